@@ -1,12 +1,64 @@
+import os
+import time
+import logging
+import threading
+import concurrent.futures
 from abc import abstractmethod
 
+import numpy as np
 import pandas as pd
 import scipy.sparse
 from anndata import AnnData
 
 from cirrocumulus.abstract_dataset import AbstractDataset
-from cirrocumulus.anndata_util import ADATA_LAYERS_UNS_KEY, ADATA_MODULE_UNS_KEY
+from cirrocumulus.anndata_util import (
+    ADATA_LAYERS_UNS_KEY,
+    ADATA_MODULE_UNS_KEY,
+    X_CSR_UNS_KEY,
+    X_QUANTIZATION_UNS_KEY,
+)
+from cirrocumulus.envir import CIRRO_DATASET_READ_CONCURRENCY
+from cirrocumulus.lru_cache import LRUCache
+from cirrocumulus.quantization import decode_X
 from cirrocumulus.sparse_dataset import SparseDataset
+from cirrocumulus.util import get_dataset_cache_size, get_dataset_info_size, get_version
+
+
+logger = logging.getLogger("cirro")
+# reads are I/O bound, the number of threads does not depend on the number of CPUs
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+max_dataset_reads = int(os.environ.get(CIRRO_DATASET_READ_CONCURRENCY, "8"))
+
+
+class DatasetReads:
+    """Submits reads of dataset components to the shared executor and records their timing.
+
+    :param semaphore: Semaphore that limits the number of concurrent reads for a dataset
+    """
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.timings = {}
+
+    def submit(self, name, fn, *args, **kwargs):
+        self.semaphore.acquire()
+
+        def run():
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.timings[name] = time.perf_counter() - start
+                self.semaphore.release()
+
+        try:
+            return executor.submit(run)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def format_timings(self):
+        return ", ".join("{}: {:.3f}s".format(name, t) for name, t in self.timings.items())
 
 
 # string_dtype = h5py.check_string_dtype(dataset.dtype)
@@ -17,6 +69,10 @@ from cirrocumulus.sparse_dataset import SparseDataset
 class AbstractBackedDataset(AbstractDataset):
     def __init__(self):
         super().__init__()
+        # (path, version) -> dict with opened root group and dataset info
+        self.handle_cache = LRUCache(
+            max_size=get_dataset_cache_size(), get_size=lambda handle: handle["size"]
+        )
 
     @abstractmethod
     def is_group(self, node):
@@ -30,16 +86,46 @@ class AbstractBackedDataset(AbstractDataset):
     def slice_dense_array(self, X, indices):
         pass
 
+    def get_version(self, filesystem, path):
+        return get_version(filesystem, path)
+
+    def get_dataset_handle(self, filesystem, path):
+        """Returns a dict containing the opened root group and dataset info.
+
+        Handles are cached per process and reopened when the dataset version changes. Handles of
+        datasets without a version are not cached.
+        """
+        version = self.get_version(filesystem, path)
+        key = (path, version) if version is not None else None
+        handle = self.handle_cache.get(key)
+        if handle is None:
+            root = self.open_group(filesystem, path)
+            info = self.read_dataset_info(root)
+            indptrs = self.read_indptrs(root)
+            size = get_dataset_info_size(info) + sum(indptr.nbytes for indptr in indptrs.values())
+            handle = dict(
+                root=root,
+                info=info,
+                indptrs=indptrs,
+                size=size,
+                # limits concurrent reads per dataset
+                semaphore=threading.BoundedSemaphore(max_dataset_reads),
+            )
+            self.handle_cache.put(key, handle)
+        return handle
+
     def get_result(self, filesystem, path, dataset, result_id):
-        g = self.open_group(filesystem, path)
+        g = self.get_dataset_handle(filesystem, path)["root"]
         uns = g["uns"]
         if result_id in uns:
             return str(uns[result_id][...])
         return super().get_result(filesystem, path, dataset, result_id)
 
     def get_dataset_info(self, filesystem, path):
+        return self.get_dataset_handle(filesystem, path)["info"]
+
+    def read_dataset_info(self, root):
         d = {}
-        root = self.open_group(filesystem, path)
         var_group = root["var"]
         var_group_index_field = var_group.attrs["_index"]
         var_ids = var_group[var_group_index_field][...]
@@ -49,7 +135,7 @@ class AbstractBackedDataset(AbstractDataset):
         X = root["X"]
         d["shape"] = X.attrs["shape"] if self.is_group(X) else X.shape
         if "layers" in root:
-            d["layers"] = root["layers"].keys()
+            d["layers"] = list(root["layers"].keys())
         if "uns" in root:
             uns_group = root["uns"]
             if "module" in uns_group:
@@ -61,26 +147,145 @@ class AbstractBackedDataset(AbstractDataset):
                 d["module"] = pd.Index(module_ids)
             if "timepoint_field" in uns_group:
                 d["timepoint_field"] = uns_group["timepoint_field"]
+            d["X_csr"] = X_CSR_UNS_KEY in uns_group
+            if X_QUANTIZATION_UNS_KEY in uns_group:
+                quantization_group = uns_group[X_QUANTIZATION_UNS_KEY]
+                d["quantization"] = {}
+                for node_path in ["X"] + ["layers/" + key for key in d.get("layers", [])]:
+                    if node_path in quantization_group:
+                        node = quantization_group[node_path]
+                        d["quantization"][node_path] = dict(
+                            scale=node["scale"][...], offset=node["offset"][...]
+                        )
         return d
 
-    def get_X(self, var_ids, keys, node):
+    def read_indptrs(self, root):
+        """Reads the indptr arrays of all sparse matrices into memory.
+
+        :return: Dict that maps group name to indptr
+        """
+        nodes = [root["X"]]
+        if "layers" in root:
+            layers_group = root["layers"]
+            nodes += [layers_group[key] for key in layers_group.keys()]
+        if "uns" in root:
+            uns_group = root["uns"]
+            if "module" in uns_group:
+                nodes.append(uns_group["module/X"])
+            if X_CSR_UNS_KEY in uns_group:
+                nodes.append(uns_group[X_CSR_UNS_KEY])
+        return {node.name: node["indptr"][...] for node in nodes if self.is_group(node)}
+
+    def get_X(self, var_ids, keys, node, obs_indices=None, csr_node=None, indptrs=None):
+        """Reads the columns given by keys from node.
+
+        :param var_ids: Index of all features stored in node
+        :param keys: List of features or a list containing one slice
+        :param node: Group or array storing the feature-major matrix
+        :param obs_indices: Optional array of observation indices to read
+        :param csr_node: Optional group storing the same matrix in cell-major (CSR) order
+        :param indptrs: Optional dict that maps group name to in-memory indptr
+        """
+        if indptrs is None:
+            indptrs = {}
         if len(keys) == 1 and isinstance(
             keys[0], slice
         ):  # special case if slice specified for performance
             get_item = keys[0]
             keys = var_ids[get_item]
+            n_features = len(range(*get_item.indices(len(var_ids))))
         else:
             get_item = var_ids.get_indexer_for(keys)
+            n_features = len(get_item)
 
         if self.is_group(node):
-            sparse_dataset = SparseDataset(node)  # sparse
-            X = sparse_dataset[:, get_item]
+            if (
+                obs_indices is not None
+                and csr_node is not None
+                and len(obs_indices) * len(var_ids) < n_features * node.attrs["shape"][0]
+            ):
+                # fraction of rows requested is smaller than fraction of columns requested
+                X = SparseDataset(csr_node, indptrs.get(csr_node.name))[obs_indices]
+                X = X[:, get_item].tocsc()
+            else:
+                sparse_dataset = SparseDataset(node, indptrs.get(node.name))  # sparse
+                X = sparse_dataset[:, get_item]
+                if obs_indices is not None:
+                    X = X[obs_indices]
         else:  # dense
             X = self.slice_dense_array(node, get_item)
+            if obs_indices is not None:
+                X = X[obs_indices]
         var = pd.DataFrame(index=keys)
         return X, var
 
-    def read_dataset(self, filesystem, path, keys=None, dataset=None):
+    def read_X(
+        self,
+        root,
+        node_path,
+        var_ids,
+        keys,
+        obs_indices=None,
+        csr_node_path=None,
+        indptrs=None,
+        quantization=None,
+    ):
+        """Reads the columns given by keys from the node at node_path and decodes values stored as
+        float16 or quantized uint16."""
+        if indptrs is None:
+            indptrs = {}
+        X, var = self.get_X(
+            var_ids,
+            keys,
+            root[node_path],
+            obs_indices,
+            root[csr_node_path] if csr_node_path is not None else None,
+            indptrs,
+        )
+        columns = None
+        if quantization is not None:
+            columns = (
+                keys[0]
+                if len(keys) == 1 and isinstance(keys[0], slice)
+                else var_ids.get_indexer_for(keys)
+            )
+        return decode_X(X, quantization, columns), var
+
+    @staticmethod
+    def read_array(root, node_path, obs_indices=None):
+        values = root[node_path][...]
+        if obs_indices is not None:
+            values = values[obs_indices]
+        return values
+
+    @staticmethod
+    def read_obs_values(group, key, obs_indices=None):
+        if key == "index":
+            index_field = group.attrs["_index"]
+            values = group[index_field][...]
+            if pd.api.types.is_object_dtype(values):
+                values = values.astype(str)
+        else:
+            dataset = group[key]
+            values = dataset[...]
+            if "categories" in dataset.attrs:
+                categories = dataset.attrs["categories"]
+                categories_dset = group[categories]
+                categories = categories_dset[...]
+                if pd.api.types.is_object_dtype(categories):
+                    categories = categories.astype(str)
+                ordered = categories_dset.attrs.get("ordered", False)
+                values = pd.Categorical.from_codes(values, categories, ordered=ordered)
+        if obs_indices is not None:
+            values = values[obs_indices]
+        return values
+
+    def read_dataset(self, filesystem, path, keys=None, dataset=None, obs_indices=None):
+        """Reads the requested features, observations, and embeddings.
+
+        :param obs_indices: Optional array of observation indices to read. When supplied, a cell-
+            major copy of X is used if present and cheaper to read than the feature-major copy.
+        """
         keys = keys.copy()
         X_keys = keys.pop("X", [])
         obs_keys = keys.pop("obs", [])
@@ -92,54 +297,91 @@ class AbstractBackedDataset(AbstractDataset):
         var = None
         obsm = {}
         adata_modules = None
-        dataset_info = self.get_dataset_info(filesystem, path)
-        root = self.open_group(filesystem, path)
-        layers = {}
+        handle = self.get_dataset_handle(filesystem, path)
+        dataset_info = handle["info"]
+        root = handle["root"]
+        obs_index = pd.RangeIndex(dataset_info["shape"][0])
+        if obs_indices is not None:
+            obs_indices = np.asarray(obs_indices)
+            if obs_indices.dtype == bool:
+                obs_indices = np.where(obs_indices)[0]
+            obs_index = obs_index[obs_indices]
+        obs_index = obs_index.astype(str)
+        indptrs = handle["indptrs"]
+        # read each component concurrently
+        reads = DatasetReads(handle["semaphore"])
+        layer_futures = {}
         for layer_key in keys.keys():
-            X_layer, var_layer = self.get_X(
-                dataset_info["var"], keys[layer_key], root["layers"][layer_key]
+            layer_futures[layer_key] = reads.submit(
+                "layers/" + layer_key,
+                self.read_X,
+                root,
+                "layers/" + layer_key,
+                dataset_info["var"],
+                keys[layer_key],
+                obs_indices,
+                indptrs=indptrs,
+                quantization=dataset_info.get("quantization", {}).get("layers/" + layer_key),
             )
-            adata_layer = AnnData(X=X_layer, var=var_layer)
-            layers[layer_key] = adata_layer
+        X_future = None
         if len(X_keys) > 0:
-            X, var = self.get_X(dataset_info["var"], X_keys, root["X"])
-        if len(obs_keys) > 0:
-            obs = pd.DataFrame(index=pd.RangeIndex(dataset_info["shape"][0]).astype(str))
-            group = root["obs"]
-            for key in obs_keys:
-                if key == "index":
-                    index_field = group.attrs["_index"]
-                    values = group[index_field][...]
-                    if pd.api.types.is_object_dtype(values):
-                        values = values.astype(str)
-                else:
-                    dataset = group[key]
-                    values = dataset[...]
-                    if "categories" in dataset.attrs:
-                        categories = dataset.attrs["categories"]
-                        categories_dset = group[categories]
-                        categories = categories_dset[...]
-                        if pd.api.types.is_object_dtype(categories):
-                            categories = categories.astype(str)
-                        ordered = categories_dset.attrs.get("ordered", False)
-                        values = pd.Categorical.from_codes(values, categories, ordered=ordered)
-                obs[key] = values
+            X_future = reads.submit(
+                "X",
+                self.read_X,
+                root,
+                "X",
+                dataset_info["var"],
+                X_keys,
+                obs_indices,
+                "uns/" + X_CSR_UNS_KEY if dataset_info.get("X_csr", False) else None,
+                indptrs,
+                dataset_info.get("quantization", {}).get("X"),
+            )
+        obs_futures = {}
+        obs_group = root["obs"] if len(obs_keys) > 0 else None
+        for key in obs_keys:
+            obs_futures[key] = reads.submit(
+                "obs/" + key, self.read_obs_values, obs_group, key, obs_indices
+            )
+        module_future = None
         if len(module_keys) > 0:
-            module_ids = dataset_info["module"]
-            module_X_node = root["uns/module/X"]
-            module_X, module_var = self.get_X(module_ids, module_keys, module_X_node)
+            module_future = reads.submit(
+                "uns/module/X",
+                self.read_X,
+                root,
+                "uns/module/X",
+                dataset_info["module"],
+                module_keys,
+                obs_indices,
+                indptrs=indptrs,
+            )
+        basis_futures = {}
+        for key in basis_keys:
+            basis_futures[key] = reads.submit(
+                "obsm/" + key, self.read_array, root, "obsm/" + key, obs_indices
+            )
+
+        layers = {}
+        for layer_key, future in layer_futures.items():
+            X_layer, var_layer = future.result()
+            layers[layer_key] = AnnData(X=X_layer, var=var_layer)
+        if X_future is not None:
+            X, var = X_future.result()
+        if len(obs_futures) > 0:
+            obs = pd.DataFrame(index=obs_index)
+            for key, future in obs_futures.items():
+                obs[key] = future.result()
+        if module_future is not None:
+            module_X, module_var = module_future.result()
             adata_modules = AnnData(X=module_X, var=module_var, obs=obs)  # obs is shared
-        if len(basis_keys) > 0:
-            group = root["obsm"]
-            for key in basis_keys:
-                embedding_data = group[key][...]
-                obsm[key] = embedding_data
-                if X is None:
-                    X = scipy.sparse.coo_matrix(([], ([], [])), shape=(embedding_data.shape[0], 0))
+        for key, future in basis_futures.items():
+            embedding_data = future.result()
+            obsm[key] = embedding_data
+            if X is None:
+                X = scipy.sparse.coo_matrix(([], ([], [])), shape=(embedding_data.shape[0], 0))
+        logger.debug("Read {} in {}".format(path, reads.format_timings()))
         if X is None and obs is None and len(obsm.keys()) == 0:
-            if dataset_info is None:
-                dataset_info = self.get_dataset_info(filesystem, path)
-            obs = pd.DataFrame(index=pd.RangeIndex(dataset_info["shape"][0]).astype(str))
+            obs = pd.DataFrame(index=obs_index)
         adata = AnnData(X=X, obs=obs, var=var, obsm=obsm)
         if adata_modules is not None:
             adata.uns[ADATA_MODULE_UNS_KEY] = adata_modules
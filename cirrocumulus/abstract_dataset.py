@@ -31,6 +31,8 @@ class AbstractDataset(ABC):
             pd.Index(map(lambda x: x["id"], var)) if isinstance(var[0], dict) else pd.Index(var)
         )
         d["shape"] = s["shape"]
+        # whether X and layers are stored as single files with one row group per feature
+        d["bundle"] = s.get("bundle", False)
         return d
 
     def get_schema(self, filesystem, path):
@@ -7,7 +7,12 @@ from anndata import AnnData
 from pandas import CategoricalDtype
 
 from cirrocumulus.abstract_dataset import AbstractDataset
-from cirrocumulus.anndata_util import ADATA_LAYERS_UNS_KEY, ADATA_MODULE_UNS_KEY, dataset_schema
+from cirrocumulus.anndata_util import (
+    ADATA_LAYERS_UNS_KEY,
+    ADATA_MODULE_UNS_KEY,
+    dataset_schema,
+    subset_obs,
+)
 from cirrocumulus.io_util import add_spatial, read_star_fusion_file
 
 
@@ -16,9 +21,19 @@ logger = logging.getLogger("cirro")
 CATEGORICAL_FIELDS_CONVERT = ["seurat_clusters"]
 
 
-def read_adata(path, filesystem, backed=False, spatial_directory=None, use_raw=False):
+def read_adata(
+    path,
+    filesystem,
+    backed=False,
+    spatial_directory=None,
+    use_raw=False,
+    out_of_core_directory=None,
+):
     path = path.rstrip(filesystem.sep)
     path_lc = path.lower()
+    if out_of_core_directory is not None and not path_lc.endswith(".h5ad"):
+        logger.info("Out-of-core conversion is only supported for h5ad files")
+        out_of_core_directory = None
     if path_lc.endswith(".loom"):
         adata = anndata.read_loom(filesystem.open(path))
     elif path_lc.endswith(".zarr"):
@@ -105,7 +120,12 @@ def read_adata(path, filesystem, backed=False, spatial_directory=None, use_raw=F
                 X=adata.raw.X, var=adata.raw.var, obs=adata.obs, obsm=adata.obsm, uns=adata.uns
             )
     else:
-        if backed:
+        if out_of_core_directory is not None:
+            from cirrocumulus.out_of_core import read_h5ad
+
+            with filesystem.open(path) as f:
+                adata = read_h5ad(f, out_of_core_directory)
+        elif backed:
             adata = anndata.read_h5ad(path, backed="r")
         else:
             adata = anndata.read_h5ad(filesystem.open(path))
@@ -193,7 +213,7 @@ class AnndataDataset(AbstractDataset):
         var = pd.DataFrame(index=d.var.index)
         return X, var
 
-    def read_dataset(self, filesystem, path, keys=None, dataset=None):
+    def read_dataset(self, filesystem, path, keys=None, dataset=None, obs_indices=None):
         adata = self.get_data(filesystem, path)
         if keys is None:
             keys = {}
@@ -242,4 +262,4 @@ class AnndataDataset(AbstractDataset):
         if adata_modules is not None:
             adata.uns[ADATA_MODULE_UNS_KEY] = adata_modules
         adata.uns[ADATA_LAYERS_UNS_KEY] = layers
-        return adata
+        return subset_obs(adata, obs_indices)
@@ -1,6 +1,9 @@
+import math
+
 import numpy as np
 import pandas as pd
 import anndata
+import scipy.sparse
 from pandas import CategoricalDtype
 
 
@@ -8,6 +11,30 @@ DATA_TYPE_MODULE = "module"
 DATA_TYPE_UNS_KEY = "data_type"
 ADATA_MODULE_UNS_KEY = "anndata_module"
 ADATA_LAYERS_UNS_KEY = "anndata_layers"
+# cell-major (CSR) copy of X
+X_CSR_UNS_KEY = "cirro-X_csr"
+# per-feature scale and offset of uint16 matrices, node path (X or layers/name) -> scale, offset
+X_QUANTIZATION_UNS_KEY = "cirro-quantization"
+
+
+def get_feature_values(X, j):
+    """Returns the row indices and values of the non-zero entries in column j of a CSC matrix,
+    sliced using indptr without densifying the column, or None and all values of column j of a
+    dense matrix."""
+    if scipy.sparse.issparse(X):
+        start, end = X.indptr[j], X.indptr[j + 1]
+        indices = X.indices[start:end]
+        values = X.data[start:end]
+        nonzero = values != 0
+        if not nonzero.all():
+            indices = indices[nonzero]
+            values = values[nonzero]
+        if len(indices) > 1 and not (np.diff(indices) > 0).all():
+            order = np.argsort(indices, kind="stable")
+            indices = indices[order]
+            values = values[order]
+        return indices, values
+    return None, np.asarray(X[:, j]).flatten()
 
 
 def get_base(adata):
@@ -17,6 +44,84 @@ def get_base(adata):
     return base
 
 
+def subset_obs(adata, obs_indices):
+    """Subsets observations of an AnnData returned by read_dataset, including layers and modules."""
+    if obs_indices is None:
+        return adata
+    layers = adata.uns.pop(ADATA_LAYERS_UNS_KEY, None)
+    adata_modules = adata.uns.pop(ADATA_MODULE_UNS_KEY, None)
+    result = adata[obs_indices].copy()
+    if layers is not None:
+        result.uns[ADATA_LAYERS_UNS_KEY] = {
+            key: layers[key][obs_indices].copy() for key in layers.keys()
+        }
+    if adata_modules is not None:
+        result.uns[ADATA_MODULE_UNS_KEY] = adata_modules[obs_indices].copy()
+    return result
+
+
+def combine_codes(obs, fields):
+    """Assigns each observation to the observed combination of values of fields.
+
+    Field codes are combined arithmetically so that values are not converted to strings. When the
+    number of possible combinations does not fit in int64, tuples of field codes are factorized
+    instead.
+
+    :return: Tuple of combination code per observation (-1 if a value is missing), code of each
+        field for each observed combination, and values of each field.
+    """
+    missing = np.zeros(len(obs), dtype=bool)
+    field_codes = []
+    field_values = []
+    for field in fields:
+        series = obs[field]
+        if isinstance(series.dtype, CategoricalDtype):
+            codes = series.cat.codes.values
+            values = series.cat.categories
+        else:
+            codes, values = pd.factorize(series, sort=True)
+        missing |= codes < 0
+        field_codes.append(codes.astype(np.int64))
+        field_values.append(values)
+    keep = ~missing
+    if math.prod(len(values) for values in field_values) <= np.iinfo(np.int64).max:
+        combined_codes = np.zeros(keep.sum(), dtype=np.int64)
+        for codes, values in zip(field_codes, field_values):
+            combined_codes = combined_codes * len(values) + codes[keep]
+        observed_codes, kept_codes = np.unique(combined_codes, return_inverse=True)
+        observed_field_codes = []
+        for values in reversed(field_values):
+            observed_field_codes.insert(0, observed_codes % len(values))
+            observed_codes = observed_codes // len(values)
+    else:
+        # lexicographic order of code tuples matches the order of mixed-radix codes
+        observed_tuples, kept_codes = np.unique(
+            np.column_stack([codes[keep] for codes in field_codes]), axis=0, return_inverse=True
+        )
+        observed_field_codes = list(observed_tuples.T)
+    codes = np.full(len(obs), -1, dtype=np.int64)
+    codes[keep] = kept_codes.ravel()
+    return codes, observed_field_codes, field_values
+
+
+def combined_code_names(field_values, observed_field_codes, sep):
+    """Creates names for observed combinations returned by combine_codes."""
+    if len(field_values) == 1:
+        return field_values[0].take(observed_field_codes[0])
+    names = None
+    for values, codes in zip(field_values, observed_field_codes):
+        field_names = values.astype(str).take(codes)
+        names = field_names if names is None else names + sep + field_names
+    return names
+
+
+def combine_fields(obs, fields, sep):
+    """Creates a categorical series of observed combinations of values of fields."""
+    codes, observed_field_codes, field_values = combine_codes(obs, fields)
+    categories = combined_code_names(field_values, observed_field_codes, sep)
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=obs.index)
+
+
 def adata_to_df(adata):
     df = pd.DataFrame(adata.X, index=adata.obs.index, columns=adata.var.index)
     for key in adata.layers.keys():
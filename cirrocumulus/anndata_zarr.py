@@ -19,6 +19,8 @@ class WriteWarning(UserWarning):
 
 
 T = TypeVar("T")
+# number of chunks along the first axis written at once by write_array
+write_block_chunks = 16
 
 
 def _to_fixed_length_strings(value: np.ndarray) -> np.ndarray:
@@ -179,8 +181,15 @@ def write_array(g, key, value, dataset_kwargs=MappingProxyType({})):
     elif value.dtype.kind == "V":
         # Structured dtype
         g.create_dataset(key, data=_to_fixed_length_strings(value), **dataset_kwargs)
-    else:
+    elif value.ndim == 0 or value.shape[0] == 0:
         g.create_dataset(key, data=value, **dataset_kwargs)
+    else:
+        # write blocks of chunks so that stores that batch writes do not hold every encoded chunk
+        # of large arrays in memory
+        z = g.create_dataset(key, shape=value.shape, dtype=value.dtype, **dataset_kwargs)
+        step = z.chunks[0] * write_block_chunks
+        for start in range(0, value.shape[0], step):
+            z[start : start + step] = value[start : start + step]
 
 
 # TODO: Not working quite right
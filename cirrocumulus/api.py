@@ -1,16 +1,20 @@
 import os
 import json
+import hashlib
 from urllib.parse import urlparse
 
+import flask
 import pandas as pd
 import anndata
 from flask import Blueprint, Response, request, stream_with_context
+from werkzeug.datastructures import ContentRange
 
 import cirrocumulus.data_processing as data_processing
 
 from .anndata_util import adata_to_df
 from .auth_exception import AuthException
 from .blueprint_util import get_auth, get_database, map_url
+from .compression import compress, get_encoding
 from .dataset_api import DatasetAPI
 from .envir import (
     CIRRO_AUTH_CLIENT_ID,
@@ -23,6 +27,7 @@ from .envir import (
     CIRRO_FOOTER,
     CIRRO_LIBRARY,
     CIRRO_MIXPANEL,
+    CIRRO_RESPONSE_CACHE_DIR,
     CIRRO_SERVE,
     CIRRO_SPECIES,
     CIRRO_STATIC_DIR,
@@ -30,12 +35,30 @@ from .envir import (
 )
 from .invalid_usage import InvalidUsage
 from .job_api import delete_job, submit_job
-from .util import get_fs, get_scheme, json_response, open_file
+from .response_cache import ResponseCache
+from .util import (
+    NDJSON_CONTENT_TYPE,
+    data_response,
+    get_data_content_type,
+    get_file_chunk_size,
+    get_fs,
+    get_response_cache_size,
+    get_scheme,
+    get_version,
+    json_response,
+    open_file,
+    serialize_data,
+    stream_response,
+    to_json,
+)
 
 
 cirro_blueprint = Blueprint("cirro", __name__)
 
 dataset_api = DatasetAPI()
+response_cache = ResponseCache(
+    max_size=get_response_cache_size(), directory=os.environ.get(CIRRO_RESPONSE_CACHE_DIR)
+)
 
 
 def get_email_and_dataset(content):
@@ -104,27 +127,107 @@ def get_file_path(file, dataset_url):
 
 
 def send_file(file_path, as_attachment=False):
+    """Sends a file, supporting byte ranges and conditional requests.
+
+    Local files are sent with flask.send_file so that the server can use sendfile.
+    """
     import mimetypes
 
     mimetype, encoding = mimetypes.guess_type(file_path)
-    chunk_size = 4096
-    f = get_fs(file_path).open(file_path)
-
-    def generate():
-        while True:
-            chunk = f.read(chunk_size)
-            if len(chunk) <= 0:
-                f.close()
-                break
-            yield chunk
-
-    r = Response(stream_with_context(generate()), mimetype=mimetype)
-    r.headers["Content-Encoding"] = encoding
+    if get_scheme(file_path) == "file":
+        if file_path.startswith("file://"):
+            file_path = file_path[len("file://") :]
+        r = flask.send_file(
+            os.path.abspath(file_path),
+            mimetype=mimetype or "application/octet-stream",
+            conditional=True,
+        )
+    else:
+        r = send_remote_file(file_path, mimetype)
+    if encoding is not None:
+        r.headers["Content-Encoding"] = encoding
     if as_attachment:
         r.headers["Content-Disposition"] = f'attachment; filename="{os.path.basename(file_path)}"'
     return r
 
 
+def send_remote_file(file_path, mimetype):
+    fs = get_fs(file_path)
+    info = fs.info(file_path)
+    size = info["size"]
+    version = get_version(fs, file_path)
+    if version is not None:
+        etag = hashlib.sha256("{}:{}".format(file_path, version).encode("utf-8")).hexdigest()
+        if request.if_none_match.contains(etag):
+            r = Response(status=304)
+            r.set_etag(etag)
+            return r
+    start = 0
+    stop = size
+    byte_range = request.range
+    # ignore range if file changed
+    if byte_range is not None and (version is None or request.if_range.etag in (None, etag)):
+        range_for_length = byte_range.range_for_length(size)
+        if range_for_length is None:
+            r = Response(status=416)
+            r.headers["Content-Range"] = "bytes */{}".format(size)
+            return r
+        start, stop = range_for_length
+    chunk_size = get_file_chunk_size()
+
+    def generate():
+        with fs.open(file_path, mode="rb", block_size=chunk_size) as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if len(chunk) == 0:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    r = Response(
+        stream_with_context(generate()),
+        status=206 if (start, stop) != (0, size) else 200,
+        mimetype=mimetype,
+    )
+    r.headers["Content-Length"] = str(stop - start)
+    r.accept_ranges = "bytes"
+    if r.status_code == 206:
+        r.content_range = ContentRange("bytes", start, stop, size)
+    if version is not None:
+        r.set_etag(etag)
+    return r
+
+
+def cached_response(key, content_type, get_content):
+    """Returns content that is identical for key, compressed at most once per accepted encoding.
+
+    :param key: Key that changes when content changes, also used for the ETag
+    :param content_type: Content type
+    :param get_content: Function that returns the uncompressed content as bytes
+    """
+    encoding = get_encoding()
+    etag = key if encoding is None else "{}:{}".format(key, encoding)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        entry = response_cache.get(etag)
+        if entry is None:
+            content = get_content()
+            if encoding is not None:
+                content = compress(content, encoding, cached=True)
+            response_cache.put(etag, content_type, content)
+        else:
+            content = entry[1]
+        response = Response(content, content_type=content_type)
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
 @cirro_blueprint.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     return Response(error.message, error.status_code)
@@ -372,7 +475,8 @@ def handle_schema():
     schema = dataset  # dataset has title, etc. from database
     schema["markers"] = database_api.get_feature_sets(email=email, dataset_id=dataset_id)
     schema.update(dataset_api.get_schema(dataset))
-    return json_response(schema)
+    content = to_json(schema).encode("utf-8")
+    return cached_response(hashlib.sha256(content).hexdigest(), "application/json", lambda: content)
 
 
 @cirro_blueprint.route("/file", methods=["GET"])
@@ -409,17 +513,31 @@ def handle_user():
 def handle_data():
     json_request = request.get_json(cache=False)
     email, dataset = get_email_and_dataset(json_request)
-    return json_response(
-        data_processing.handle_data(
-            dataset_api=dataset_api,
-            dataset=dataset,
-            embedding_list=json_request.get("embedding"),
-            values=json_request.get("values"),
-            stats=json_request.get("stats"),
-            grouped_stats=json_request.get("groupedStats"),
-            selection=json_request.get("selection"),
-        )
+    params = dict(
+        dataset_api=dataset_api,
+        dataset=dataset,
+        embedding_list=json_request.get("embedding"),
+        values=json_request.get("values"),
+        stats=json_request.get("stats"),
+        grouped_stats=json_request.get("groupedStats"),
+        selection=json_request.get("selection"),
+    )
+    content_type = get_data_content_type()
+    if content_type == NDJSON_CONTENT_TYPE:
+        # stream results as they are computed
+        return stream_response(data_processing.iter_data(**params))
+    version = dataset_api.get_version(dataset)
+    if version is None:  # dataset changes can not be detected
+        return data_response(data_processing.handle_data(**params))
+    # identical requests for the same dataset version return the same response
+    key = ResponseCache.get_key(dataset["url"], version, content_type, json_request)
+    response = cached_response(
+        key,
+        content_type,
+        lambda: serialize_data(data_processing.handle_data(**params), content_type),
     )
+    response.vary.add("Accept")
+    return response
 
 
 @cirro_blueprint.route("/selection", methods=["POST"])
@@ -428,7 +546,7 @@ def handle_selection():
     content = request.get_json(cache=False)
     email, dataset = get_email_and_dataset(content)
     data_filter = content.get("filter")
-    return json_response(
+    return data_response(
         data_processing.handle_selection(
             dataset_api=dataset_api,
             dataset=dataset,
@@ -447,7 +565,10 @@ def handle_selected_ids():
     data_filter = content.get("filter")
     return json_response(
         data_processing.handle_selection_ids(
-            dataset_api=dataset_api, dataset=dataset, data_filter=data_filter
+            dataset_api=dataset_api,
+            dataset=dataset,
+            data_filter=data_filter,
+            encode=content.get("encode", False),
         )
     )
 
@@ -570,7 +691,10 @@ def handle_job():
             dataset["url"] = map_url(dataset["url"])
             job_result = dataset_api.get_result(dataset, job_id)
             if get_scheme(job_result) == "file" and not os.path.exists(job_result):
-                return Response(job_result, content_type="application/json")
+                content = job_result.encode("utf-8")
+                return cached_response(
+                    hashlib.sha256(content).hexdigest(), "application/json", lambda: content
+                )
             else:
                 return send_file(job_result)
         job = database_api.get_job(email=email, job_id=job_id, return_type=c)
@@ -605,7 +729,7 @@ def handle_job():
                 # URL to JSON or text
                 return send_file(url)
         elif isinstance(job, dict):
-            return json_response(job)
+            return data_response(job)
         elif isinstance(job, anndata.AnnData):
             return Response(
                 adata_to_df(job).to_json(double_precision=2, orient="records"),
@@ -0,0 +1,73 @@
+import os
+import gzip
+
+from flask import request
+
+from cirrocumulus.abstract_db import to_bool
+from cirrocumulus.envir import CIRRO_COMPRESS
+
+
+compressors = dict(gzip=lambda content, level: gzip.compress(content, compresslevel=level))
+try:
+    import brotli
+
+    compressors["br"] = lambda content, level: brotli.compress(content, quality=level)
+except ModuleNotFoundError:
+    pass
+try:
+    import zstandard
+
+    compressors["zstd"] = lambda content, level: zstandard.ZstdCompressor(level=level).compress(
+        content
+    )
+except ModuleNotFoundError:
+    pass
+
+# encoding -> level for content that is compressed once and served many times
+cached_levels = dict(gzip=9, br=9, zstd=15)
+# cached content larger than this is compressed with the dynamic levels
+max_cached_level_size = 4 << 20
+# encoding -> (maximum size in bytes, level), faster levels for larger content
+dynamic_levels = dict(
+    gzip=[(1 << 20, 6), (16 << 20, 3), (None, 1)],
+    br=[(1 << 20, 5), (16 << 20, 3), (None, 1)],
+    zstd=[(1 << 20, 3), (16 << 20, 2), (None, 1)],
+)
+# responses smaller than this are not compressed
+min_size = 500
+
+
+def get_encoding():
+    """Returns the preferred content encoding accepted by the client or None."""
+    if not to_bool(os.environ.get(CIRRO_COMPRESS, "true")):
+        return None
+    return request.accept_encodings.best_match(
+        [encoding for encoding in ["br", "zstd", "gzip"] if encoding in compressors]
+    )
+
+
+def get_compression_level(encoding, size, cached=False):
+    if cached and size <= max_cached_level_size:
+        return cached_levels[encoding]
+    for max_size, level in dynamic_levels[encoding]:
+        if max_size is None or size <= max_size:
+            return level
+
+
+def compress(content, encoding, cached=False):
+    """Compresses content with a level chosen by content size, using the highest levels for
+    content that will be cached unless it is large."""
+    return compressors[encoding](
+        content, get_compression_level(encoding, len(content), cached=cached)
+    )
+
+
+def compress_response(response):
+    """Compresses the data of a non-streamed response if the client accepts a compressed
+    encoding. Responses that are compressed here are skipped by flask_compress."""
+    response.vary.add("Accept-Encoding")
+    encoding = get_encoding()
+    if encoding is not None and response.content_length >= min_size:
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers["Content-Encoding"] = encoding
+    return response
@@ -1,3 +1,6 @@
+import operator
+
+import numpy as np
 import pandas as pd
 import scipy.sparse
 from pandas import CategoricalDtype
@@ -6,10 +9,19 @@ from cirrocumulus.anndata_util import ADATA_LAYERS_UNS_KEY, ADATA_MODULE_UNS_KEY
 from cirrocumulus.dotplot_aggregator import DotPlotAggregator
 from cirrocumulus.feature_aggregator import FeatureAggregator
 from cirrocumulus.ids_aggregator import IdsAggregator
+from cirrocumulus.mask_encoding import decode_mask, encode_mask
 from cirrocumulus.unique_aggregator import UniqueAggregator
 
 
 def get_mask(dataset_api, dataset, dataset_info, data_filters):
+    """Computes the boolean mask of cells that pass each filter.
+
+    Masks are cached by dataset version and filter so that the dataset is only read for filters
+    that have not been evaluated before.
+
+    :return: Tuple of masks (None for filters without criteria) and the data read to compute the
+        masks (None if all masks were cached).
+    """
     measures = set()
     dimensions = set()
     basis = set()
@@ -18,16 +30,46 @@ def get_mask(dataset_api, dataset, dataset_info, data_filters):
         measures.update(_measures)
         dimensions.update(_dimensions)
         basis.update(_basis)
-    keys = get_type_to_measures(measures)
-    keys["obs"] = list(dimensions)
-    keys["basis"] = list(basis)
-    adata = dataset_api.read_dataset(keys=keys, dataset=dataset)
-    result = []
-    for data_filter in data_filters:
-        result.append(get_filter_expr(adata, data_filter))
+    # computing a key reads the dataset version
+    cache_keys = [
+        dataset_api.get_mask_cache_key(dataset, data_filter) if data_filter is not None else None
+        for data_filter in data_filters
+    ]
+    result = [dataset_api.mask_cache.get(key) if key is not None else None for key in cache_keys]
+    adata = None
+    if any(mask is None for mask in result):
+        keys = get_type_to_measures(measures)
+        keys["obs"] = list(dimensions)
+        keys["basis"] = list(basis)
+        adata = dataset_api.read_dataset(keys=keys, dataset=dataset)
+        for i in range(len(data_filters)):
+            if cache_keys[i] is None:  # no criteria or dataset version unknown
+                result[i] = get_filter_expr(adata, data_filters[i])
+            elif result[i] is None:
+                result[i] = get_cached_filter_expr(
+                    dataset_api, dataset, adata, data_filters[i], cache_keys[i]
+                )
     return result, adata
 
 
+def get_cached_filter_expr(dataset_api, dataset, adata, data_filter, key=None):
+    """Returns the cached mask for data_filter or evaluates it on adata.
+
+    :param key: Mask cache key of data_filter if already computed
+    """
+    if data_filter is None:
+        return None
+    if key is None:
+        key = dataset_api.get_mask_cache_key(dataset, data_filter)
+    keep = dataset_api.mask_cache.get(key)
+    if keep is None:
+        keep = get_filter_expr(adata, data_filter)
+        if keep is not None and key is not None:
+            keep.flags.writeable = False  # shared between requests
+            dataset_api.mask_cache.put(key, keep)
+    return keep
+
+
 def apply_filter(adata, data_filter):
     keep_expr = get_filter_expr(adata, data_filter)
     return adata[keep_expr] if keep_expr is not None else adata
@@ -70,6 +112,16 @@ def get_filter_str(data_filter):
     return "".join(s).replace("/", "-").replace(" ", "-").replace("\\", "-")
 
 
+_filter_operations = {
+    ">": operator.gt,
+    "=": operator.eq,
+    "<": operator.lt,
+    "!=": operator.ne,
+    ">=": operator.ge,
+    "<=": operator.le,
+}
+
+
 def _flatten_array(val):
     if scipy.sparse.issparse(val):
         val = val.toarray().flatten()
@@ -80,99 +132,128 @@ def _flatten_array(val):
     return val
 
 
-def get_filter_expr(adata, data_filter):
-    keep_expr = None
-    if data_filter is not None:
-        user_filters = data_filter.get("filters", [])
-        combine_filters = data_filter.get("combine", "and")
-        for filter_obj in user_filters:
-            field = filter_obj["field"]
-            op = filter_obj["operation"]
-            value = filter_obj["value"]
-            invert = filter_obj.get("invert", False)
-            if isinstance(field, dict):  # selection box
-                # selected_points_basis = get_basis(field['basis'], field.get('nbins'),
-                #                                   field.get('agg'), field.get('ndim', '2'),
-                #                                   field.get('precomputed', False))
-
-                if "points" in value:
-                    p = value["points"]
-                    # list of indices
-                    keep = pd.RangeIndex(adata.shape[0]).isin(p)
-
-                # else:
-                #     keep = None
-                #     for p in value['path']:
-                #         if 'z' in p:  # 3d
-                #             selection_keep = \
-                #                 (df[selected_points_basis['coordinate_columns'][0]] >= p['x']) & \
-                #                 (df[selected_points_basis['coordinate_columns'][0]] <= p['x'] + p['width']) & \
-                #                 (df[selected_points_basis['coordinate_columns'][1]] >= p['y']) & \
-                #                 (df[selected_points_basis['coordinate_columns'][1]] <= p['y'] + p[
-                #                     'height']) & \
-                #                 (df[selected_points_basis['coordinate_columns'][2]] >= p['z']) & \
-                #                 (df[selected_points_basis['coordinate_columns'][2]] <= p['z'] + p['depth'])
-                #         else:
-                #             selection_keep = \
-                #                 (df[selected_points_basis['coordinate_columns'][0]] >= p['x']) & \
-                #                 (df[selected_points_basis['coordinate_columns'][0]] <= p['x'] + p['width']) & \
-                #                 (df[selected_points_basis['coordinate_columns'][1]] >= p['y']) & \
-                #                 (df[selected_points_basis['coordinate_columns'][1]] <= p['y'] + p['height'])
-
-                # keep = selection_keep | keep if keep is not None else selection_keep
-
-            elif field == "__index":
-                import numpy as np
-
-                keep = np.zeros(adata.shape[0], dtype=bool)
-                keep[value] = True
+def compile_filter(data_filter):
+    """Converts a filter to a list of (field, operations, invert) terms and how to combine them.
+
+    Operations are either ("in", values) or a list of (function, value) pairs that are combined
+    with and.
+    """
+    terms = []
+    for filter_obj in data_filter.get("filters", []):
+        field = filter_obj["field"]
+        op = filter_obj["operation"]
+        value = filter_obj["value"]
+        if isinstance(field, dict) or field == "__index":  # selection box or cell indices
+            if isinstance(value, dict) and ("rle" in value or "bitmap" in value):
+                operations = ("mask", value)  # see mask_encoding.encode_mask
             else:
-                series = (
-                    adata.obs[field]
-                    if field in adata.obs
-                    else adata[:, adata.var.index == field].X[:, 0]
-                )
-                if op == "in":
-                    keep = (series.isin(value)).values
-                else:  # array of operations e.g. >, <
-                    keep = None
-                    for i in range(len(op)):
-                        op_i = op[i]
-                        value_i = value[i]
-                        if op_i == ">":
-                            keep_i = series > value_i
-                        elif op_i == "=":
-                            keep_i = series == value_i
-                        elif op_i == "<":
-                            keep_i = series < value_i
-                        elif op_i == "!=":
-                            keep_i = series != value_i
-                        elif op_i == ">=":
-                            keep_i = series >= value_i
-                        elif op_i == "<=":
-                            keep_i = series <= value_i
-                        else:
-                            raise ValueError(
-                                "Unknown filter, field: {}, operation: {}, value: {}".format(
-                                    field, op, value
-                                )
-                            )
-                        keep_i = _flatten_array(keep_i)
-                        keep = keep_i & keep if keep is not None else keep_i
-            keep = _flatten_array(keep)
-            if invert:
-                keep = ~keep
-            if keep_expr is not None:
-                if combine_filters == "and":
-                    keep_expr = keep_expr & keep
-                else:
-                    keep_expr = keep_expr | keep
+                operations = ("points", value.get("points") if isinstance(value, dict) else value)
+            field = None
+        elif op == "in":
+            operations = ("in", value)
+        else:  # array of operations e.g. >, <
+            operations = []
+            for i in range(len(op)):
+                if op[i] not in _filter_operations:
+                    raise ValueError(
+                        "Unknown filter, field: {}, operation: {}, value: {}".format(
+                            field, op, value
+                        )
+                    )
+                operations.append((_filter_operations[op[i]], value[i]))
+        terms.append((field, operations, filter_obj.get("invert", False)))
+    return terms, data_filter.get("combine", "and")
+
+
+def _points_expr(n, points):
+    keep = np.zeros(n, dtype=bool)
+    if points is not None:
+        points = np.asarray(points, dtype=np.int64)
+        keep[points[(points >= 0) & (points < n)]] = True
+    return keep
+
+
+def _values_expr(values, operations):
+    # evaluate operations on a numpy array
+    if operations[0] == "in":
+        return np.isin(values, operations[1])
+    keep = None
+    for op, value in operations:
+        keep_i = op(values, value)
+        keep = keep_i & keep if keep is not None else keep_i
+    return keep
+
+
+def _obs_expr(series, operations):
+    if isinstance(series.dtype, CategoricalDtype):
+        if operations[0] == "in":
+            # compare codes instead of values
+            indexer = series.cat.categories.get_indexer(pd.Index(operations[1]).unique())
+            return np.isin(series.cat.codes.values, indexer[indexer != -1])
+    elif isinstance(series.values, np.ndarray) and series.dtype.kind in "biuf":
+        return _values_expr(series.values, operations)
+    if operations[0] == "in":
+        return series.isin(operations[1]).values
+    keep = None
+    for op, value in operations:
+        keep_i = _flatten_array(op(series, value))
+        keep = keep_i & keep if keep is not None else keep_i
+    return keep
+
+
+def _X_expr(X, operations):
+    if not scipy.sparse.issparse(X):
+        return _values_expr(np.asarray(X).reshape(-1), operations)
+    # evaluate operations on stored values only
+    X = scipy.sparse.csc_matrix(X)
+    X.sum_duplicates()
+    keep = np.full(X.shape[0], _values_expr(np.zeros(1, dtype=X.dtype), operations)[0])
+    keep[X.indices] = _values_expr(X.data, operations)
+    return keep
+
+
+def get_var_position(var_index, field):
+    """Returns the column of field, using the first column when var names are not unique."""
+    positions = var_index.get_indexer_for([field])
+    if len(positions) == 0 or positions[0] == -1:
+        raise KeyError("{} not found".format(field))
+    return positions[0]
+
+
+def evaluate_filter(adata, compiled_filter):
+    """Evaluates a filter created with compile_filter.
+
+    :return: Boolean mask or None if the filter has no terms.
+    """
+    terms, combine_filters = compiled_filter
+    keep_expr = None
+    for field, operations, invert in terms:
+        if operations[0] == "points":
+            keep = _points_expr(adata.shape[0], operations[1])
+        elif operations[0] == "mask":
+            keep = decode_mask(operations[1], adata.shape[0])
+        elif field in adata.obs:
+            keep = _obs_expr(adata.obs[field], operations)
+        else:
+            keep = _X_expr(adata.X[:, get_var_position(adata.var.index, field)], operations)
+        if invert:
+            keep = ~keep
+        if keep_expr is not None:
+            if combine_filters == "and":
+                keep_expr = keep_expr & keep
             else:
-                keep_expr = keep
-
+                keep_expr = keep_expr | keep
+        else:
+            keep_expr = keep
     return keep_expr
 
 
+def get_filter_expr(adata, data_filter):
+    if data_filter is None:
+        return None
+    return evaluate_filter(adata, compile_filter(data_filter))
+
+
 def precomputed_summary(dataset_api, dataset, obs_measures, var_measures, dimensions):
     if "__count" in var_measures:
         var_measures.remove("__count")
@@ -264,6 +345,47 @@ def handle_data(
     stats=None,
     selection=None,
 ):
+    results = {}
+    for path, value in iter_data(
+        dataset_api,
+        dataset,
+        embedding_list=embedding_list,
+        values=values,
+        grouped_stats=grouped_stats,
+        stats=stats,
+        selection=selection,
+    ):
+        add_data_item(results, path, value)
+    return results
+
+
+def add_data_item(results, path, value):
+    """Sets value at path in results, creating containers as needed.
+
+    Integer keys append to a list.
+    """
+    container = results
+    for key, next_key in zip(path[:-1], path[1:]):
+        if key not in container:
+            container[key] = [] if isinstance(next_key, int) else {}
+        container = container[key]
+    if isinstance(container, list):
+        container.append(value)
+    else:
+        container[path[-1]] = value
+
+
+def iter_data(
+    dataset_api,
+    dataset,
+    embedding_list=None,
+    values=None,
+    grouped_stats=None,
+    stats=None,
+    selection=None,
+):
+    """Computes the results of handle_data, yielding (path, value) pairs as soon as each value is
+    computed."""
     dimensions = set()
     measures = set()
     basis_keys = set()
@@ -283,8 +405,6 @@ def handle_data(
         selection["basis"] = selected_points_filter_basis_list
         measures.update(var_keys_filter)
         dimensions.update(obs_keys_filter)
-        dimensions.update(selection.get("dimensions", []))
-        measures.update(selection.get("measures", []))
         selection_embeddings = selection.get("embeddings", [])
 
         for embedding in selected_points_filter_basis_list + selection_embeddings:
@@ -301,104 +421,120 @@ def handle_data(
     if stats is not None:
         dimensions.update(stats.get("dimensions", []))
         measures.update(stats.get("measures", []))
+    # read selection keys for selected cells only if they are not needed otherwise
+    read_selection = selection is not None and not (
+        set(selection.get("dimensions", [])).issubset(dimensions)
+        and set(selection.get("measures", [])).issubset(measures)
+    )
 
     keys = get_type_to_measures(measures)
     keys["obs"] += list(dimensions)
     keys["basis"] = list(basis_keys)
     adata = dataset_api.read_dataset(dataset=dataset, keys=keys)
-    results = {}
     if values is not None:
         dimensions = values.get("dimensions", [])
         measures = values.get("measures", [])
         # measure can be X or layers
         type2measures = get_type_to_measures(measures)
-        results["values"] = {}
+        yield ("values",), {}
         for key in type2measures["obs"] + dimensions:
             series = adata.obs[key]
-            results["values"][key] = series
             if isinstance(series.dtype, CategoricalDtype):
-                results["values"][key] = dict(
+                yield ("values", key), dict(
                     values=series.values.codes, categories=series.cat.categories.values
                 )
             else:
-                results["values"][key] = series
+                yield ("values", key), series
 
-        def array_to_json(d, var_index, result):
+        def array_to_json(d, var_index, path):
             is_sparse = scipy.sparse.issparse(d)
             for i in range(len(var_index)):
                 x = d[:, i]
                 if is_sparse:
                     indices = x.indices
                     data = x.data
-                    result[var_index[i]] = dict(indices=indices, values=data)
+                    yield path + (var_index[i],), dict(indices=indices, values=data)
                 else:
-                    result[var_index[i]] = x
+                    yield path + (var_index[i],), x
 
         if adata.uns.get(ADATA_MODULE_UNS_KEY) is not None:
             adata_modules = adata.uns[ADATA_MODULE_UNS_KEY]
-            array_to_json(adata_modules.X, adata_modules.var.index, results["values"])
+            yield from array_to_json(adata_modules.X, adata_modules.var.index, ("values",))
 
         if adata.X is not None:
-            array_to_json(adata.X, adata.var.index, results["values"])
+            yield from array_to_json(adata.X, adata.var.index, ("values",))
         if ADATA_LAYERS_UNS_KEY in adata.uns:
             for layer_name in adata.uns[ADATA_LAYERS_UNS_KEY].keys():
-                if "layers" not in results:
-                    results["layers"] = {}
-                results["layers"][layer_name] = {}
+                yield ("layers", layer_name), {}
                 adata_layer = adata.uns[ADATA_LAYERS_UNS_KEY][layer_name]
-                array_to_json(adata_layer.X, adata_layer.var.index, results["layers"][layer_name])
+                yield from array_to_json(
+                    adata_layer.X, adata_layer.var.index, ("layers", layer_name)
+                )
 
     if embedding_list is not None and len(embedding_list) > 0:
-        results["embeddings"] = []
-        for key in adata.obsm.keys():
+        yield ("embeddings",), []
+        for index, key in enumerate(adata.obsm.keys()):
             m = adata.obsm[key]
             ndim = m.shape[1]
             coordinates = dict()
-            embedding = dict(name=key, dimensions=ndim, coordinates=coordinates)
-            results["embeddings"].append(embedding)
             for i in range(ndim):
                 coordinates["{}_{}".format(key, i + 1)] = m[:, i]
+            yield ("embeddings", index), dict(name=key, dimensions=ndim, coordinates=coordinates)
 
     if grouped_stats is not None:
-        results["distribution"] = DotPlotAggregator(
-            var_measures=grouped_stats.get("measures", []),
+        yield ("distribution",), DotPlotAggregator(
+            var_measures=get_type_to_measures(grouped_stats.get("measures", []))["X"],
             dimensions=grouped_stats.get("dimensions", []),
         ).execute(adata)
     if stats is not None:
         dimensions = stats.get("dimensions", [])
         measures = stats.get("measures", [])
         type2measures = get_type_to_measures(measures)
-        results["summary"] = FeatureAggregator(
+        yield ("summary",), FeatureAggregator(
             type2measures["obs"], type2measures["X"], dimensions
         ).execute(adata)
     if selection is not None:
-        results["selection"] = {}
+        yield ("selection",), {}
         dimensions = selection.get("dimensions", [])
         measures = selection.get("measures", [])
         type2measures = get_type_to_measures(measures)
         # basis_list = selection.get('basis', [])
         selection_embeddings = selection.get("embeddings", [])
-        df = apply_filter(adata, data_filter)
+        keep = get_cached_filter_expr(dataset_api, dataset, adata, data_filter)
+        if read_selection:
+            selection_keys = get_type_to_measures(measures)
+            selection_keys["obs"] += dimensions
+            df = dataset_api.read_dataset(
+                dataset=dataset,
+                keys=selection_keys,
+                obs_indices=np.where(keep)[0] if keep is not None else None,
+            )
+        else:
+            df = adata[keep] if keep is not None else adata
         if len(selection_embeddings) > 0:
-            results["selection"]["coordinates"] = {}
+            yield ("selection", "coordinates"), {}
             for embedding in selection_embeddings:
-                results["selection"]["coordinates"][embedding["name"]] = UniqueAggregator(
+                yield ("selection", "coordinates", embedding["name"]), UniqueAggregator(
                     "index"
                 ).execute(df)
         var_measures = type2measures["X"]
-        results["selection"]["summary"] = FeatureAggregator(
+        yield ("selection", "summary"), FeatureAggregator(
             type2measures["obs"], type2measures["X"], dimensions
         ).execute(df)
         if len(dimensions) > 0 and len(var_measures) > 0:
-            results["selection"]["distribution"] = DotPlotAggregator(
+            yield ("selection", "distribution"), DotPlotAggregator(
                 var_measures=var_measures, dimensions=[dimensions]
             ).execute(df)
-        results["selection"]["count"] = df.shape[0]
-
-    return results
+        yield ("selection", "count"), df.shape[0]
 
 
-def handle_selection_ids(dataset_api, dataset, data_filter):
+def handle_selection_ids(dataset_api, dataset, data_filter, encode=False):
+    if encode:  # selected cells as an encoded mask instead of ids
+        masks, _ = get_mask(dataset_api, dataset, None, [data_filter])
+        mask = masks[0]
+        if mask is None:
+            mask = np.ones(dataset_api.get_dataset_info(dataset)["shape"][0], dtype=bool)
+        return {"selection": encode_mask(mask)}
     df = get_selected_data(dataset_api, dataset, measures=["obs/index"], data_filter=data_filter)
     return {"ids": IdsAggregator().execute(df)}
 
@@ -411,6 +547,7 @@ def get_adata(
     dimensions=[],
     data_filters=[],
     dataset_info=None,
+    obs_indices=None,
 ):
     type2measures = get_type_to_measures(measures)
     var_keys_filter = []
@@ -434,7 +571,9 @@ def get_adata(
         basis_keys.add(embedding["name"])
 
     adata = dataset_api.read_dataset(
-        dataset=dataset, keys=dict(obs=obs_keys, X=var_keys, basis=list(basis_keys))
+        dataset=dataset,
+        keys=dict(obs=obs_keys, X=var_keys, basis=list(basis_keys)),
+        obs_indices=obs_indices,
     )
     # for basis_obj in basis_objs:
     #     if not basis_obj['precomputed'] and basis_obj['nbins'] is not None:
@@ -454,17 +593,21 @@ def get_selected_data(
     data_filter=None,
     dataset_info=None,
 ):
-    df = get_adata(
+    obs_indices = None
+    if data_filter is not None:
+        # read filter keys first so that requested keys are read for selected cells only
+        masks, _ = get_mask(dataset_api, dataset, dataset_info, [data_filter])
+        if masks[0] is not None:
+            obs_indices = np.where(masks[0])[0]
+    return get_adata(
         dataset_api,
         dataset,
         embeddings,
         measures,
         dimensions,
-        [data_filter] if data_filter is not None else [],
         dataset_info=dataset_info,
+        obs_indices=obs_indices,
     )
-    df = apply_filter(df, data_filter)
-    return df
 
 
 def data_filter_keys(data_filter, dataset_info=None):
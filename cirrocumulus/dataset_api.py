@@ -1,6 +1,19 @@
 import os
+import copy
+import logging
 
-from cirrocumulus.util import get_fs
+from cirrocumulus.lru_cache import LRUCache
+from cirrocumulus.response_cache import ResponseCache
+from cirrocumulus.util import (
+    get_dataset_cache_size,
+    get_dataset_info_size,
+    get_fs,
+    get_version,
+    to_json,
+)
+
+
+logger = logging.getLogger("cirro")
 
 
 def get_path(dataset, dataset_path):
@@ -17,8 +30,16 @@ class DatasetAPI:
     def __init__(self):
         self.suffix_to_provider = {}
         self.default_provider = None
-        self.cached_dataset_info = None
-        self.cached_dataset_id = None
+        # (url, version) -> dataset info
+        self.dataset_info_cache = LRUCache(
+            max_size=get_dataset_cache_size(), get_size=get_dataset_info_size
+        )
+        # (url, version) -> (schema, result id -> JSON result, size)
+        self.schema_cache = LRUCache(
+            max_size=get_dataset_cache_size(), get_size=lambda entry: entry[2]
+        )
+        # digest of (url, version, filter) -> boolean mask of cells that pass the filter
+        self.mask_cache = LRUCache(max_size=get_dataset_cache_size(), get_size=lambda x: x.nbytes)
 
     def get_dataset_provider(self, path):
         index = path.rfind(".")
@@ -37,33 +58,95 @@ class DatasetAPI:
             self.suffix_to_provider[suffix.lower()] = provider
 
     def get_dataset_info(self, dataset):
-        dataset_id = dataset["id"]
-        if self.cached_dataset_id == dataset_id:
-            dataset_info = self.cached_dataset_info
-        else:
-            path = dataset["url"]
+        path = dataset["url"]
+        filesystem = get_fs(path)
+        version = get_version(filesystem, path)
+        key = (path, version) if version is not None else None
+        dataset_info = self.dataset_info_cache.get(key)
+        if dataset_info is None:
             provider = self.get_dataset_provider(path)
-            dataset_info = provider.get_dataset_info(get_fs(path), path)
-            self.cached_dataset_info = dataset_info
-            self.cached_dataset_id = dataset_id
+            dataset_info = provider.get_dataset_info(filesystem, path)
+            self.dataset_info_cache.put(key, dataset_info)
+            logger.debug("Dataset cache {}".format(self.cache_stats()))
         return dataset_info
 
-    def get_schema(self, dataset):
+    def cache_stats(self):
+        """Returns hit, miss, and eviction counts for dataset caches."""
+        stats = dict(
+            dataset_info=self.dataset_info_cache.stats(),
+            schema=self.schema_cache.stats(),
+            mask=self.mask_cache.stats(),
+        )
+        for provider in set(self.suffix_to_provider.values()):
+            handle_cache = getattr(provider, "handle_cache", None)
+            if handle_cache is not None:
+                stats[type(provider).__name__] = handle_cache.stats()
+        return stats
+
+    def get_version(self, dataset):
+        """Returns a token that changes when the dataset is rewritten or None."""
         path = dataset["url"]
-        provider = self.get_dataset_provider(path)
-        schema_dict = provider.get_schema(get_fs(path), path)
+        return get_version(get_fs(path), path)
+
+    def get_mask_cache_key(self, dataset, data_filter):
+        """Returns the mask cache key of data_filter or None if the dataset version is unknown.
+
+        Filters on selected points contain one index per cell, so the filter is hashed to keep
+        keys small compared to the cached masks.
+        """
+        version = self.get_version(dataset)
+        if version is None:
+            return None
+        return ResponseCache.get_key(dataset["url"], version, data_filter)
+
+    def get_schema_entry(self, dataset):
+        """Returns the cached schema and results that were moved out of the schema."""
+        path = dataset["url"]
+        version = self.get_version(dataset)
+        key = (path, version) if version is not None else None
+        entry = self.schema_cache.get(key)
+        if entry is None:
+            provider = self.get_dataset_provider(path)
+            schema_dict = provider.get_schema(get_fs(path), path)
+            results = schema_dict.get("results", [])
+            result_id_to_json = {}
+            for i in range(len(results)):
+                if "data" in results[i] and "id" in results[i]:
+                    full_result = results[i].copy()
+                    result_id = full_result.pop("id")
+                    # keep id, name, type in schema, fetch rest using get_result
+                    results[i] = dict(
+                        id=result_id,
+                        name=full_result.pop("name", None),
+                        type=full_result.pop("type", None),
+                        content_type="application/json",
+                    )
+                    result_id_to_json[result_id] = to_json(full_result)
+            size = len(to_json(schema_dict)) + sum(map(len, result_id_to_json.values()))
+            entry = (schema_dict, result_id_to_json, size)
+            self.schema_cache.put(key, entry)
+        return entry
+
+    def get_schema(self, dataset):
+        # callers modify nested values of the returned schema
+        schema_dict = copy.deepcopy(self.get_schema_entry(dataset)[0])
         if "summary" in dataset:
             schema_dict["summary"] = dataset["summary"]
         if "markers" in schema_dict:
             schema_dict["markers_read_only"] = schema_dict.pop("markers")
         return schema_dict
 
-    def read_dataset(self, dataset, keys=[]):
+    def read_dataset(self, dataset, keys=[], obs_indices=None):
         path = dataset["url"]
         provider = self.get_dataset_provider(path)
-        return provider.read_dataset(get_fs(path), path, keys=keys, dataset=dataset)
+        return provider.read_dataset(
+            get_fs(path), path, keys=keys, dataset=dataset, obs_indices=obs_indices
+        )
 
     def get_result(self, dataset, result_id):
+        result_id_to_json = self.get_schema_entry(dataset)[1]
+        if result_id in result_id_to_json:
+            return result_id_to_json[result_id]
         path = dataset["url"]
         provider = self.get_dataset_provider(path)
         return provider.get_result(get_fs(path), path, dataset=dataset, result_id=result_id)
@@ -1,61 +1,59 @@
+import numpy as np
+import scipy.sparse
 from pandas import CategoricalDtype
 
+from cirrocumulus.anndata_util import combine_codes, combined_code_names
+
 
 class DotPlotAggregator:
     def __init__(self, var_measures, dimensions):
         self.var_measures = var_measures
         self.dimensions = dimensions
 
-    def execute(self, df):
+    def execute(self, adata):
         results = []
         # {categories:[], name:'', values:[{name:'', percentExpressed:0, mean:0}]}
         var_measures = self.var_measures
         dimensions = self.dimensions
         if len(var_measures) == 0 or len(dimensions) == 0:
             return results
-
-        def mean(x):
-            return x.mean()
-
-        def percent_expressed(x):
-            return 100 * ((x.values != 0).sum() / len(x))
-
+        X = adata[:, var_measures].X
+        X_expressed = X != 0
         for d in dimensions:
-            dimension_name = d
-            if isinstance(d, list):
-                if len(d) > 1:
-                    dimension_name = "-".join(d)
-                    df[dimension_name] = (
-                        df[d[0]]
-                        .astype(str)
-                        .str.cat(df[d[1:]].astype(str), sep="-")
-                        .astype("category")
-                    )
-                else:
-                    dimension_name = d[0]
+            fields = d if isinstance(d, list) else [d]
+            dimension_name = "-".join(fields)
             if (
-                isinstance(df[dimension_name].dtype, CategoricalDtype)
-                and len(df[dimension_name].dtype.categories) <= 1
+                len(fields) == 1
+                and isinstance(adata.obs[dimension_name].dtype, CategoricalDtype)
+                and len(adata.obs[dimension_name].dtype.categories) <= 1
             ):
                 continue
-            agg_result = df.groupby(dimension_name, observed=True).agg([mean, percent_expressed])
-
+            group_codes, observed_field_codes, field_values = combine_codes(adata.obs, fields)
+            categories = combined_code_names(field_values, observed_field_codes, "-")
+            keep = group_codes >= 0
+            counts = np.bincount(group_codes[keep], minlength=len(categories))
+            # indicator matrix (groups, observations), rows scaled to compute mean per group
+            A = scipy.sparse.csr_matrix(
+                (1.0 / counts[group_codes[keep]], (group_codes[keep], np.where(keep)[0])),
+                shape=(len(categories), adata.shape[0]),
+            )
+            mean = A @ X
+            fraction_expressed = A @ X_expressed
+            if scipy.sparse.issparse(mean):
+                mean = mean.toarray()
+                fraction_expressed = fraction_expressed.toarray()
             values = []
             dotplot_result = {
-                "categories": agg_result.index,
+                "categories": categories,
                 "name": dimension_name,
                 "values": values,
             }
-            for var_measure in var_measures:
-                series = agg_result[var_measure]
-                is_sparse = hasattr(series, "sparse")
-                if is_sparse:
-                    series = series.sparse.to_dense()
+            for j in range(len(var_measures)):
                 values.append(
                     {
-                        "name": var_measure,
-                        "percentExpressed": series["percent_expressed"],
-                        "mean": series["mean"],
+                        "name": var_measures[j],
+                        "percentExpressed": 100 * fraction_expressed[:, j],
+                        "mean": mean[:, j],
                     }
                 )
             results.append(dotplot_result)
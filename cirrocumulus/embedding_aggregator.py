@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 from pandas import CategoricalDtype
 
 
@@ -24,6 +25,131 @@ def mode_agg(x):
     return x.mode()[0]
 
 
+def _is_dense_numeric(series):
+    return not hasattr(series, "sparse") and series.dtype.kind in "iuf"
+
+
+def _is_sparse_numeric(series):
+    return hasattr(series, "sparse") and series.sparse.sp_values.dtype.kind in "iuf"
+
+
+def _can_vectorize(series, agg):
+    if agg in ("min", "max", "mean", "sum"):
+        return _is_dense_numeric(series)
+    if agg in (sparse_max_agg, sparse_sum_agg):
+        return _is_sparse_numeric(series)
+    if agg == mean_agg:
+        return _is_dense_numeric(series) or _is_sparse_numeric(series)
+    return agg in (mode_agg, purity_agg)
+
+
+def _dense_agg(values, agg, codes, order, starts, counts):
+    if agg == "min" or agg == "max":
+        if values.dtype.kind == "f":
+            ufunc = np.fmin if agg == "min" else np.fmax  # skip NaN
+        else:
+            ufunc = np.minimum if agg == "min" else np.maximum
+        return ufunc.reduceat(values[order], starts)
+    is_float = values.dtype.kind == "f"
+    valid = ~np.isnan(values) if is_float else slice(None)
+    sums = np.bincount(codes[valid], weights=values[valid], minlength=len(counts))
+    if agg == "sum":
+        return sums.astype(values.dtype)
+    n = np.bincount(codes[valid], minlength=len(counts)) if is_float else counts
+    with np.errstate(invalid="ignore"):
+        means = sums / n
+    return means.astype(values.dtype) if is_float else means
+
+
+def _sparse_agg(series, agg, codes, counts):
+    array = series.array
+    sp_values = array.sp_values
+    fill_value = array.fill_value
+    point_codes = codes[array.sp_index.indices]
+    npoints = np.bincount(point_codes, minlength=len(counts))
+    if agg == sparse_max_agg:
+        result = np.full(len(counts), fill_value, dtype=sp_values.dtype)
+        has_points = npoints > 0
+        point_order = np.argsort(point_codes, kind="stable")
+        point_starts = (np.cumsum(npoints) - npoints)[has_points]
+        if len(point_starts) > 0:
+            result[has_points] = np.maximum.reduceat(sp_values[point_order], point_starts)
+    else:
+        valid = ~np.isnan(sp_values) if sp_values.dtype.kind == "f" else slice(None)
+        sums = np.bincount(point_codes[valid], weights=sp_values[valid], minlength=len(counts))
+        n = np.bincount(point_codes[valid], minlength=len(counts))
+        if not pd.isna(fill_value):
+            gaps = counts - npoints
+            sums += fill_value * gaps
+            n += gaps
+        if agg == sparse_sum_agg:
+            result = np.where(npoints == 0, fill_value, sums)
+        else:
+            with np.errstate(invalid="ignore"):
+                result = sums / n
+        result = result.astype(sp_values.dtype)
+    return pd.arrays.SparseArray(result, fill_value=fill_value)
+
+
+def _mode_agg(series, agg, codes, counts):
+    """Computes the most frequent value, ties broken by smallest value, or its frequency."""
+    if isinstance(series.dtype, CategoricalDtype):
+        value_codes = series.cat.codes.values
+        values = None
+    else:
+        value_codes, values = pd.factorize(series.values, sort=True)
+    valid = value_codes >= 0
+    ncodes = max(1, value_codes.max() + 1) if len(value_codes) > 0 else 1
+    pairs, pair_counts = np.unique(
+        codes[valid].astype(np.int64) * ncodes + value_codes[valid], return_counts=True
+    )
+    pair_bins = pairs // ncodes
+    pair_codes = pairs % ncodes
+    # sort by bin, then by decreasing count, then by value and take the first pair per bin
+    order = np.lexsort((pair_codes, -pair_counts, pair_bins))
+    first = order[np.concatenate(([True], pair_bins[order][1:] != pair_bins[order][:-1]))]
+    if agg == purity_agg:
+        largest = np.zeros(len(counts))
+        largest[pair_bins[first]] = pair_counts[first]
+        with np.errstate(invalid="ignore"):
+            return largest / np.bincount(codes[valid], minlength=len(counts))
+    mode_codes = np.full(len(counts), -1, dtype=np.int64)
+    mode_codes[pair_bins[first]] = pair_codes[first]
+    if values is None:
+        return pd.Categorical.from_codes(mode_codes, dtype=series.dtype)
+    return pd.api.extensions.take(values, mode_codes, allow_fill=True)
+
+
+def groupby_agg(df, by, agg_dict):
+    """Equivalent of df.groupby(by).agg(agg_dict) that is vectorized for the aggregations used
+    to bin embeddings, falling back to pandas for other aggregations."""
+    for column, aggs in agg_dict.items():
+        for agg in aggs if isinstance(aggs, tuple) else (aggs,):
+            if not _can_vectorize(df[column], agg):
+                return df.groupby(by).agg(agg_dict)
+    bins, codes = np.unique(df[by].values, return_inverse=True)
+    codes = codes.ravel()
+    counts = np.bincount(codes, minlength=len(bins))
+    order = np.argsort(codes, kind="stable")
+    starts = np.cumsum(counts) - counts
+    multi_index = any(isinstance(aggs, tuple) for aggs in agg_dict.values())
+    columns = {}
+    for column, aggs in agg_dict.items():
+        series = df[column]
+        for agg in aggs if isinstance(aggs, tuple) else (aggs,):
+            if agg in (mode_agg, purity_agg):
+                values = _mode_agg(series, agg, codes, counts)
+            elif hasattr(series, "sparse"):
+                values = _sparse_agg(series, agg, codes, counts)
+            else:
+                values = _dense_agg(
+                    series.values, "mean" if agg == mean_agg else agg, codes, order, starts, counts
+                )
+            name = agg if isinstance(agg, str) else agg.__name__
+            columns[(column, name) if multi_index else column] = values
+    return pd.DataFrame(columns, index=pd.Index(bins, name=by))
+
+
 class EmbeddingAggregator:
     def __init__(
         self, measures, dimensions, nbins, basis, agg_function="max", quick=True, coords=True
@@ -106,7 +232,7 @@ class EmbeddingAggregator:
             if add_count:
                 agg_dict["__count"] = "sum"
 
-            agg_df = df.groupby(full_basis_name).agg(agg_dict)
+            agg_df = groupby_agg(df, full_basis_name, agg_dict)
 
             if add_count:
                 series = agg_df["__count"]
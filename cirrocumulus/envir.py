@@ -23,6 +23,18 @@ CIRRO_MIXPANEL = "CIRRO_MIXPANEL"
 # for mounting a bucket locally. Comma separated string of bucket:local_path. Example s3://foo/bar:/fsx
 CIRRO_MOUNT = "CIRRO_MOUNT"
 CIRRO_LOG_LEVEL = "CIRRO_LOG_LEVEL"
+# maximum size in megabytes of opened dataset handles, dataset info, and filter masks cached per process
+CIRRO_DATASET_CACHE_SIZE = "CIRRO_DATASET_CACHE_SIZE"
+# maximum size in megabytes of serialized /data, /schema, and precomputed result responses cached per process
+CIRRO_RESPONSE_CACHE_SIZE = "CIRRO_RESPONSE_CACHE_SIZE"
+# optional directory to store serialized responses in, shared by server processes
+CIRRO_RESPONSE_CACHE_DIR = "CIRRO_RESPONSE_CACHE_DIR"
+# size in megabytes of chunks read when sending files that are not on the local filesystem
+CIRRO_FILE_CHUNK_SIZE = "CIRRO_FILE_CHUNK_SIZE"
+# maximum number of concurrent reads of arrays in a zarr or h5ad dataset per process
+CIRRO_DATASET_READ_CONCURRENCY = "CIRRO_DATASET_READ_CONCURRENCY"
+# maximum number of elements between ranges of a sparse matrix that are fetched in a single read
+CIRRO_SPARSE_READ_GAP = "CIRRO_SPARSE_READ_GAP"
 # columns to display to user
 CIRRO_DATASET_SELECTOR_COLUMNS = "CIRRO_DATASET_SELECTOR_COLUMNS"
 CIRRO_JOB_TYPE = "CIRRO_JOB_TYPE"
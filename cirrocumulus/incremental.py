@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from pandas import CategoricalDtype
+
+
+logger = logging.getLogger("cirro")
+
+# file in the output directory that stores the content hash of each component
+HASHES_FILE = "cirro-hashes.json"
+# components that require a full rewrite when changed
+GLOBAL_COMPONENTS = ["options", "obs_names", "var_names"]
+
+
+def update_hash_array(h, a):
+    a = np.asarray(a)
+    if not a.flags.c_contiguous:
+        # hash column-major arrays such as memory-mapped dense matrices without a copy
+        a = a.T if a.flags.f_contiguous else np.ascontiguousarray(a)
+    h.update(str((a.dtype.str, a.shape)).encode())
+    h.update(memoryview(a).cast("B"))
+
+
+def hash_matrix(X):
+    h = hashlib.sha1()
+    if scipy.sparse.issparse(X):
+        h.update(X.format.encode())
+        h.update(str(X.shape).encode())
+        for a in [X.data, X.indices, X.indptr]:
+            update_hash_array(h, a)
+    else:
+        update_hash_array(h, X)
+    return h.hexdigest()
+
+
+def hash_values(values):
+    """Returns the hash of a series or index including its dtype and category order."""
+    values = pd.Series(values)
+    h = hashlib.sha1()
+    h.update(str(values.dtype).encode())
+    if isinstance(values.dtype, CategoricalDtype):
+        update_hash_array(h, pd.util.hash_pandas_object(values.cat.categories, index=False).values)
+        update_hash_array(h, values.cat.codes.values)
+    else:
+        update_hash_array(h, pd.util.hash_pandas_object(values, index=False).values)
+    return h.hexdigest()
+
+
+def hash_options(options):
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def get_component_hashes(dataset, options):
+    """Returns a dict that maps each component of a dataset that is written separately to a
+    content hash.
+
+    :param dataset: Prepared AnnData
+    :param options: JSON serializable dict of options that change how components are written
+    """
+    hashes = dict(
+        options=hash_options(options),
+        obs_names=hash_values(dataset.obs.index),
+        var_names=hash_values(dataset.var.index),
+    )
+    hashes["X"] = hash_matrix(dataset.X)
+    for key in dataset.layers.keys():
+        hashes["layers/" + key] = hash_matrix(dataset.layers[key])
+    for key in dataset.obs.columns:
+        hashes["obs/" + key] = hash_values(dataset.obs[key])
+    for key in dataset.obsm.keys():
+        hashes["obsm/" + key] = hash_matrix(np.asarray(dataset.obsm[key]))
+    return hashes
+
+
+def read_component_hashes(filesystem, output_directory):
+    """Returns the component hashes stored in output_directory or None."""
+    path = os.path.join(output_directory, HASHES_FILE)
+    if not filesystem.exists(path):
+        return None
+    with filesystem.open(path, "rt") as f:
+        return json.load(f)
+
+
+def write_component_hashes(filesystem, output_directory, hashes):
+    with filesystem.open(os.path.join(output_directory, HASHES_FILE), "wt") as f:
+        json.dump(hashes, f)
+
+
+def remove_component_hashes(filesystem, output_directory):
+    """Removes stored hashes before an output is modified so that an interrupted write is not
+    mistaken for an up to date output."""
+    path = os.path.join(output_directory, HASHES_FILE)
+    if filesystem.exists(path):
+        filesystem.rm(path)
+
+
+def get_changed_keys(old_hashes, new_hashes, prefix):
+    """Returns names of components under prefix that were added or changed and whether any were
+    removed."""
+    old_keys = set(key for key in old_hashes.keys() if key.startswith(prefix))
+    new_keys = [key for key in new_hashes.keys() if key.startswith(prefix)]
+    changed = [key[len(prefix) :] for key in new_keys if old_hashes.get(key) != new_hashes[key]]
+    return changed, len(old_keys - set(new_keys)) > 0
+
+
+def get_incremental_whitelist(old_hashes, new_hashes):
+    """Returns a save whitelist with the components that differ between old and new hashes or None
+    if the output needs to be fully rewritten."""
+    if old_hashes is None:
+        logger.info("No component hashes found, writing all components")
+        return None
+    for key in GLOBAL_COMPONENTS:
+        if old_hashes.get(key) != new_hashes[key]:
+            logger.info("{} changed, writing all components".format(key))
+            return None
+    changed_layers, removed_layers = get_changed_keys(old_hashes, new_hashes, "layers/")
+    matrix_keys = ["layers/" + key for key in changed_layers]
+    if old_hashes.get("X") != new_hashes["X"]:
+        matrix_keys.insert(0, "X")
+    obs_keys, removed_obs = get_changed_keys(old_hashes, new_hashes, "obs/")
+    obsm_keys, removed_obsm = get_changed_keys(old_hashes, new_hashes, "obsm/")
+    logger.info(
+        "Writing changed components: {}".format(
+            ", ".join(
+                matrix_keys
+                + ["obs/" + key for key in obs_keys]
+                + ["obsm/" + key for key in obsm_keys]
+            )
+            or "none"
+        )
+    )
+    return {
+        "x": len(matrix_keys) > 0 or removed_layers,
+        "obs": len(obs_keys) > 0 or removed_obs,
+        "obsm": len(obsm_keys) > 0 or removed_obsm,
+        "x_keys": None,
+        "obs_keys": obs_keys,
+        "obsm_keys": obsm_keys,
+        "matrix_keys": matrix_keys,
+    }
@@ -4,6 +4,7 @@ import logging
 
 import pandas as pd
 
+from cirrocumulus.anndata_util import combine_fields
 from cirrocumulus.diff_exp import DE
 from cirrocumulus.ot.transport_map_model import read_transport_map_dir
 from cirrocumulus.util import dumps
@@ -126,10 +127,7 @@ def get_obs(dataset_api, dataset, dataset_info, params):
         if len(obs_fields) > 1:
             # combine in to one field
             obs_field = "_".join(obs_fields)
-            obs[obs_field] = obs[obs_fields[0]].astype(str)
-            for i in range(1, len(obs_fields)):
-                obs[obs_field] += "_" + obs[obs_fields[i]].astype(str)
-            obs[obs_field] = obs[obs_field].astype("category")
+            obs[obs_field] = combine_fields(obs, obs_fields, "_")
         return obs, obs_field
     else:
         filters = [params["filter"], params["filter2"]]
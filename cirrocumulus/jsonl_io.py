@@ -2,13 +2,15 @@ import os
 import gzip
 import json
 import logging
+import concurrent.futures
 
 import numpy as np
 import pandas as pd
 import scipy.sparse
 from pandas import CategoricalDtype
 
-from cirrocumulus.util import dumps
+from cirrocumulus.anndata_util import get_feature_values
+from cirrocumulus.util import WriteProgress, dumps
 
 
 logger = logging.getLogger("cirro")
@@ -16,12 +18,20 @@ logger = logging.getLogger("cirro")
 LINE_END = "\n".encode("UTF-8")
 
 
-def write_jsonl(d, f, name, index, compress=False):
+def encode_jsonl(d, name, compress=False):
     output = {}
     output[name] = d
     c = dumps(output, double_precision=2, orient="values").encode("UTF-8")
     if compress:
         c = gzip.compress(c)
+    return c
+
+
+def write_jsonl(d, f, name, index, compress=False):
+    write_encoded_jsonl(encode_jsonl(d, name, compress), f, name, index)
+
+
+def write_encoded_jsonl(c, f, name, index):
     start = f.tell()
     end = start + len(c)
     index[name] = [start, end - 1]
@@ -62,17 +72,17 @@ def read_adata_jsonl(path, keys):
     return df
 
 
-def save_dataset_jsonl(dataset, schema, output_dir, base_name, filesystem):
+def save_dataset_jsonl(dataset, schema, output_dir, base_name, filesystem, workers=1):
     compress = False
     index = {}  # key to byte start-end
     filesystem.makedirs(output_dir, exist_ok=True)
     jsonl_path = os.path.join(output_dir, base_name)
     with filesystem.open(jsonl_path, "wb") as f:
-        save_adata_X(dataset, f, index, compress)
+        save_adata_X(dataset, f, index, compress, workers=workers)
         save_data_obs(dataset, f, index, compress)
         save_data_obsm(dataset, f, index, compress)
         for layer in dataset.layers.keys():
-            save_adata_X(dataset, f, index, compress, layer)
+            save_adata_X(dataset, f, index, compress, layer, workers=workers)
         write_jsonl(schema, f, "schema", index)
 
     with filesystem.open(
@@ -83,32 +93,29 @@ def save_dataset_jsonl(dataset, schema, output_dir, base_name, filesystem):
         f.write(dumps(result, double_precision=2, orient="values"))
 
 
-def save_adata_X(adata, f, index, compress, layer=None):
+def save_adata_X(adata, f, index, compress, layer=None, workers=1):
     adata_X = adata.X if layer is None else adata.layers[layer]
     names = adata.var.index
-    is_sparse = scipy.sparse.issparse(adata_X)
-    if is_sparse and scipy.sparse.isspmatrix_csr(adata_X):
+    if scipy.sparse.issparse(adata_X) and not scipy.sparse.isspmatrix_csc(adata_X):
         adata_X = adata_X.tocsc()
 
-    for j in range(adata_X.shape[1]):
-        X = adata_X[:, j]
+    def encode_feature(j):
         name = names[j]
         if layer:
             name = layer + "/" + name
-
-        if is_sparse:
-            X = X.toarray().flatten()
-            indices = np.where(X != 0)[0]
-            values = X[indices]
-            write_jsonl(dict(index=indices, value=values), f, name, index, compress)
-        else:
-            write_jsonl(dict(value=X), f, name, index, compress)
-        if j > 0 and (j + 1) % 1000 == 0:
-            logger.info(
-                "Wrote adata {} {}/{}".format(
-                    "X" if layer is None else layer, j + 1, adata_X.shape[1]
-                )
-            )
+        indices, values = get_feature_values(adata_X, j)
+        d = dict(value=values) if indices is None else dict(index=indices, value=values)
+        return name, encode_jsonl(d, name, compress), len(values)
+
+    progress = WriteProgress("X" if layer is None else layer, adata_X.shape[1])
+    # features are encoded concurrently in batches and written in order
+    batch_size = workers * 64
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, adata_X.shape[1], batch_size):
+            end = min(adata_X.shape[1], start + batch_size)
+            for name, c, nvalues in executor.map(encode_feature, range(start, end)):
+                write_encoded_jsonl(c, f, name, index)
+                progress.update(nvalues)
 
 
 def save_data_obsm(adata, f, index, compress):
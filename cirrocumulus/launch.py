@@ -4,6 +4,7 @@ import argparse
 import anndata
 
 import cirrocumulus
+from cirrocumulus.abstract_db import to_bool
 from cirrocumulus.anndata_dataset import AnndataDataset
 from cirrocumulus.envir import (
     CIRRO_AUTH,
@@ -95,7 +96,7 @@ def create_app():
             os.path.abspath(os.path.join(app.root_path, "client")), "index.html"
         )
 
-    if bool(os.environ.get(CIRRO_COMPRESS, "true")):
+    if to_bool(os.environ.get(CIRRO_COMPRESS, "true")):
         Compress(app)
     return app
 
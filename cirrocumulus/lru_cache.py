@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe least recently used cache bounded by the total size of its entries.
+
+    Values are never cached for a key of None, e.g. when the version of a dataset is unknown.
+
+    :param max_size: Maximum total size of cached entries
+    :param get_size: Function that returns the size of a value. Defaults to counting entries.
+    """
+
+    def __init__(self, max_size, get_size=None):
+        self.max_size = max_size
+        self.get_size = get_size if get_size is not None else lambda value: 1
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        if key is None:
+            return default
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        if key is None:
+            return
+        size = self.get_size(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:  # too large to cache
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._remove(key)
+            return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self._entries),
+            size=self.size,
+            max_size=self.max_size,
+        )
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        return entry
@@ -0,0 +1,37 @@
+import base64
+
+import numpy as np
+
+
+def encode_mask(mask):
+    """Encodes a boolean mask of selected cells as base64 using the smaller of two encodings.
+
+    rle: little endian uint32 lengths of alternating runs of unselected and selected cells,
+    starting with unselected cells.
+    bitmap: one bit per cell, least significant bit first.
+
+    :return: Dict with key rle or bitmap and the base64 encoded value
+    """
+    mask = np.asarray(mask, dtype=bool)
+    changes = np.flatnonzero(np.diff(mask.view(np.int8))) + 1
+    if len(mask) > 0 and mask[0]:
+        changes = np.concatenate(([0], changes))
+    if 4 * (len(changes) + 1) < (len(mask) + 7) // 8:
+        runs = np.diff(np.concatenate(([0], changes, [len(mask)])))
+        return dict(rle=base64.b64encode(runs.astype("<u4").tobytes()).decode())
+    return dict(bitmap=base64.b64encode(np.packbits(mask, bitorder="little").tobytes()).decode())
+
+
+def decode_mask(value, n):
+    """Decodes a value created by encode_mask into a boolean mask of length n."""
+    if "rle" in value:
+        runs = np.frombuffer(base64.b64decode(value["rle"]), dtype="<u4")
+        mask = np.repeat(np.arange(len(runs)) % 2 == 1, runs)
+    elif "bitmap" in value:
+        bits = np.frombuffer(base64.b64decode(value["bitmap"]), dtype=np.uint8)
+        mask = np.unpackbits(bits, bitorder="little").astype(bool)
+    else:
+        raise ValueError("Unknown mask encoding")
+    if len(mask) < n:  # trailing unselected cells can be omitted
+        mask = np.concatenate((mask, np.zeros(n - len(mask), dtype=bool)))
+    return mask[:n]
@@ -0,0 +1,159 @@
+import os
+import logging
+
+import h5py
+import numpy as np
+import scipy.sparse
+from anndata import AnnData
+from anndata.experimental import read_elem
+
+
+logger = logging.getLogger("cirro")
+
+# maximum number of values read from the source file at once
+max_block_size = 1 << 20
+
+
+def create_memmap(directory, name, dtype, shape, order="C"):
+    # zero sized memory maps are not supported
+    size_shape = tuple(max(1, d) for d in shape)
+    m = np.memmap(
+        os.path.join(directory, name), dtype=dtype, mode="w+", shape=size_shape, order=order
+    )
+    return m[tuple(slice(0, d) for d in shape)]
+
+
+def get_row_blocks(indptr, block_size):
+    """Returns (start, end) rows such that each block contains at most block_size values or a
+    single row."""
+    blocks = []
+    start = 0
+    n_rows = len(indptr) - 1
+    while start < n_rows:
+        end = np.searchsorted(indptr, indptr[start] + block_size, side="right") - 1
+        end = min(n_rows, max(end, start + 1))
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+
+def get_sparse_format(group):
+    encoding = group.attrs.get("encoding-type", group.attrs.get("h5sparse_format"))
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+    return encoding.replace("_matrix", "")
+
+
+def get_index_dtype(*sizes):
+    return np.int32 if max(sizes) <= np.iinfo(np.int32).max else np.int64
+
+
+def transpose_csr(group, directory, name, block_size):
+    """Converts a CSR matrix stored in an h5 group to a CSC matrix stored in memory-mapped files.
+
+    The first pass counts the values in each column and the second pass scatters each block of
+    rows to its position in the memory-mapped arrays so that only one block is in memory.
+    """
+    shape = tuple(group.attrs["shape"] if "shape" in group.attrs else group.attrs["h5sparse_shape"])
+    indptr = group["indptr"][...]
+    source_data = group["data"]
+    source_indices = group["indices"]
+    nnz = int(indptr[-1])
+    blocks = get_row_blocks(indptr, block_size)
+    counts = np.zeros(shape[1], dtype=np.int64)
+    for start, end in blocks:
+        counts += np.bincount(
+            source_indices[indptr[start] : indptr[end]], minlength=shape[1]
+        ).astype(np.int64)
+    index_dtype = get_index_dtype(nnz, shape[0])
+    csc_indptr = np.zeros(shape[1] + 1, dtype=index_dtype)
+    np.cumsum(counts, out=csc_indptr[1:])
+    data = create_memmap(directory, name + ".data", source_data.dtype, (nnz,))
+    indices = create_memmap(directory, name + ".indices", index_dtype, (nnz,))
+    next_position = csc_indptr[:-1].astype(np.int64)
+    for i, (start, end) in enumerate(blocks):
+        columns = source_indices[indptr[start] : indptr[end]]
+        rows = np.repeat(np.arange(start, end, dtype=index_dtype), np.diff(indptr[start : end + 1]))
+        # stable sort keeps rows ordered within each column
+        order = np.argsort(columns, kind="stable")
+        columns = columns[order]
+        block_counts = np.bincount(columns, minlength=shape[1])
+        block_starts = np.cumsum(block_counts) - block_counts
+        positions = next_position[columns] + (np.arange(len(columns)) - block_starts[columns])
+        data[positions] = source_data[indptr[start] : indptr[end]][order]
+        indices[positions] = rows[order]
+        next_position += block_counts
+        if (i + 1) % 100 == 0 or end == shape[0]:
+            logger.info("Transposed {} rows {}/{}".format(name, end, shape[0]))
+    data.flush()
+    indices.flush()
+    return scipy.sparse.csc_matrix((data, indices, csc_indptr), shape=shape)
+
+
+def copy_csc(group, directory, name, block_size):
+    """Copies a CSC matrix stored in an h5 group to memory-mapped files in blocks."""
+    shape = tuple(group.attrs["shape"] if "shape" in group.attrs else group.attrs["h5sparse_shape"])
+    indptr = group["indptr"][...]
+    nnz = int(indptr[-1])
+    index_dtype = get_index_dtype(nnz, shape[0])
+    data = create_memmap(directory, name + ".data", group["data"].dtype, (nnz,))
+    indices = create_memmap(directory, name + ".indices", index_dtype, (nnz,))
+    for start in range(0, nnz, block_size):
+        end = min(nnz, start + block_size)
+        data[start:end] = group["data"][start:end]
+        indices[start:end] = group["indices"][start:end]
+    data.flush()
+    indices.flush()
+    return scipy.sparse.csc_matrix((data, indices, indptr.astype(index_dtype)), shape=shape)
+
+
+def copy_dense(dataset, directory, name, block_size):
+    """Copies a dense matrix stored in an h5 dataset to a column-major memory-mapped file in blocks
+    of rows."""
+    X = create_memmap(directory, name, dataset.dtype, dataset.shape, order="F")
+    rows = max(1, block_size // max(1, dataset.shape[1]))
+    for start in range(0, dataset.shape[0], rows):
+        end = min(dataset.shape[0], start + rows)
+        X[start:end] = dataset[start:end]
+    X.flush()
+    return X
+
+
+def read_matrix(node, directory, name, block_size):
+    if isinstance(node, h5py.Dataset):
+        return copy_dense(node, directory, name, block_size)
+    sparse_format = get_sparse_format(node)
+    if sparse_format == "csr":
+        return transpose_csr(node, directory, name, block_size)
+    if sparse_format == "csc":
+        return copy_csc(node, directory, name, block_size)
+    raise ValueError("Unknown sparse format {}".format(sparse_format))
+
+
+def read_h5ad(f, directory, block_size=None):
+    """Reads an h5ad file with X and layers stored feature-major (CSC or column-major) in
+    memory-mapped files under directory so that the matrices do not need to fit in memory.
+
+    :param f: Path or file object of the h5ad file
+    :param directory: Directory for memory-mapped files. Files must exist while the returned
+        AnnData is in use.
+    :param block_size: Maximum number of matrix values to read into memory at once
+    """
+    if block_size is None:
+        block_size = max_block_size
+    with h5py.File(f, "r") as h5:
+        X = read_matrix(h5["X"], directory, "X", block_size)
+        layers = {}
+        if "layers" in h5:
+            for key in h5["layers"].keys():
+                layers[key] = read_matrix(
+                    h5["layers"][key], directory, "layers-{}".format(key), block_size
+                )
+        elements = {}
+        for key in ["obs", "var", "obsm", "uns"]:
+            if key in h5:
+                elements[key] = read_elem(h5[key])
+    adata = AnnData(X=X, **elements)
+    for key in layers.keys():
+        adata.layers[key] = layers[key]
+    return adata
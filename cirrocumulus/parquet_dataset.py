@@ -10,7 +10,10 @@ import pyarrow.parquet as pq
 from anndata import AnnData
 
 from cirrocumulus.abstract_dataset import AbstractDataset
-from cirrocumulus.anndata_util import ADATA_LAYERS_UNS_KEY
+from cirrocumulus.anndata_util import ADATA_LAYERS_UNS_KEY, subset_obs
+from cirrocumulus.lru_cache import LRUCache
+from cirrocumulus.quantization import decode_X
+from cirrocumulus.util import get_dataset_cache_size, get_version
 
 
 max_workers = min(12, pa.cpu_count())
@@ -34,11 +37,17 @@ def get_matrix(futures, shape=None):
     data = []
     row = []
     col = []
+    scale = []
+    offset = []
     is_sparse = None
     for i in range(len(futures)):
         t = futures[i].result()
         if i == 0:
             is_sparse = "index" in t.column_names
+        if t.schema.metadata is not None and b"cirro" in t.schema.metadata:
+            quantization = json.loads(t.schema.metadata[b"cirro"])
+            scale.append(quantization["scale"])
+            offset.append(quantization["offset"])
         if is_sparse:
             row.append(t.column("index").to_numpy())
             col.append(np.repeat(i, len(t)))
@@ -54,7 +63,14 @@ def get_matrix(futures, shape=None):
         X = scipy.sparse.csc_matrix((data, (row, col)), shape=(shape[0], len(futures)))
     else:
         X = np.array(data).T
-    return X
+    if len(scale) > 0:
+        return decode_X(
+            X,
+            dict(
+                scale=np.array(scale, dtype=np.float32), offset=np.array(offset, dtype=np.float32)
+            ),
+        )
+    return decode_X(X)
 
 
 def read_matrix(keys, node_path, dataset_info, filesystem, shape):
@@ -70,9 +86,83 @@ def read_matrix(keys, node_path, dataset_info, filesystem, shape):
     return X, var
 
 
+def get_obs_values(table):
+    """Returns the values of an obs column written by save_data_obs. Dictionary encoded columns
+    are returned as categoricals without materializing category values per observation."""
+    field = table.schema.field("value")
+    column = table.column("value")
+    if pa.types.is_dictionary(field.type):
+        chunks = column.unify_dictionaries().chunks or [pa.array([], type=field.type)]
+        return pd.Categorical.from_codes(
+            np.concatenate([chunk.indices.fill_null(-1).to_numpy() for chunk in chunks]),
+            pd.Index(chunks[0].dictionary.to_pandas()),
+            ordered=field.type.ordered,
+        )
+    values = column.to_pandas()
+    if field.metadata is not None and b"dtype" in field.metadata:
+        values = values.astype(field.metadata[b"dtype"].decode(), copy=False)
+    return values
+
+
+def read_bundle_matrix(keys, path, dataset_info, filesystem, shape, bundle):
+    """Reads features from a file written by save_adata_X_bundle using one ranged read per
+    requested row group."""
+    metadata, feature_index, quantization = bundle
+    if len(keys) == 1 and isinstance(keys[0], slice):
+        keys = dataset_info["var"][keys[0]]
+    row_groups = feature_index.get_indexer(keys)
+    if (row_groups == -1).any():
+        raise KeyError("{} not found".format(", ".join(np.asarray(keys)[row_groups == -1])))
+    with filesystem.open(path, "rb") as f:
+        table = pq.ParquetFile(f, metadata=metadata, pre_buffer=True).read_row_groups(
+            row_groups, use_threads=False
+        )
+    value = table.column("value").to_numpy()
+    if "index" in table.column_names:
+        indptr = np.zeros(len(row_groups) + 1, dtype=np.int64)
+        np.cumsum([metadata.row_group(i).num_rows for i in row_groups], out=indptr[1:])
+        X = scipy.sparse.csc_matrix(
+            (value, table.column("index").to_numpy(), indptr), shape=(shape[0], len(row_groups))
+        )
+    else:
+        X = value.reshape(len(row_groups), shape[0]).T
+    return decode_X(X, quantization, row_groups), pd.DataFrame(index=keys)
+
+
 class ParquetDataset(AbstractDataset):
     def __init__(self):
         super().__init__()
+        # (path, version) -> (parquet metadata, feature name -> row group, quantization) for
+        # bundled matrices
+        self.bundle_cache = LRUCache(
+            max_size=get_dataset_cache_size(), get_size=lambda entry: entry[0].serialized_size
+        )
+
+    def get_bundle(self, filesystem, path):
+        """Returns the footer metadata, feature index, and quantization of a bundled matrix."""
+        version = get_version(filesystem, path)
+        key = (path, version) if version is not None else None
+        bundle = self.bundle_cache.get(key)
+        if bundle is None:
+            with filesystem.open(path, "rb") as f:
+                metadata = pq.read_metadata(f)
+            cirro_metadata = json.loads(metadata.metadata[b"cirro"])
+            quantization = None
+            if "scale" in cirro_metadata:
+                quantization = dict(
+                    scale=np.array(cirro_metadata["scale"], dtype=np.float32),
+                    offset=np.array(cirro_metadata["offset"], dtype=np.float32),
+                )
+            bundle = (metadata, pd.Index(cirro_metadata["features"]), quantization)
+            self.bundle_cache.put(key, bundle)
+        return bundle
+
+    def read_matrix(self, keys, node_path, dataset_info, filesystem, shape):
+        if dataset_info.get("bundle"):
+            bundle_path = node_path + ".parquet"
+            bundle = self.get_bundle(filesystem, bundle_path)
+            return read_bundle_matrix(keys, bundle_path, dataset_info, filesystem, shape, bundle)
+        return read_matrix(keys, node_path, dataset_info, filesystem, shape)
 
     def get_suffixes(self):
         return ["parquet", "pq", "cpq"]
@@ -90,7 +180,7 @@ class ParquetDataset(AbstractDataset):
         keys.pop("module", [])
         layers = {}
         for layer_key in keys.keys():
-            X_layer, var_layer = read_matrix(
+            X_layer, var_layer = self.read_matrix(
                 keys=keys[layer_key],
                 node_path=os.path.join(path, "layers", layer_key),
                 dataset_info=dataset_info,
@@ -101,7 +191,7 @@ class ParquetDataset(AbstractDataset):
             layers[layer_key] = adata_layer
 
         if len(X_keys) > 0:
-            X, var = read_matrix(
+            X, var = self.read_matrix(
                 keys=X_keys,
                 node_path=os.path.join(path, "X"),
                 dataset_info=dataset_info,
@@ -114,8 +204,7 @@ class ParquetDataset(AbstractDataset):
             paths = [node_path + "/" + key + ".parquet" for key in obs_keys]
             futures = read_tables(paths, filesystem, columns=["value"])
             for i in range(len(futures)):
-                df = futures[i].result().to_pandas()
-                obs[obs_keys[i]] = df["value"]
+                obs[obs_keys[i]] = get_obs_values(futures[i].result())
 
         if len(basis_keys) > 0:
             node_path = os.path.join(path, "obsm")
@@ -162,15 +251,17 @@ class ParquetDataset(AbstractDataset):
                 obsm[key] = df[["{}_{}".format(key, 1), "{}_{}".format(key, 2)]]
         return AnnData(X=X, obs=obs, var=var, obsm=obsm)
 
-    def read_dataset(self, filesystem, path, keys=None, dataset=None):
+    def read_dataset(self, filesystem, path, keys=None, dataset=None, obs_indices=None):
         if keys is None:
             keys = {}
         # path is directory
         keys = keys.copy()
         if not path.endswith(".parquet"):
-            return self.read_data_sparse(filesystem, path, keys, dataset)
-        # single parquet file containing everything
-        return self.read_data_dense(filesystem, path, keys, dataset)
+            adata = self.read_data_sparse(filesystem, path, keys, dataset)
+        else:
+            # single parquet file containing everything
+            adata = self.read_data_dense(filesystem, path, keys, dataset)
+        return subset_obs(adata, obs_indices)
 
     def get_schema(self, filesystem, path):
         if path.endswith(".json") or path.endswith(".json.gz"):
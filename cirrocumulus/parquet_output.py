@@ -1,21 +1,34 @@
 import os
+import json
 import logging
+import concurrent.futures
 
 import numpy as np
 import pyarrow as pa
 import scipy.sparse
 import pyarrow.parquet as pq
+from pandas import CategoricalDtype
 
-from cirrocumulus.util import dumps
+from cirrocumulus.anndata_util import X_QUANTIZATION_UNS_KEY, get_feature_values
+from cirrocumulus.util import WriteProgress, dumps
 
 
 logger = logging.getLogger("cirro")
 
 
-def write_pq(d, output_dir, name, filesystem, write_statistics=True, row_group_size=None):
+def write_pq(
+    d,
+    output_dir,
+    name,
+    filesystem,
+    write_statistics=True,
+    row_group_size=None,
+    schema=None,
+    metadata=None,
+):
     filesystem.makedirs(output_dir, exist_ok=True)
     pq.write_table(
-        pa.Table.from_pydict(d),
+        pa.Table.from_pydict(d, schema=schema, metadata=metadata),
         os.path.join(output_dir, name + ".parquet"),
         write_statistics=write_statistics,
         row_group_size=row_group_size,
@@ -23,11 +36,14 @@ def write_pq(d, output_dir, name, filesystem, write_statistics=True, row_group_s
     )
 
 
-def save_dataset_pq(dataset, schema, output_directory, filesystem, whitelist):
+def save_dataset_pq(
+    dataset, schema, output_directory, filesystem, whitelist, bundle=False, workers=1
+):
     X_dir = os.path.join(output_directory, "X")
     obs_dir = os.path.join(output_directory, "obs")
     obsm_dir = os.path.join(output_directory, "obsm")
-    filesystem.makedirs(X_dir, exist_ok=True)
+    if not bundle:
+        filesystem.makedirs(X_dir, exist_ok=True)
     filesystem.makedirs(obs_dir, exist_ok=True)
     filesystem.makedirs(obsm_dir, exist_ok=True)
 
@@ -35,38 +51,157 @@ def save_dataset_pq(dataset, schema, output_directory, filesystem, whitelist):
         os.path.join(output_directory, "index.json.gz"), "wt", compression="gzip"
     ) as f:
         f.write(dumps(schema, double_precision=2, orient="values"))
-        if whitelist["x"]:
-            save_adata_X(dataset, X_dir, filesystem, whitelist=whitelist["x_keys"])
-            for layer in dataset.layers.keys():
+        quantization = dataset.uns.get(X_QUANTIZATION_UNS_KEY, {})
+        matrix_keys = whitelist.get("matrix_keys")
+        layers = [
+            layer
+            for layer in dataset.layers.keys()
+            if matrix_keys is None or "layers/" + layer in matrix_keys
+        ]
+        if whitelist["x"] and matrix_keys is not None:
+            remove_stale(
+                filesystem,
+                os.path.join(output_directory, "layers"),
+                [layer + ".parquet" if bundle else layer for layer in dataset.layers.keys()],
+            )
+        if whitelist["x"] and bundle:
+            if matrix_keys is None or "X" in matrix_keys:
+                save_adata_X_bundle(
+                    dataset,
+                    os.path.join(output_directory, "X.parquet"),
+                    filesystem,
+                    whitelist=whitelist["x_keys"],
+                    quantization=quantization.get("X"),
+                )
+            for layer in layers:
+                filesystem.makedirs(os.path.join(output_directory, "layers"), exist_ok=True)
+                save_adata_X_bundle(
+                    dataset,
+                    os.path.join(output_directory, "layers", layer + ".parquet"),
+                    filesystem,
+                    layer,
+                    whitelist=whitelist["x_keys"],
+                    quantization=quantization.get("layers/" + layer),
+                )
+        elif whitelist["x"]:
+            if matrix_keys is None or "X" in matrix_keys:
+                save_adata_X(
+                    dataset,
+                    X_dir,
+                    filesystem,
+                    whitelist=whitelist["x_keys"],
+                    quantization=quantization.get("X"),
+                    workers=workers,
+                )
+            for layer in layers:
                 layer_dir = os.path.join(output_directory, "layers", layer)
                 filesystem.makedirs(layer_dir, exist_ok=True)
-                save_adata_X(dataset, layer_dir, filesystem, layer, whitelist=whitelist["x_keys"])
+                save_adata_X(
+                    dataset,
+                    layer_dir,
+                    filesystem,
+                    layer,
+                    whitelist=whitelist["x_keys"],
+                    quantization=quantization.get("layers/" + layer),
+                    workers=workers,
+                )
         if whitelist["obs"]:
+            if whitelist["obs_keys"] is not None:
+                remove_stale(
+                    filesystem,
+                    obs_dir,
+                    [name + ".parquet" for name in list(dataset.obs.columns) + ["index"]],
+                )
             save_data_obs(dataset, obs_dir, filesystem, whitelist=whitelist["obs_keys"])
         if whitelist["obsm"]:
+            if whitelist["obsm_keys"] is not None:
+                remove_stale(
+                    filesystem, obsm_dir, [name + ".parquet" for name in dataset.obsm.keys()]
+                )
             save_data_obsm(dataset, obsm_dir, filesystem, whitelist=whitelist["obsm_keys"])
 
 
-def save_adata_X(adata, X_dir, filesystem, layer=None, whitelist=None):
+def remove_stale(filesystem, directory, names):
+    """Removes entries of directory that are not in names when only some components are
+    written."""
+    if not filesystem.exists(directory):
+        return
+    for path in filesystem.ls(directory, detail=False):
+        if os.path.basename(path.rstrip("/")) not in names:
+            logger.info("Removing {}".format(path))
+            filesystem.rm(path, recursive=True)
+
+
+def get_quantization_metadata(quantization, j):
+    if quantization is None:
+        return None
+    return dict(
+        cirro=json.dumps(
+            dict(scale=float(quantization["scale"][j]), offset=float(quantization["offset"][j]))
+        )
+    )
+
+
+def save_adata_X(
+    adata, X_dir, filesystem, layer=None, whitelist=None, quantization=None, workers=1
+):
+    adata_X = adata.X if layer is None else adata.layers[layer]
+    if scipy.sparse.issparse(adata_X) and not scipy.sparse.isspmatrix_csc(adata_X):
+        adata_X = adata_X.tocsc()
+    names = adata.var.index
+    columns = [j for j in range(adata_X.shape[1]) if whitelist is None or names[j] in whitelist]
+
+    def write_feature(j):
+        indices, values = get_feature_values(adata_X, j)
+        write_pq(
+            dict(value=values) if indices is None else dict(index=indices, value=values),
+            X_dir,
+            names[j],
+            filesystem,
+            metadata=get_quantization_metadata(quantization, j),
+        )
+        return len(values)
+
+    progress = WriteProgress("X" if layer is None else layer, len(columns))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for nvalues in executor.map(write_feature, columns):
+            progress.update(nvalues)
+
+
+def save_adata_X_bundle(adata, path, filesystem, layer=None, whitelist=None, quantization=None):
+    """Saves a matrix to a single parquet file with one row group per feature.
+
+    Feature names in row group order, and the scale and offset of quantized features, are stored
+    in the cirro key of the file metadata so that readers can map features to row groups using the
+    parquet footer only.
+    """
     adata_X = adata.X if layer is None else adata.layers[layer]
     names = adata.var.index
     is_sparse = scipy.sparse.issparse(adata_X)
-    output_dir = X_dir
-    for j in range(adata_X.shape[1]):
-        filename = names[j]
-        if whitelist is None or filename in whitelist:
-            X = adata_X[:, j]
-            if is_sparse:
-                X = X.toarray().flatten()
-
-            if is_sparse:
-                indices = np.where(X != 0)[0]
-                values = X[indices]
-                write_pq(dict(index=indices, value=values), output_dir, filename, filesystem)
-            else:
-                write_pq(dict(value=X), output_dir, filename, filesystem)
-            if j > 0 and (j + 1) % 1000 == 0:
-                logger.info("Wrote adata X {}/{}".format(j + 1, adata_X.shape[1]))
+    if is_sparse and not scipy.sparse.isspmatrix_csc(adata_X):
+        adata_X = adata_X.tocsc()
+    index_dtype = np.int32 if adata_X.shape[0] <= np.iinfo(np.int32).max else np.int64
+    fields = [("value", pa.from_numpy_dtype(adata_X.dtype))]
+    if is_sparse:
+        fields.insert(0, ("index", pa.from_numpy_dtype(index_dtype)))
+    columns = [j for j in range(adata_X.shape[1]) if whitelist is None or names[j] in whitelist]
+    metadata = dict(features=[names[j] for j in columns])
+    if quantization is not None:
+        metadata["scale"] = quantization["scale"][columns].tolist()
+        metadata["offset"] = quantization["offset"][columns].tolist()
+    schema = pa.schema(fields).with_metadata({"cirro": json.dumps(metadata)})
+    with filesystem.open(path, "wb") as f, pq.ParquetWriter(
+        f, schema, write_statistics=False
+    ) as writer:
+        progress = WriteProgress("X" if layer is None else layer, len(columns))
+        for j in columns:
+            indices, values = get_feature_values(adata_X, j)
+            d = dict(value=values)
+            if indices is not None:
+                d["index"] = indices.astype(index_dtype, copy=False)
+            table = pa.Table.from_pydict(d, schema=schema)
+            writer.write_table(table, row_group_size=max(1, len(table)))
+            progress.update(len(table))
 
 
 def save_data_obsm(adata, obsm_dir, filesystem, whitelist):
@@ -82,10 +217,38 @@ def save_data_obsm(adata, obsm_dir, filesystem, whitelist):
             write_pq(d, obsm_dir, name, filesystem)
 
 
+def get_obs_field(value):
+    """Returns an arrow array and field for an obs column.
+
+    Categoricals are dictionary encoded with their category order. Integers and floats are stored
+    in the narrowest type that holds their values, with the original dtype in the field metadata.
+    """
+    if isinstance(value.dtype, CategoricalDtype):
+        codes = value.cat.codes.values
+        array = pa.DictionaryArray.from_arrays(
+            pa.array(codes, mask=codes < 0),
+            pa.array(value.cat.categories.values),
+            ordered=value.cat.ordered,
+        )
+        return array, pa.field("value", array.type)
+    values = value.values
+    if isinstance(values, np.ndarray) and len(values) > 0:
+        if values.dtype.kind in "iu":
+            values = values.astype(
+                np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max()))
+            )
+        elif values.dtype == np.float64:
+            values32 = values.astype(np.float32)
+            if np.array_equal(values32, values, equal_nan=True):
+                values = values32
+    array = pa.array(values)
+    return array, pa.field("value", array.type, metadata=dict(dtype=str(value.dtype)))
+
+
 def save_data_obs(adata, obs_dir, filesystem, whitelist=None):
     logger.info("writing adata obs")
     for name in adata.obs:
         if whitelist is None or name in whitelist:
-            value = adata.obs[name]
-            write_pq(dict(value=value), obs_dir, name, filesystem)
+            array, field = get_obs_field(adata.obs[name])
+            write_pq(dict(value=array), obs_dir, name, filesystem, schema=pa.schema([field]))
     write_pq(dict(value=adata.obs.index.values), obs_dir, "index", filesystem)
@@ -1,6 +1,8 @@
 import os
 import logging
 import argparse
+import tempfile
+import contextlib
 
 import h5py
 import numpy as np
@@ -10,9 +12,18 @@ import scipy.sparse
 from pandas import CategoricalDtype
 
 from cirrocumulus.anndata_dataset import read_adata
-from cirrocumulus.anndata_util import dataset_schema, get_scanpy_marker_keys
+from cirrocumulus.anndata_util import X_QUANTIZATION_UNS_KEY, dataset_schema, get_scanpy_marker_keys
+from cirrocumulus.incremental import (
+    get_component_hashes,
+    get_incremental_whitelist,
+    read_component_hashes,
+    remove_component_hashes,
+    write_component_hashes,
+)
 from cirrocumulus.io_util import SPATIAL_HELP, filter_markers, get_markers, unique_id
+from cirrocumulus.quantization import X_DTYPES, encode_X
 from cirrocumulus.util import get_fs, open_file, to_json
+from cirrocumulus.zarr_output import COMPRESSORS
 
 
 logger = logging.getLogger("cirro")
@@ -64,6 +75,7 @@ def whitelist_todict(whitelist):
         "x_keys": x_keys if len(x_keys) > 0 else None,
         "obs_keys": obs_keys if len(obs_keys) > 0 else None,
         "obsm_keys": obsm_keys if len(obsm_keys) > 0 else None,
+        "matrix_keys": None,
     }
 
 
@@ -79,14 +91,41 @@ class PrepareData:
         output_format="zarr",
         no_auto_groups=False,
         save_whitelist=None,
+        csr=False,
+        bundle=False,
+        x_dtype=None,
+        workers=1,
+        zarr_compressor=None,
+        compression_level=None,
+        features_per_chunk=None,
+        incremental=False,
     ):
         self.groups = groups
         self.group_nfeatures = group_nfeatures
         self.markers = markers
         self.output_format = output_format
         self.no_auto_groups = no_auto_groups
+        self.bundle = bundle
+        if bundle and output_format != "parquet":
+            logger.info("Bundled X is only saved in parquet format")
+        if x_dtype == "uint16" and output_format == "jsonl":
+            logger.info("Quantized X is only saved in parquet and zarr formats, using float32")
+            x_dtype = "float32"
+        self.x_dtype = x_dtype
+        self.workers = workers
+        self.zarr_compressor = zarr_compressor
+        if compression_level is not None and zarr_compressor is None:
+            logger.info("Compression level has no effect without a zarr compressor")
+        self.compression_level = compression_level
+        self.features_per_chunk = features_per_chunk
         if save_whitelist is None:
             save_whitelist = whitelist_todict(None)
+        if incremental and output_format not in ["parquet", "zarr"]:
+            logger.info("Incremental updates are only supported in parquet and zarr formats")
+            incremental = False
+        if incremental and save_whitelist != whitelist_todict(None):
+            raise ValueError("Incremental updates can not be combined with a whitelist")
+        self.incremental = incremental
         self.save_whitelist = save_whitelist
         for dataset in datasets:
             for key in list(dataset.obsm.keys()):
@@ -114,7 +153,13 @@ class PrepareData:
         self.measures = []
         self.others = []
         self.dataset = dataset
+        self.X_csr = None
         if save_whitelist["x"]:
+            if csr:
+                if output_format != "zarr" or not scipy.sparse.issparse(dataset.X):
+                    logger.info("Cell-major copy of X is only saved for sparse data in zarr format")
+                else:
+                    self.X_csr = dataset.X.tocsr()
             if scipy.sparse.issparse(dataset.X) and not scipy.sparse.isspmatrix_csc(dataset.X):
                 dataset.X = dataset.X.tocsc()
             for layer_name in dataset.layers.keys():
@@ -237,12 +282,20 @@ class PrepareData:
                     raise ValueError(group + " not found in " + ", ".join(dataset.obs.columns))
         schema = self.get_schema()
         schema["format"] = output_format
+        if self.bundle and output_format == "parquet":
+            schema["bundle"] = True
         if output_format in ["parquet", "zarr"]:
             output_dir = self.base_output
         else:
             output_dir = os.path.splitext(self.base_output)[0]
         filesystem = get_fs(output_dir)
+        old_component_hashes = (
+            read_component_hashes(filesystem, output_dir) if self.incremental else None
+        )
         filesystem.makedirs(output_dir, exist_ok=True)
+        if output_format in ["parquet", "zarr"]:
+            # stored hashes are only valid after all components are written
+            remove_component_hashes(filesystem, output_dir)
         results = schema.get("results", [])
 
         if len(results) > 0:
@@ -279,21 +332,81 @@ class PrepareData:
                 dest = os.path.join(image_dir, os.path.basename(src))
                 filesystem.copy(src, dest)
                 image["image"] = "images/" + os.path.basename(src)
+        component_hashes = None
+        if self.incremental:
+            component_hashes = get_component_hashes(dataset, self.get_write_options())
+            save_whitelist = get_incremental_whitelist(old_component_hashes, component_hashes)
+            if save_whitelist is not None:
+                self.save_whitelist = save_whitelist
+        if self.x_dtype is not None and self.save_whitelist["x"]:
+            self.encode_X()
 
         if output_format == "parquet":
             from cirrocumulus.parquet_output import save_dataset_pq
 
-            save_dataset_pq(dataset, schema, self.base_output, filesystem, self.save_whitelist)
+            save_dataset_pq(
+                dataset,
+                schema,
+                self.base_output,
+                filesystem,
+                self.save_whitelist,
+                self.bundle,
+                self.workers,
+            )
         elif output_format == "jsonl":
             from cirrocumulus.jsonl_io import save_dataset_jsonl
 
-            save_dataset_jsonl(dataset, schema, output_dir, self.base_output, filesystem)
+            save_dataset_jsonl(
+                dataset, schema, output_dir, self.base_output, filesystem, self.workers
+            )
         elif output_format == "zarr":
-            from cirrocumulus.zarr_output import save_dataset_zarr
-
-            save_dataset_zarr(dataset, schema, self.base_output, filesystem, self.save_whitelist)
+            from cirrocumulus.zarr_output import get_compressor, save_dataset_zarr
+
+            save_dataset_zarr(
+                dataset,
+                schema,
+                self.base_output,
+                filesystem,
+                self.save_whitelist,
+                self.X_csr,
+                compressor=get_compressor(self.zarr_compressor, self.compression_level)
+                if self.zarr_compressor is not None
+                else None,
+                features_per_chunk=self.features_per_chunk,
+            )
         else:
             raise ValueError("Unknown format")
+        if component_hashes is not None:
+            write_component_hashes(filesystem, output_dir, component_hashes)
+
+    def get_write_options(self):
+        """Returns options that change how components are written."""
+        return dict(
+            output_format=self.output_format,
+            csr=self.X_csr is not None,
+            bundle=self.bundle,
+            x_dtype=self.x_dtype,
+            zarr_compressor=self.zarr_compressor,
+            compression_level=self.compression_level,
+            features_per_chunk=self.features_per_chunk,
+        )
+
+    def encode_X(self):
+        """Converts X and layers to the storage dtype after markers are computed."""
+        dataset = self.dataset
+        logger.info("Converting X to {}".format(self.x_dtype))
+        if self.x_dtype == "float16" and scipy.sparse.issparse(dataset.X):
+            logger.info("Sparse matrices are saved as float32 instead of float16")
+        quantization = {}
+        dataset.X, quantization["X"] = encode_X(dataset.X, self.x_dtype)
+        for layer_name in dataset.layers.keys():
+            dataset.layers[layer_name], quantization["layers/" + layer_name] = encode_X(
+                dataset.layers[layer_name], self.x_dtype
+            )
+        if self.X_csr is not None:
+            self.X_csr = dataset.X.tocsr()
+        if self.x_dtype == "uint16":
+            dataset.uns[X_QUANTIZATION_UNS_KEY] = quantization
 
     def get_schema(self):
         result = dataset_schema(self.dataset, n_features=self.group_nfeatures)
@@ -346,6 +459,57 @@ def create_parser(description=False):
         "--group_nfeatures", help="Number of marker genes/features to include", type=int, default=10
     )
     parser.add_argument("--spatial", help=SPATIAL_HELP)
+    parser.add_argument(
+        "--csr",
+        help="Also save a cell-major copy of X for faster retrieval of many features in a subset of cells (zarr format only)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bundle",
+        help="Save X and each layer as a single file with one row group per feature instead of one file per feature (parquet format only)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--x-dtype",
+        dest="x_dtype",
+        help="Data type used to store X and layers. uint16 stores values quantized with a per-feature scale and offset (parquet and zarr formats only)",
+        choices=X_DTYPES,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of threads used to write features (parquet and jsonl formats)",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--zarr-compressor",
+        dest="zarr_compressor",
+        help="Compressor for all arrays (zarr format only)",
+        choices=COMPRESSORS,
+    )
+    parser.add_argument(
+        "--compression-level",
+        dest="compression_level",
+        help="Compression level for blosc and zstd or acceleration for lz4 (zarr format only)",
+        type=int,
+    )
+    parser.add_argument(
+        "--features-per-chunk",
+        dest="features_per_chunk",
+        help="Target number of features per chunk of X and layers, with chunk sizes derived from the mean number of non-zero values per feature (zarr format only)",
+        type=int,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only rewrite X, layers, obs columns, and embeddings that changed since the output was last prepared with this option (parquet and zarr formats only)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--out-of-core",
+        dest="out_of_core",
+        help="Convert X and layers to feature-major order in blocks using temporary memory-mapped files in TMPDIR so that h5ad files larger than memory can be prepared (h5ad inputs only)",
+        action="store_true",
+    )
     return parser
 
 
@@ -367,33 +531,52 @@ def main(argsv):
     if not out.lower().endswith(output_format2extension[output_format]):
         out += output_format2extension[output_format]
     save_whitelist = whitelist_todict(save_whitelist)
-    datasets = []
-    for input_dataset in input_datasets:
-        filesystem = get_fs(input_dataset)
-        adata = read_adata(
-            input_dataset,
-            filesystem,
-            spatial_directory=args.spatial,
-            use_raw=False,
-            backed=not save_whitelist["x"],
-        )
-        datasets.append(adata)
-        adata.uns["name"] = os.path.splitext(
-            os.path.basename(input_dataset.rstrip(filesystem.sep))
-        )[0]
-
-    prepare_data = PrepareData(
-        datasets=datasets,
-        output=out,
-        dimensions=args.groups,
-        groups=args.groups,
-        group_nfeatures=args.group_nfeatures,
-        markers=args.markers,
-        output_format=output_format,
-        no_auto_groups=no_auto_groups,
-        save_whitelist=save_whitelist,
+    # memory-mapped files used by out-of-core datasets must exist until the output is written
+    out_of_core_context = (
+        tempfile.TemporaryDirectory() if args.out_of_core else contextlib.nullcontext()
     )
-    prepare_data.execute()
+    with out_of_core_context as out_of_core_directory:
+        datasets = []
+        for i, input_dataset in enumerate(input_datasets):
+            filesystem = get_fs(input_dataset)
+            dataset_out_of_core_directory = None
+            if out_of_core_directory is not None and save_whitelist["x"]:
+                # memory-mapped files have fixed names, each input needs its own directory
+                dataset_out_of_core_directory = os.path.join(out_of_core_directory, str(i))
+                os.mkdir(dataset_out_of_core_directory)
+            adata = read_adata(
+                input_dataset,
+                filesystem,
+                spatial_directory=args.spatial,
+                use_raw=False,
+                backed=not save_whitelist["x"],
+                out_of_core_directory=dataset_out_of_core_directory,
+            )
+            datasets.append(adata)
+            adata.uns["name"] = os.path.splitext(
+                os.path.basename(input_dataset.rstrip(filesystem.sep))
+            )[0]
+
+        prepare_data = PrepareData(
+            datasets=datasets,
+            output=out,
+            dimensions=args.groups,
+            groups=args.groups,
+            group_nfeatures=args.group_nfeatures,
+            markers=args.markers,
+            output_format=output_format,
+            no_auto_groups=no_auto_groups,
+            save_whitelist=save_whitelist,
+            csr=args.csr,
+            bundle=args.bundle,
+            x_dtype=args.x_dtype,
+            workers=args.workers,
+            zarr_compressor=args.zarr_compressor,
+            compression_level=args.compression_level,
+            features_per_chunk=args.features_per_chunk,
+            incremental=args.incremental,
+        )
+        prepare_data.execute()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+import numpy as np
+import scipy.sparse
+
+
+X_DTYPES = ["float32", "float16", "uint16"]
+max_code = np.iinfo(np.uint16).max
+
+
+def get_columns(X):
+    """Returns the column of each stored value of a CSC or CSR matrix."""
+    if scipy.sparse.isspmatrix_csr(X):
+        return X.indices
+    return np.repeat(np.arange(X.shape[1]), np.diff(X.indptr))
+
+
+def quantize(X):
+    """Quantizes each column of X to uint16.
+
+    Zeros are stored as code 0 so that sparse matrices stay sparse. Non-zero values are stored as
+    codes 1-65535 that are decoded as offset + code * scale using per-column scale and offset.
+
+    :return: Tuple of quantized X, float32 scale, and float32 offset
+    """
+    if scipy.sparse.issparse(X):
+        X = scipy.sparse.csc_matrix(X)
+        X.eliminate_zeros()
+        lo = np.full(X.shape[1], np.inf)
+        hi = np.full(X.shape[1], -np.inf)
+        nonempty = np.diff(X.indptr) > 0
+        starts = X.indptr[:-1][nonempty]
+        if len(starts) > 0:
+            lo[nonempty] = np.minimum.reduceat(X.data, starts)
+            hi[nonempty] = np.maximum.reduceat(X.data, starts)
+    else:
+        X = np.asarray(X)
+        nonzero = X != 0
+        lo = np.where(nonzero, X, np.inf).min(axis=0, initial=np.inf)
+        hi = np.where(nonzero, X, -np.inf).max(axis=0, initial=-np.inf)
+    empty = np.isinf(lo)
+    lo[empty] = 0
+    hi[empty] = 0
+    scale = (hi - lo) / (max_code - 1)
+    scale[scale == 0] = 1
+    scale = scale.astype(np.float32)
+    offset = (lo - scale).astype(np.float32)
+    if scipy.sparse.issparse(X):
+        columns = get_columns(X)
+        codes = get_codes(X.data, scale[columns], offset[columns])
+        X = scipy.sparse.csc_matrix((codes, X.indices, X.indptr), shape=X.shape)
+    else:
+        codes = get_codes(X, scale, offset)
+        X = np.where(nonzero, codes, 0).astype(np.uint16)
+    return X, scale, offset
+
+
+def get_codes(values, scale, offset):
+    """Returns codes 1-65535 for non-zero values.
+
+    Codes that decode to exactly zero in columns with negative and positive values are moved one
+    step towards the sign of the value so that non-zero values stay non-zero.
+    """
+    codes = np.clip(np.rint((values - offset) / scale), 1, max_code).astype(np.uint16)
+    zero = (offset + codes * scale) == 0
+    if np.any(zero):
+        step = np.where(values > 0, 1, -1)
+        codes = np.where(zero, np.clip(codes.astype(np.int64) + step, 1, max_code), codes).astype(
+            np.uint16
+        )
+    return codes
+
+
+def dequantize(X, scale, offset):
+    """Decodes a matrix created by quantize to float32.
+
+    :param X: Quantized matrix or a subset of its columns
+    :param scale: Scale of each column in X
+    :param offset: Offset of each column in X
+    """
+    if scipy.sparse.issparse(X):
+        if not (scipy.sparse.isspmatrix_csc(X) or scipy.sparse.isspmatrix_csr(X)):
+            X = X.tocsc()
+        columns = get_columns(X)
+        data = np.where(X.data == 0, 0, offset[columns] + X.data * scale[columns])
+        return type(X)((data.astype(np.float32), X.indices, X.indptr), shape=X.shape)
+    return np.where(X == 0, 0, offset + X * scale).astype(np.float32)
+
+
+def encode_X(X, x_dtype):
+    """Converts X to the storage type x_dtype. Sparse matrices are stored as float32 instead of
+    float16 because scipy.sparse does not support float16.
+
+    :return: Tuple of converted X and dict with scale and offset when x_dtype is uint16 or None
+    """
+    if x_dtype == "uint16":
+        X, scale, offset = quantize(X)
+        return X, dict(scale=scale, offset=offset)
+    if x_dtype not in X_DTYPES:
+        raise ValueError("Unknown dtype {}".format(x_dtype))
+    if x_dtype == "float16" and scipy.sparse.issparse(X):
+        x_dtype = "float32"
+    return X.astype(x_dtype), None
+
+
+def decode_X(X, quantization=None, columns=slice(None)):
+    """Returns X as float32 if it was stored as float16 or quantized.
+
+    :param quantization: Dict with scale and offset of all columns if X was quantized
+    :param columns: Indices or slice of the columns in X
+    """
+    if quantization is not None:
+        return dequantize(X, quantization["scale"][columns], quantization["offset"][columns])
+    if X.dtype == np.float16:
+        return X.astype(np.float32)
+    return X
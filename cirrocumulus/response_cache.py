@@ -0,0 +1,56 @@
+import os
+import json
+import hashlib
+import logging
+
+from cirrocumulus.lru_cache import LRUCache
+
+
+logger = logging.getLogger("cirro")
+
+
+class ResponseCache:
+    """Serialized responses cached in memory and optionally in a directory.
+
+    :param max_size: Maximum number of bytes to keep in memory
+    :param directory: Optional directory shared by server processes. Files are not removed.
+    """
+
+    def __init__(self, max_size, directory=None):
+        self.cache = LRUCache(max_size=max_size, get_size=lambda entry: len(entry[1]))
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(*args):
+        """Returns a digest of the JSON serializable args, with dict keys in sorted order."""
+        s = json.dumps(args, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns a tuple of content type and content or None."""
+        entry = self.cache.get(key)
+        if entry is None and self.directory is not None:
+            try:
+                with open(os.path.join(self.directory, key), "rb") as f:
+                    content_type = f.readline().decode("utf-8").strip()
+                    entry = content_type, f.read()
+                self.cache.put(key, entry)
+            except FileNotFoundError:
+                pass
+        return entry
+
+    def put(self, key, content_type, content):
+        entry = (content_type, content)
+        self.cache.put(key, entry)
+        if self.directory is not None:
+            path = os.path.join(self.directory, key)
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(content_type.encode("utf-8") + b"\n")
+                    f.write(content)
+                os.replace(tmp_path, path)
+            except OSError:
+                logger.exception("Unable to write response to {}".format(path))
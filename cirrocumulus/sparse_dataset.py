@@ -7,8 +7,9 @@ See the copyright and license note in this directory source code.
 .. _Appier Inc.: https://www.appier.com/
 """
 
+import os
 import collections.abc as cabc
-from itertools import accumulate, chain
+import concurrent.futures
 from typing import Iterable, NamedTuple, Sequence, Tuple, Type, Union
 
 import numpy as np
@@ -24,6 +25,13 @@ except ImportError:
 
 from anndata._core.index import _subset
 
+from cirrocumulus.envir import CIRRO_SPARSE_READ_GAP
+
+
+# ranges separated by at most this many elements are fetched in a single read
+max_gap = int(os.environ.get(CIRRO_SPARSE_READ_GAP, "262144"))
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(12, os.cpu_count() or 1))
+
 
 Index1D = Union[slice, int, str, np.int64, np.ndarray]
 Index = Union[Index1D, Tuple[Index1D, Index1D], ss.spmatrix]
@@ -162,10 +170,10 @@ class backed_csc_matrix(BackedSparseMatrix, ss.csc_matrix):
             if start is not None and start < 0:
                 start -= 1
             indptr_slice = slice(start, stop)
-            indptr = self.group["indptr"][indptr_slice]
+            indptr = self.indptr[indptr_slice]
             data = self.group["data"][indptr[0] : indptr[-1]]
             indices = self.group["indices"][indptr[0] : indptr[-1]]
-            indptr -= indptr[0]
+            indptr = indptr - indptr[0]
             shape = (self.shape[0], indptr.size - 1)
             return ss.csc_matrix((data, indices, indptr), shape=shape)  # much faster
             # return self._get_sliceXarray(row, np.arange(*col.indices(self.shape[1])))
@@ -198,13 +206,104 @@ def slice_as_int(s: slice, dim: int) -> int:
     return out[0]
 
 
+def coalesce_ranges(
+    starts: np.ndarray, stops: np.ndarray, max_gap: int, chunk_size: int = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merges ranges sorted by start and stop that are separated by at most `max_gap` elements.
+
+    If `chunk_size` is given, ranges that end and start in the same chunk are also merged so that
+    each chunk is decompressed once.
+
+    Returns the start and stop of each merged range and the merged range that each input range
+    belongs to.
+    """
+    new_range = starts[1:] - stops[:-1] > max_gap
+    if chunk_size is not None:
+        new_range &= (stops[:-1] - 1) // chunk_size < starts[1:] // chunk_size
+    range_ids = np.concatenate(([0], np.cumsum(new_range)))
+    breaks = np.flatnonzero(new_range) + 1
+    merged_starts = starts[np.concatenate(([0], breaks))]
+    merged_stops = stops[np.concatenate((breaks - 1, [len(stops) - 1]))]
+    return merged_starts, merged_stops, range_ids
+
+
+def _gather_ranges(buffer: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Concatenates buffer[start:start + length] for each range."""
+    total = lengths.sum()
+    offsets = np.cumsum(lengths) - lengths
+    if len(starts) == 1 or (total == len(buffer) and np.array_equal(starts, offsets)):
+        # a single range or ranges that cover buffer in order
+        return buffer[starts[0] : starts[0] + total]
+    return buffer[np.repeat(starts - offsets, lengths) + np.arange(total)]
+
+
+def get_chunk_size(arrays: Sequence) -> Union[int, None]:
+    """Returns the largest chunk length of chunked zarr or h5py arrays or None."""
+    chunk_sizes = [
+        array.chunks[0] for array in arrays if getattr(array, "chunks", None) is not None
+    ]
+    return max(chunk_sizes) if len(chunk_sizes) > 0 else None
+
+
+def read_ranges(
+    arrays: Sequence, starts: np.ndarray, stops: np.ndarray, max_gap: int = max_gap
+) -> list:
+    """Reads array[start:stop] for each range and array and concatenates the results per array.
+
+    Ranges must be sorted by start and stop. Nearby ranges and ranges that share a chunk are
+    coalesced into a single read and reads are issued concurrently.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    if len(starts) == 0:
+        return [array[0:0] for array in arrays]
+    merged_starts, merged_stops, range_ids = coalesce_ranges(
+        starts, stops, max_gap, get_chunk_size(arrays)
+    )
+    futures = [
+        [
+            executor.submit(array.__getitem__, slice(start, stop))
+            for start, stop in zip(merged_starts, merged_stops)
+        ]
+        for array in arrays
+    ]
+    merged_offsets = np.cumsum(merged_stops - merged_starts) - (merged_stops - merged_starts)
+    buffer_starts = merged_offsets[range_ids] + starts - merged_starts[range_ids]
+    lengths = stops - starts
+    results = []
+    for array_futures in futures:
+        chunks = [future.result() for future in array_futures]
+        buffer = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        results.append(_gather_ranges(buffer, buffer_starts, lengths))
+    return results
+
+
 def get_compressed_vectors(
-    x: BackedSparseMatrix, row_idxs: Iterable[int]
+    x: BackedSparseMatrix, row_idxs: Iterable[int], max_gap: int = max_gap
 ) -> Tuple[Sequence, Sequence, Sequence]:
-    slices = [slice(*(x.indptr[i : i + 2])) for i in row_idxs]
-    data = np.concatenate([x.data[s] for s in slices])
-    indices = np.concatenate([x.indices[s] for s in slices])
-    indptr = list(accumulate(chain((0,), (s.stop - s.start for s in slices))))
+    row_idxs = np.asarray(row_idxs, dtype=np.int64).ravel()
+    # read each distinct vector once and in storage order
+    unique_idxs, inverse = np.unique(row_idxs, return_inverse=True)
+    if isinstance(x.indptr, np.ndarray):
+        starts = x.indptr[unique_idxs]
+        stops = x.indptr[unique_idxs + 1]
+    else:
+        bounds = read_ranges([x.indptr], unique_idxs, unique_idxs + 2, max_gap)[0]
+        # each range contributes the start and stop of one vector
+        bounds_offsets = 2 * np.arange(len(unique_idxs))
+        starts = bounds[bounds_offsets]
+        stops = bounds[bounds_offsets + 1]
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    data, indices = read_ranges([x.data, x.indices], starts, stops, max_gap)
+    lengths = stops - starts
+    if len(unique_idxs) != len(row_idxs) or np.any(unique_idxs != row_idxs):
+        # scatter back in requested order
+        offsets = np.cumsum(lengths) - lengths
+        data = _gather_ranges(data, offsets[inverse], lengths[inverse])
+        indices = _gather_ranges(indices, offsets[inverse], lengths[inverse])
+        lengths = lengths[inverse]
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
     return data, indices, indptr
 
 
@@ -238,11 +337,15 @@ def get_backed_class(format_str: str) -> Type[BackedSparseMatrix]:
 
 
 class SparseDataset:
-    """Analogous to :class:`h5py.Dataset or zarr.Group`, but for sparse matrices."""
+    """Analogous to :class:`h5py.Dataset or zarr.Group`, but for sparse matrices.
 
-    def __init__(self, group):
+    :param group: Group storing the matrix
+    :param indptr: Optional in-memory copy of the group's indptr array
+    """
+
+    def __init__(self, group, indptr=None):
         self.group = group
-        self.indptr = None
+        self.indptr = indptr
 
     @property
     def dtype(self) -> np.dtype:
@@ -345,6 +448,7 @@ class SparseDataset:
         append_offset = indptr[-1]
         indptr.resize((orig_data_size + sparse_matrix.indptr.shape[0] - 1,))
         indptr[orig_data_size:] = sparse_matrix.indptr[1:].astype(np.int64) + append_offset
+        self.indptr = None
 
         # indices
         indices = self.group["indices"]
@@ -358,7 +462,7 @@ class SparseDataset:
         mtx.group = self.group
         mtx.data = self.group["data"]
         mtx.indices = self.group["indices"]
-        mtx.indptr = self.group["indptr"]
+        mtx.indptr = self.indptr if self.indptr is not None else self.group["indptr"]
         return mtx
 
     def to_memory(self) -> ss.spmatrix:
@@ -366,7 +470,7 @@ class SparseDataset:
         mtx = format_class(self.shape, dtype=self.dtype)
         mtx.data = self.group["data"][...]
         mtx.indices = self.group["indices"][...]
-        mtx.indptr = self.group["indptr"][...]
+        mtx.indptr = self.indptr.copy() if self.indptr is not None else self.group["indptr"][...]
         return mtx
 
 
@@ -7,6 +7,7 @@ import scipy.sparse
 from anndata import AnnData
 
 from cirrocumulus.abstract_dataset import AbstractDataset
+from cirrocumulus.anndata_util import subset_obs
 
 
 class TileDBDataset(AbstractDataset):
@@ -88,7 +89,7 @@ class TileDBDataset(AbstractDataset):
             schema_dict["var"] = pd.Index(array.query(attrs=["name_0"])[:]["name_0"])
         return schema_dict
 
-    def read_dataset(self, filesystem, path, keys=None, dataset=None):
+    def read_dataset(self, filesystem, path, keys=None, dataset=None, obs_indices=None):
         keys = keys.copy()
         var_keys = keys.pop("X", [])
         obs_keys = keys.pop("obs", [])
@@ -127,4 +128,4 @@ class TileDBDataset(AbstractDataset):
                     obsm[key] = array[:]
                     if X is None:
                         X = scipy.sparse.coo_matrix(([], ([], [])), shape=(array.shape[0], 0))
-        return AnnData(X=X, obs=obs, var=var, obsm=obsm)
+        return subset_obs(AnnData(X=X, obs=obs, var=var, obsm=obsm), obs_indices)
@@ -1,15 +1,27 @@
 import os
+import json
+import time
+import logging
+import itertools
 from urllib.parse import urlparse
 
 import numpy as np
 import fsspec
 import pandas as pd
 import pandas._libs.json as ujson
-from flask import make_response
+from flask import Response, make_response, request, stream_with_context
 
-from cirrocumulus.envir import CIRRO_DATASET_PROVIDERS
+from cirrocumulus.compression import compress_response
+from cirrocumulus.envir import (
+    CIRRO_DATASET_CACHE_SIZE,
+    CIRRO_DATASET_PROVIDERS,
+    CIRRO_FILE_CHUNK_SIZE,
+    CIRRO_RESPONSE_CACHE_SIZE,
+)
 
 
+logger = logging.getLogger("cirro")
+
 try:
     dumps = ujson.dumps
 except AttributeError:
@@ -56,6 +68,58 @@ def get_fs(path):
     return fsspec.filesystem(get_scheme(path), **fsspec_kwargs)
 
 
+# files that are rewritten last whenever a zarr or parquet dataset directory is prepared
+DATASET_VERSION_FILES = [".zmetadata", "index.json.gz"]
+
+
+def get_version(filesystem, path):
+    """Returns a token that changes when the file or directory at path is rewritten or None if
+    the filesystem does not provide one.
+
+    The version of a dataset directory is the version of a file that is rewritten on every
+    prepare as directories do not change when their files are rewritten and object stores do not
+    store a modification time for prefixes.
+    """
+    try:
+        info = filesystem.info(path)
+    except (FileNotFoundError, OSError):
+        return None
+    if info.get("type") == "directory":
+        for name in DATASET_VERSION_FILES:
+            version = get_version(filesystem, os.path.join(path, name))
+            if version is not None:
+                return version
+    for key in ["mtime", "etag", "ETag", "LastModified", "updated", "generation"]:
+        value = info.get(key)
+        if value is not None:
+            return str(value)
+    return None
+
+
+def get_dataset_cache_size():
+    return int(float(os.environ.get(CIRRO_DATASET_CACHE_SIZE, "512")) * 1024 * 1024)
+
+
+def get_file_chunk_size():
+    return int(float(os.environ.get(CIRRO_FILE_CHUNK_SIZE, "1")) * 1024 * 1024)
+
+
+def get_response_cache_size():
+    return int(float(os.environ.get(CIRRO_RESPONSE_CACHE_SIZE, "256")) * 1024 * 1024)
+
+
+def get_dataset_info_size(dataset_info):
+    """Estimates the number of bytes used by a dataset info dict."""
+    size = 1024
+    for key in ["var", "module"]:
+        index = dataset_info.get(key)
+        if isinstance(index, pd.Index):
+            size += index.memory_usage(deep=True)
+    for quantization in dataset_info.get("quantization", {}).values():
+        size += quantization["scale"].nbytes + quantization["offset"].nbytes
+    return size
+
+
 def open_file(urlpath, mode="rb", compression=None):
     return fsspec.open(urlpath, mode=mode, compression=compression, **fsspec_kwargs)
 
@@ -74,6 +138,174 @@ def json_response(data, response=200):
     return response
 
 
+BINARY_CONTENT_TYPE = "application/x-cirro-arrays"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+_binary_dtypes = {"b": "uint8", "f2": "float32", "i8": "float64", "u8": "float64"}
+
+
+def _add_buffer(values, buffers):
+    values = np.asarray(values)
+    dtype = _binary_dtypes.get(values.dtype.kind, _binary_dtypes.get(values.dtype.str[1:]))
+    if dtype == "float64" and values.size > 0 and values.dtype.kind in "iu":
+        if np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+            dtype = "int32"  # typed arrays do not support 64 bit integers
+    values = np.ascontiguousarray(values, dtype=np.dtype(dtype if dtype else values.dtype))
+    buffers.append(values.astype(values.dtype.newbyteorder("<"), copy=False))
+    return {"$buffer": len(buffers) - 1}
+
+
+def _replace_arrays(data, buffers):
+    if isinstance(data, dict):
+        return {key: _replace_arrays(value, buffers) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [_replace_arrays(value, buffers) for value in data]
+    if isinstance(data, (pd.Series, pd.Index)):
+        data = data.values
+    if isinstance(data, np.ndarray) and data.dtype.kind in "biuf":
+        return _add_buffer(data, buffers)
+    return data
+
+
+def to_binary(data):
+    """Serializes data to a binary container that keeps numeric arrays as typed buffers.
+
+    The container consists of the little endian uint32 length of a JSON header followed by the
+    header and the buffers, each aligned to 8 bytes. Numeric arrays in data are replaced by
+    {"$buffer": index} in the header and header["buffers"][index] contains the dtype, byte
+    offset, and number of elements of the buffer. Buffers of arrays with more than one dimension
+    are stored in row-major order and their descriptor also contains the shape of the array.
+    """
+    buffers = []
+    header = dict(data=_replace_arrays(data, buffers), buffers=[])
+    offset = 0
+    for values in buffers:
+        descriptor = dict(dtype=values.dtype.name, offset=offset, length=values.size)
+        if values.ndim != 1:
+            descriptor["shape"] = list(values.shape)
+        header["buffers"].append(descriptor)
+        offset += values.nbytes + (-values.nbytes % 8)
+    header_bytes = dumps(header, double_precision=6, orient="values").encode("utf-8")
+    header_bytes += b" " * (-(len(header_bytes) + 4) % 8)
+    chunks = [np.uint32(len(header_bytes)).astype("<u4").tobytes(), header_bytes]
+    for values in buffers:
+        chunks.append(memoryview(values).cast("B"))
+        chunks.append(b"\0" * (-values.nbytes % 8))
+    return b"".join(chunks)
+
+
+def from_binary(content):
+    """Deserializes content created by to_binary."""
+    header_length = int(np.frombuffer(content, dtype="<u4", count=1)[0])
+    header = json.loads(bytes(content[4 : 4 + header_length]))
+    start = 4 + header_length
+    buffers = [
+        np.frombuffer(
+            content,
+            dtype=np.dtype(b["dtype"]).newbyteorder("<"),
+            count=b["length"],
+            offset=start + b["offset"],
+        ).reshape(b.get("shape", -1))
+        for b in header["buffers"]
+    ]
+
+    def replace_buffers(data):
+        if isinstance(data, dict):
+            if "$buffer" in data:
+                return buffers[data["$buffer"]]
+            return {key: replace_buffers(value) for key, value in data.items()}
+        if isinstance(data, list):
+            return [replace_buffers(value) for value in data]
+        return data
+
+    return replace_buffers(header["data"])
+
+
+def get_data_content_type():
+    """Returns the requested content type for data responses."""
+    content_type = request.accept_mimetypes.best_match(
+        ["application/json", BINARY_CONTENT_TYPE, NDJSON_CONTENT_TYPE]
+    )
+    return content_type if content_type is not None else "application/json"
+
+
+def serialize_data(data, content_type):
+    if content_type == BINARY_CONTENT_TYPE:
+        return to_binary(data)
+    return dumps(data, double_precision=2, orient="values").encode("utf-8")
+
+
+def data_response(data, response=200):
+    """Returns data as JSON or in the format created by to_binary if the client accepts it."""
+    content_type = get_data_content_type()
+    if content_type != BINARY_CONTENT_TYPE:
+        content_type = "application/json"
+    response = make_response(serialize_data(data, content_type), response)
+    response.headers["Content-Type"] = content_type
+    response.vary.add("Accept")
+    return compress_response(response)
+
+
+def stream_response(items):
+    """Streams (path, value) pairs as newline delimited JSON [path, value] arrays.
+
+    Each pair is serialized as soon as it is produced. The first pair is computed before the
+    response is returned so that errors in validating the request or reading the dataset produce
+    an error status. Errors raised after the response starts are logged and end the stream with an
+    [["error"], message] line.
+    """
+    start = time.perf_counter()
+    items = iter(items)
+    first_item = next(items, None)
+
+    def to_line(path, value):
+        return (dumps([list(path), value], double_precision=2, orient="values") + "\n").encode(
+            "utf-8"
+        )
+
+    def generate():
+        first_byte_time = time.perf_counter() - start
+        nbytes = 0
+        if first_item is not None:
+            try:
+                for path, value in itertools.chain([first_item], items):
+                    line = to_line(path, value)
+                    nbytes += len(line)
+                    yield line
+            except Exception as e:
+                logger.exception("Error streaming data")
+                yield to_line(("error",), str(e))
+        logger.info(
+            "Streamed {:,} bytes, time to first byte {:.3f}s, total {:.3f}s".format(
+                nbytes, first_byte_time, time.perf_counter() - start
+            )
+        )
+
+    return Response(stream_with_context(generate()), content_type=NDJSON_CONTENT_TYPE)
+
+
+class WriteProgress:
+    """Logs the number of features written and the write throughput."""
+
+    def __init__(self, name, total, interval=1000):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.values = 0
+        self.start = time.perf_counter()
+
+    def update(self, nvalues):
+        self.count += 1
+        self.values += nvalues
+        if self.count % self.interval == 0 or self.count == self.total:
+            elapsed = max(time.perf_counter() - self.start, 1e-9)
+            logger.info(
+                "Wrote {} {}/{} ({:.0f} features/s, {:.0f} values/s)".format(
+                    self.name, self.count, self.total, self.count / elapsed, self.values / elapsed
+                )
+            )
+
+
 def get_email_domain(email):
     at_index = email.find("@")
     domain = None
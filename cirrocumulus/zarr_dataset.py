@@ -6,6 +6,16 @@ from cirrocumulus.abstract_backed_dataset import AbstractBackedDataset
 from cirrocumulus.anndata_util import dataset_schema
 
 
+def open_zarr_group(filesystem, path):
+    """Opens a zarr group read-only using consolidated metadata when available so that the
+    metadata of all groups and arrays is fetched in a single request."""
+    store = filesystem.get_mapper(path)
+    try:
+        return zarr.open_consolidated(store, mode="r")
+    except KeyError:  # no consolidated metadata
+        return zarr.open_group(store, mode="r")
+
+
 class ZarrDataset(AbstractBackedDataset):
     def __init__(self):
         super().__init__()
@@ -17,13 +27,13 @@ class ZarrDataset(AbstractBackedDataset):
         return isinstance(node, zarr.hierarchy.Group)
 
     def open_group(self, filesystem, path):
-        return zarr.open_group(filesystem.get_mapper(path), mode="r")
+        return open_zarr_group(filesystem, path)
 
     def slice_dense_array(self, X, indices):
         return X.get_orthogonal_selection((slice(None), indices))
 
     def get_schema(self, filesystem, path):
-        g = zarr.open_group(filesystem.get_mapper(path), mode="r")
+        g = open_zarr_group(filesystem, path)
         if "cirro-schema" in g["uns"]:
             s = str(g["uns"]["cirro-schema"][()])
             return json.loads(s)
@@ -1,11 +1,109 @@
+import math
+import logging
+
 import zarr
+import numcodecs
+import scipy.sparse
 
-from cirrocumulus.anndata_util import ADATA_MODULE_UNS_KEY, get_pegasus_marker_keys
-from cirrocumulus.anndata_zarr import write_attribute
+from cirrocumulus.anndata_util import ADATA_MODULE_UNS_KEY, X_CSR_UNS_KEY, get_pegasus_marker_keys
+from cirrocumulus.anndata_zarr import write_attribute, write_series
 from cirrocumulus.util import dumps
 
 
-def save_dataset_zarr(dataset, schema, output_directory, filesystem, whitelist):
+logger = logging.getLogger("cirro")
+
+COMPRESSORS = ["blosc-lz4", "blosc-zstd", "zstd", "lz4"]
+# bounds on the number of elements in a chunk of a matrix
+min_chunk_size = 1 << 16
+max_chunk_size = 1 << 22
+
+
+def get_compressor(name, level=None):
+    """Returns a numcodecs compressor. level is the compression level for blosc and zstd and the
+    acceleration for lz4."""
+    if name.startswith("blosc-"):
+        return numcodecs.Blosc(
+            cname=name[len("blosc-") :],
+            clevel=5 if level is None else level,
+            shuffle=numcodecs.Blosc.SHUFFLE,
+        )
+    if name == "zstd":
+        return numcodecs.Zstd(level=3 if level is None else level)
+    if name == "lz4":
+        return numcodecs.LZ4(acceleration=1 if level is None else level)
+    raise ValueError("Unknown compressor {}".format(name))
+
+
+def get_matrix_chunks(X, features_per_chunk):
+    """Returns the chunk shape of a feature-major matrix so that a chunk holds features_per_chunk
+    features on average.
+
+    Zarr chunks are fixed size, so chunks of sparse matrices are sized from the mean number of
+    non-zero values per feature rather than aligned to individual features.
+    """
+    if scipy.sparse.issparse(X):
+        values_per_feature = X.nnz / max(1, X.shape[1])
+        chunk_size = math.ceil(values_per_feature * features_per_chunk)
+        return (min(max_chunk_size, max(min_chunk_size, chunk_size)),)
+    features_per_chunk = min(max(1, X.shape[1]), features_per_chunk)
+    rows = min(max(1, X.shape[0]), max(1, max_chunk_size // features_per_chunk))
+    return rows, features_per_chunk
+
+
+def write_matrix(group, key, X, dataset_kwargs, features_per_chunk=None):
+    """Writes a feature-major matrix.
+
+    Readers plan chunk-aligned reads from the chunk shape stored in the zarr array metadata.
+    """
+    if features_per_chunk is not None and (
+        scipy.sparse.isspmatrix_csc(X) or not scipy.sparse.issparse(X)
+    ):
+        dataset_kwargs = dict(dataset_kwargs, chunks=get_matrix_chunks(X, features_per_chunk))
+    write_attribute(group, key, X, dataset_kwargs)
+
+
+def remove_stale(group, keys):
+    """Removes members of group that are not in keys."""
+    keys = set(keys)
+    for key in list(group.keys()):
+        if key not in keys:
+            logger.info("Removing {}".format(group[key].name))
+            del group[key]
+
+
+def write_obs_columns(obs_group, obs, keys, dataset_kwargs):
+    """Writes the given columns to an existing obs group and removes columns not in obs."""
+    index_key = obs_group.attrs["_index"]
+    for key in list(obs_group.keys()):
+        if key not in obs.columns and key not in (index_key, "__categories"):
+            del obs_group[key]
+    if "__categories" in obs_group:
+        for key in list(obs_group["__categories"].keys()):
+            if key not in obs.columns or key in keys:
+                del obs_group["__categories"][key]
+    for key in keys:
+        if key in obs_group:
+            del obs_group[key]
+        write_series(obs_group, key, obs[key], dataset_kwargs)
+    obs_group.attrs["column-order"] = list(obs.columns)
+
+
+def save_dataset_zarr(
+    dataset,
+    schema,
+    output_directory,
+    filesystem,
+    whitelist,
+    X_csr=None,
+    compressor=None,
+    features_per_chunk=None,
+):
+    """Saves a dataset in zarr format.
+
+    :param compressor: Optional numcodecs compressor for all arrays
+    :param features_per_chunk: Optional target number of features per chunk of X and layers.
+        Embeddings are also stored in as few chunks as possible when given.
+    """
     module_dataset = None
     if dataset.uns.get(ADATA_MODULE_UNS_KEY) is not None:
         module_dataset = dataset.uns[ADATA_MODULE_UNS_KEY]
@@ -19,18 +117,51 @@ def save_dataset_zarr(dataset, schema, output_directory, filesystem, whitelist):
 
     dataset.uns["cirro-schema"] = dumps(schema, double_precision=2, orient="values")
     group = zarr.open_group(filesystem.get_mapper(output_directory), mode="a")
-
+    dataset_kwargs = dict(compressor=compressor) if compressor is not None else {}
+    matrix_keys = whitelist.get("matrix_keys")
     if whitelist["x"]:
-        write_attribute(group, "X", dataset.X)
+        if matrix_keys is None or "X" in matrix_keys:
+            write_matrix(group, "X", dataset.X, dataset_kwargs, features_per_chunk)
+            csr_key = "uns/{}".format(X_CSR_UNS_KEY)
+            if X_csr is not None:
+                write_attribute(group, csr_key, X_csr, dataset_kwargs)
+            elif csr_key in group:  # remove stale copy
+                del group[csr_key]
+        if matrix_keys is not None and "layers" in group:
+            remove_stale(group["layers"], dataset.layers.keys())
         for layer in dataset.layers.keys():
-            write_attribute(group, "layers/{}".format(layer), dataset.layers[layer])
+            if matrix_keys is None or "layers/" + layer in matrix_keys:
+                write_matrix(
+                    group,
+                    "layers/{}".format(layer),
+                    dataset.layers[layer],
+                    dataset_kwargs,
+                    features_per_chunk,
+                )
         if module_dataset is not None:
-            write_attribute(group, "uns/module/X", module_dataset.X)
-            write_attribute(group, "uns/module/var", module_dataset.var)
+            write_attribute(group, "uns/module/X", module_dataset.X, dataset_kwargs)
+            write_attribute(group, "uns/module/var", module_dataset.var, dataset_kwargs)
     if whitelist["obs"]:
-        write_attribute(group, "obs", dataset.obs)
+        if whitelist["obs_keys"] is not None and "obs" in group:
+            write_obs_columns(group["obs"], dataset.obs, whitelist["obs_keys"], dataset_kwargs)
+        else:
+            write_attribute(group, "obs", dataset.obs, dataset_kwargs)
     if whitelist["obsm"]:
-        write_attribute(group, "obsm", dataset.obsm)
+        obsm_keys = whitelist["obsm_keys"]
+        if "obsm" in group:  # remove stale embeddings
+            if obsm_keys is None:
+                del group["obsm"]
+            else:
+                remove_stale(group["obsm"], dataset.obsm.keys())
+        for key in dataset.obsm.keys():
+            if obsm_keys is not None and key not in obsm_keys:
+                continue
+            m = dataset.obsm[key]
+            obsm_kwargs = dict(dataset_kwargs)
+            if features_per_chunk is not None and len(m.shape) == 2 and m.shape[0] > 0:
+                # each embedding is read in full
+                obsm_kwargs["chunks"] = (min(m.shape[0], max_chunk_size // m.shape[1]), m.shape[1])
+            write_attribute(group, "obsm/{}".format(key), m, obsm_kwargs)
 
     pg_marker_keys = get_pegasus_marker_keys(dataset)
     for key in list(dataset.varm.keys()):
@@ -57,3 +188,5 @@ def save_dataset_zarr(dataset, schema, output_directory, filesystem, whitelist):
     for key in list(dataset.uns.keys()):
         # need to write individual groups so don't overwrite uns
         write_attribute(group, "uns/{}".format(key), dataset.uns[key])
+    # readers open the dataset with a single metadata request
+    zarr.consolidate_metadata(group.store)
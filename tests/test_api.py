@@ -1,12 +1,22 @@
 import os
+import gzip
+import json
 
+import numpy as np
+import fsspec
 import pytest
 import anndata
 
-from cirrocumulus.envir import CIRRO_DB_URI, CIRRO_TEST
+from cirrocumulus import data_processing
+from cirrocumulus.api import response_cache, send_file
+from cirrocumulus.compression import get_compression_level, get_encoding
+from cirrocumulus.data_processing import add_data_item
+from cirrocumulus.envir import CIRRO_COMPRESS, CIRRO_DB_URI, CIRRO_TEST
 from cirrocumulus.launch import configure_app, create_app
+from cirrocumulus.mask_encoding import decode_mask
 from cirrocumulus.prepare_data import PrepareData
 from cirrocumulus.serve import cached_app
+from cirrocumulus.util import BINARY_CONTENT_TYPE, NDJSON_CONTENT_TYPE, from_binary, to_binary
 
 
 @pytest.fixture(scope="session", params=[True, False])
@@ -51,3 +61,171 @@ def test_schema(app_conf):
     assert isinstance(r["embeddings"], list)
     assert len(r["obsCat"]) == 1 and r["obsCat"][0] == "louvain"
     assert r["shape"][0] == 2638 and r["shape"][1] == 1838
+
+
+def test_selected_ids(app_conf):
+    client, dataset_id = app_conf
+    data_filter = {"filters": [{"field": "louvain", "operation": "in", "value": ["1"]}]}
+    ids = client.post("/api/selected_ids", json=dict(id=dataset_id, filter=data_filter)).json
+    r = client.post("/api/selected_ids", json=dict(id=dataset_id, filter=data_filter, encode=True))
+    mask = decode_mask(r.json["selection"], 2638)
+    assert mask.sum() == len(ids["ids"])
+
+
+def test_binary_data(app_conf):
+    client, dataset_id = app_conf
+    data = dict(
+        id=dataset_id, values=dict(measures=["DSCR3", "obs/n_genes"], dimensions=["louvain"])
+    )
+    json_result = client.post("/api/data", json=data).json
+    r = client.post("/api/data", json=data, headers={"Accept": BINARY_CONTENT_TYPE})
+    assert r.headers["Content-Type"] == BINARY_CONTENT_TYPE
+    result = from_binary(r.data)
+    assert json_result["values"].keys() == result["values"].keys()
+    louvain = result["values"]["louvain"]
+    assert louvain["categories"] == json_result["values"]["louvain"]["categories"]
+    np.testing.assert_array_equal(louvain["values"], json_result["values"]["louvain"]["values"])
+    np.testing.assert_array_equal(result["values"]["n_genes"], json_result["values"]["n_genes"])
+    dscr3 = result["values"]["DSCR3"]
+    if isinstance(dscr3, dict):
+        assert dscr3["values"].dtype == np.float32
+        np.testing.assert_array_equal(dscr3["indices"], json_result["values"]["DSCR3"]["indices"])
+        dscr3 = dscr3["values"]
+        expected = json_result["values"]["DSCR3"]["values"]
+    else:
+        expected = json_result["values"]["DSCR3"]
+    np.testing.assert_allclose(dscr3, expected, atol=0.01)
+
+
+def test_binary_shape():
+    matrix = np.arange(12, dtype=np.float32).reshape(3, 4)
+    result = from_binary(
+        to_binary(dict(matrix=matrix, columns=np.asfortranarray(matrix), values=np.arange(3)))
+    )
+    np.testing.assert_array_equal(result["matrix"], matrix)
+    np.testing.assert_array_equal(result["columns"], matrix)
+    np.testing.assert_array_equal(result["values"], np.arange(3))
+
+
+def test_stream_data(app_conf):
+    client, dataset_id = app_conf
+    data = dict(
+        id=dataset_id,
+        values=dict(measures=["DSCR3", "obs/n_genes"], dimensions=["louvain"]),
+        embedding=[dict(name="X_umap")],
+        groupedStats=dict(measures=["DSCR3"], dimensions=["louvain"]),
+    )
+    json_result = client.post("/api/data", json=data).json
+    r = client.post("/api/data", json=data, headers={"Accept": NDJSON_CONTENT_TYPE})
+    assert r.headers["Content-Type"] == NDJSON_CONTENT_TYPE
+    result = {}
+    for line in r.data.decode("utf-8").splitlines():
+        path, value = json.loads(line)
+        add_data_item(result, path, value)
+    assert result == json_result
+
+
+def test_data_response_cache(app_conf):
+    client, dataset_id = app_conf
+    data = dict(id=dataset_id, values=dict(measures=["DSCR3"], dimensions=["louvain"]))
+    r = client.post("/api/data", json=data)
+    etag = r.headers["ETag"]
+    hits = response_cache.cache.hits
+    r2 = client.post("/api/data", json=dict(values=data["values"], id=dataset_id))
+    assert response_cache.cache.hits == hits + 1
+    assert r2.headers["ETag"] == etag and r2.data == r.data
+    r3 = client.post("/api/data", json=data, headers={"If-None-Match": etag})
+    assert r3.status_code == 304 and r3.data == b""
+
+
+def test_precompressed_response(app_conf):
+    client, dataset_id = app_conf
+    data = dict(id=dataset_id, values=dict(measures=["SUMO3"], dimensions=["louvain"]))
+    for method, url, kwargs in [
+        ("get", "/api/schema?id={}".format(dataset_id), {}),
+        ("post", "/api/data", dict(json=data)),
+    ]:
+        r = getattr(client, method)(url, **kwargs)
+        headers = {"Accept-Encoding": "gzip"}
+        for i in range(2):
+            r_gzip = getattr(client, method)(url, headers=headers, **kwargs)
+            assert r_gzip.headers["Content-Encoding"] == "gzip"
+            assert gzip.decompress(r_gzip.data) == r.data
+        assert r_gzip.get_etag()[0] in response_cache.cache  # compressed once
+    assert get_compression_level("gzip", 100 << 20) < get_compression_level("gzip", 1000)
+    # large content is not compressed at the highest level even if cached
+    assert get_compression_level("gzip", 100 << 20, cached=True) == get_compression_level(
+        "gzip", 100 << 20
+    )
+    assert get_compression_level("gzip", 1000, cached=True) == 9
+
+
+def test_compress_disabled(app_conf, monkeypatch):
+    client, dataset_id = app_conf
+    with client.application.test_request_context(headers={"Accept-Encoding": "gzip"}):
+        assert get_encoding() == "gzip"
+        monkeypatch.setenv(CIRRO_COMPRESS, "false")
+        assert get_encoding() is None
+
+
+@pytest.mark.parametrize("local", [True, False])
+def test_send_file_range(app_conf, tmp_path, local):
+    client, dataset_id = app_conf
+    content = bytes(range(256)) * 10
+    if local:
+        path = str(tmp_path / "image.bin")
+    else:
+        path = "memory://{}/image.bin".format(tmp_path.name)
+    with fsspec.open(path, "wb") as f:
+        f.write(content)
+    with client.application.test_request_context(headers={"Range": "bytes=10-19"}):
+        r = send_file(path)
+        r.direct_passthrough = False
+        assert r.status_code == 206
+        assert r.get_data() == content[10:20]
+        assert r.headers["Content-Range"] == "bytes 10-19/{}".format(len(content))
+        assert r.headers["Content-Length"] == "10"
+    with client.application.test_request_context():
+        r = send_file(path)
+        r.direct_passthrough = False
+        assert r.status_code == 200 and r.get_data() == content
+        etag = r.get_etag()[0]
+    if etag is not None:
+        with client.application.test_request_context(headers={"If-None-Match": etag}):
+            assert send_file(path).status_code == 304
+
+
+def test_schema_results(app_conf):
+    client, dataset_id = app_conf
+    results = client.get("/api/schema?id={}".format(dataset_id)).json["results"]
+    assert len(results) == 1 and "data" not in results[0]
+    r = client.get(
+        "/api/job?c=result&id={}&ds={}".format(results[0]["id"], dataset_id),
+        headers={"Accept-Encoding": "gzip"},
+    )
+    result = json.loads(gzip.decompress(r.data))
+    assert len(result["data"]) == 1838 and "groups" in result
+
+
+def test_stream_data_errors(app_conf, monkeypatch):
+    client, dataset_id = app_conf
+    data = dict(id=dataset_id, values=dict(measures=["DSCR3"]))
+    headers = {"Accept": NDJSON_CONTENT_TYPE}
+
+    def fail_before_first_item(**kwargs):
+        raise ValueError("invalid request")
+        yield
+
+    def fail_after_first_item(**kwargs):
+        yield ("values",), {}
+        raise ValueError("read failed")
+
+    # errors before the first item are raised before the response starts
+    monkeypatch.setitem(client.application.config, "PROPAGATE_EXCEPTIONS", False)
+    monkeypatch.setattr(data_processing, "iter_data", fail_before_first_item)
+    r = client.post("/api/data", json=data, headers=headers)
+    assert r.status_code == 500
+    monkeypatch.setattr(data_processing, "iter_data", fail_after_first_item)
+    r = client.post("/api/data", json=data, headers=headers)
+    lines = [json.loads(line) for line in r.data.decode("utf-8").splitlines()]
+    assert lines == [[["values"], {}], [["error"], "read failed"]]
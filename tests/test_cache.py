@@ -0,0 +1,202 @@
+import concurrent.futures
+
+import numpy as np
+import fsspec
+import pytest
+import scipy.sparse
+
+from cirrocumulus import abstract_backed_dataset
+from cirrocumulus import dataset_api as dataset_api_module
+from cirrocumulus.data_processing import get_mask
+from cirrocumulus.dataset_api import DatasetAPI
+from cirrocumulus.lru_cache import LRUCache
+from cirrocumulus.parquet_dataset import ParquetDataset
+from cirrocumulus.prepare_data import PrepareData
+from cirrocumulus.response_cache import ResponseCache
+from cirrocumulus.util import get_version
+from cirrocumulus.zarr_dataset import ZarrDataset
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(max_size=3, get_size=len)
+    cache.put("a", "x")
+    cache.put("b", "yy")
+    assert cache.get("a") == "x"
+    cache.put("c", "z")  # evicts b, the least recently used entry
+    assert cache.get("b") is None
+    assert cache.get("c") == "z"
+    cache.put("d", "toolarge")  # larger than cache, not stored
+    assert "d" not in cache
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 1
+    assert stats["size"] == 2
+
+
+def test_dataset_handle_cache(test_data, tmp_path):
+    output_dir = str(tmp_path / "test.zarr")
+    PrepareData(datasets=[test_data], output=output_dir, no_auto_groups=True).execute()
+    fs = fsspec.filesystem("file")
+    reader = ZarrDataset()
+    info = reader.get_dataset_info(fs, output_dir)
+    assert reader.get_dataset_info(fs, output_dir) is info
+    reader.read_dataset(fs, output_dir, keys=dict(X=["DSCR3"], obs=["louvain"]))
+    stats = reader.handle_cache.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 2
+    assert list(info["var"]) == list(test_data.var.index)
+
+
+def test_indptr_cache(test_data, tmp_path):
+    output_dir = str(tmp_path / "test.zarr")
+    test_data = test_data.copy()
+    test_data.X = scipy.sparse.csc_matrix(test_data.X)
+    PrepareData(datasets=[test_data], output=output_dir, no_auto_groups=True).execute()
+    fs = fsspec.filesystem("file")
+    reader = ZarrDataset()
+    indptrs = reader.get_dataset_handle(fs, output_dir)["indptrs"]
+    np.testing.assert_array_equal(indptrs["/X"], test_data.X.indptr)
+    keys = ["DSCR3", "SUMO3"]
+    adata = reader.read_dataset(fs, output_dir, keys=dict(X=keys))
+    np.testing.assert_array_equal(adata.X.toarray(), test_data[:, keys].X.toarray())
+    np.testing.assert_array_equal(indptrs["/X"], test_data.X.indptr)  # cached copy unchanged
+
+
+def test_concurrent_reads(test_data, measures, continuous_obs, basis, tmp_path, monkeypatch):
+    output_dir = str(tmp_path / "test.zarr")
+    PrepareData(datasets=[test_data.copy()], output=output_dir, no_auto_groups=True).execute()
+    fs = fsspec.filesystem("file")
+    keys = dict(X=measures, obs=["louvain"] + continuous_obs, basis=[basis])
+    with monkeypatch.context() as m:
+        m.setattr(
+            abstract_backed_dataset,
+            "executor",
+            concurrent.futures.ThreadPoolExecutor(max_workers=1),
+        )
+        expected = ZarrDataset().read_dataset(fs, output_dir, keys=keys)
+    reader = ZarrDataset()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: reader.read_dataset(fs, output_dir, keys=keys), range(8)))
+    expected_X = expected.X.toarray() if scipy.sparse.issparse(expected.X) else expected.X
+    for adata in results:
+        X = adata.X.toarray() if scipy.sparse.issparse(adata.X) else adata.X
+        np.testing.assert_array_equal(X, expected_X)
+        assert list(adata.var.index) == list(expected.var.index)
+        for key in keys["obs"]:
+            np.testing.assert_array_equal(adata.obs[key].values, expected.obs[key].values)
+        np.testing.assert_array_equal(adata.obsm[basis], expected.obsm[basis])
+
+
+def test_read_error(test_data, tmp_path):
+    output_dir = str(tmp_path / "test.zarr")
+    PrepareData(datasets=[test_data.copy()], output=output_dir, no_auto_groups=True).execute()
+    fs = fsspec.filesystem("file")
+
+    class FailingDataset(ZarrDataset):
+        def read_obs_values(self, group, key, obs_indices=None):
+            raise ValueError("Unable to read {}".format(key))
+
+    reader = FailingDataset()
+    with pytest.raises(ValueError, match="Unable to read louvain"):
+        reader.read_dataset(fs, output_dir, keys=dict(obs=["louvain"]))
+    # the failed read released its slot
+    semaphore = reader.get_dataset_handle(fs, output_dir)["semaphore"]
+    for _ in range(abstract_backed_dataset.max_dataset_reads):
+        assert semaphore.acquire(blocking=False)
+
+
+def test_response_cache_directory(tmp_path):
+    key = ResponseCache.get_key("test.zarr", "1", dict(b=1, a=[1, 2]))
+    assert key == ResponseCache.get_key("test.zarr", "1", dict(a=[1, 2], b=1))
+    cache = ResponseCache(max_size=1024, directory=str(tmp_path))
+    cache.put(key, "application/json", b'{"a":1}')
+    # another process sharing the directory
+    assert ResponseCache(max_size=1024, directory=str(tmp_path)).get(key) == (
+        "application/json",
+        b'{"a":1}',
+    )
+    assert cache.get("missing") is None
+
+
+@pytest.mark.parametrize(
+    "file_format,version_file", [("zarr", ".zmetadata"), ("parquet", "index.json.gz")]
+)
+def test_directory_version(test_data, file_format, version_file, tmp_path):
+    output_dir = str(tmp_path / ("test.zarr" if file_format == "zarr" else "test.cpq"))
+    PrepareData(
+        datasets=[test_data.copy()],
+        output=output_dir,
+        output_format=file_format,
+        no_auto_groups=True,
+    ).execute()
+
+    class ObjectStoreFileSystem(fsspec.implementations.local.LocalFileSystem):
+        # object stores do not store a modification time for prefixes
+        def info(self, path, **kwargs):
+            info = super().info(path, **kwargs)
+            if info["type"] == "directory":
+                info.pop("mtime", None)
+            return info
+
+    fs = ObjectStoreFileSystem()
+    version = get_version(fs, output_dir)
+    assert version is not None
+    assert version == get_version(fs, output_dir + "/" + version_file)
+
+
+def test_unknown_version_not_cached(test_data, tmp_path, monkeypatch):
+    output_dir = str(tmp_path / "test.zarr")
+    PrepareData(datasets=[test_data.copy()], output=output_dir, no_auto_groups=True).execute()
+    monkeypatch.setattr(dataset_api_module, "get_version", lambda filesystem, path: None)
+    monkeypatch.setattr(abstract_backed_dataset, "get_version", lambda filesystem, path: None)
+    reader = ZarrDataset()
+    dataset_api = DatasetAPI()
+    dataset_api.add(reader)
+    dataset = dict(id="", url=output_dir)
+    data_filter = dict(
+        filters=[dict(field="n_genes", operation=[">"], value=[1000])], combine="and"
+    )
+    for _ in range(2):
+        assert tuple(dataset_api.get_dataset_info(dataset)["shape"]) == test_data.shape
+        assert tuple(dataset_api.get_schema(dataset)["shape"]) == test_data.shape
+        masks, adata = get_mask(dataset_api, dataset, None, [data_filter])
+        assert adata is not None
+        np.testing.assert_array_equal(masks[0], (test_data.obs["n_genes"] > 1000).values)
+    for cache in [
+        dataset_api.dataset_info_cache,
+        dataset_api.schema_cache,
+        dataset_api.mask_cache,
+        reader.handle_cache,
+    ]:
+        assert len(cache) == 0
+        assert cache.stats()["hits"] == 0
+
+
+def test_schema_cache(test_data, tmp_path):
+    output_dir = str(tmp_path / "test.zarr")
+    PrepareData(datasets=[test_data.copy()], output=output_dir, no_auto_groups=True).execute()
+    dataset_api = DatasetAPI()
+    dataset_api.add(ZarrDataset())
+    dataset = dict(url=output_dir)
+    schema = dataset_api.get_schema(dataset)
+    schema["summary"] = "changed"  # copies are returned
+    schema["embeddings"].append(dict(name="changed"))
+    schema = dataset_api.get_schema(dataset)
+    assert "summary" not in schema
+    assert "changed" not in [embedding["name"] for embedding in schema["embeddings"]]
+    stats = dataset_api.schema_cache.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 1
+
+
+def test_schema_cache_results_without_name(tmp_path):
+    class Provider(ZarrDataset):
+        def get_schema(self, filesystem, path):
+            return dict(results=[dict(id="r1", data=[1, 2])])
+
+    dataset_api = DatasetAPI()
+    dataset_api.add(Provider())
+    dataset = dict(url=str(tmp_path / "test.zarr"))
+    assert dataset_api.get_schema(dataset)["results"] == [
+        dict(id="r1", name=None, type=None, content_type="application/json")
+    ]
+    assert dataset_api.get_result(dataset, "r1") == '{"data":[1,2]}'
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from cirrocumulus.anndata_dataset import AnndataDataset
+from cirrocumulus.anndata_util import combine_fields
+from cirrocumulus.data_processing import handle_data
+from cirrocumulus.dataset_api import DatasetAPI
+
+
+def test_dotplot(test_data, measures, dimensions):
+    dimensions = dimensions + [["louvain", "n_genes_bin"]]
+    test_data = test_data.copy()
+    test_data.obs["n_genes_bin"] = pd.cut(test_data.obs["n_genes"], 3, labels=["a", "b", "c"])
+    input_dataset = dict(id="dotplot", url="dotplot.h5ad")
+    provider = AnndataDataset()
+    provider.add_data(input_dataset["url"], test_data)
+    dataset_api = DatasetAPI()
+    dataset_api.add(provider)
+    results = handle_data(
+        dataset_api=dataset_api,
+        dataset=input_dataset,
+        grouped_stats=dict(measures=measures, dimensions=dimensions),
+    )["distribution"]
+    assert len(results) == len(dimensions)
+    X = test_data[:, measures].X
+    df = pd.DataFrame(X.toarray() if scipy.sparse.issparse(X) else X, columns=measures)
+    for result in results:
+        fields = result["name"].split("-")
+        df["group"] = test_data.obs[fields[0]].astype(str).values
+        for field in fields[1:]:
+            df["group"] = df["group"] + "-" + test_data.obs[field].astype(str).values
+        grouped = df.groupby("group")
+        mean = grouped.mean()
+        percent_expressed = grouped.agg(lambda x: 100 * (x != 0).sum() / len(x))
+        categories = list(result["categories"].astype(str))
+        assert sorted(categories) == list(mean.index)
+        for value in result["values"]:
+            np.testing.assert_allclose(
+                value["mean"], mean.loc[categories, value["name"]].values, rtol=1e-5
+            )
+            np.testing.assert_allclose(
+                value["percentExpressed"],
+                percent_expressed.loc[categories, value["name"]].values,
+            )
+
+
+def test_combine_fields():
+    obs = pd.DataFrame(
+        dict(
+            a=pd.Categorical(["x", "y", "x", None, "y"], categories=["y", "x", "unused"]),
+            b=[2, 1, 2, 1, 3],
+        )
+    )
+    series = combine_fields(obs, ["a", "b"], "_")
+    assert list(series.cat.categories) == ["y_1", "y_3", "x_2"]
+    expected = obs["a"].astype(str) + "_" + obs["b"].astype(str)
+    expected[obs["a"].isna()] = np.nan
+    pd.testing.assert_series_equal(
+        series.astype(object), expected.astype(object), check_names=False
+    )
+
+
+def test_combine_fields_overflow():
+    # the number of possible combinations of 5 fields with 10000 values each exceeds int64
+    n = 10000
+    rng = np.random.default_rng(0)
+    fields = ["f{}".format(i) for i in range(5)]
+    obs = pd.DataFrame({field: rng.permutation(n) for field in fields})
+    obs.loc[3, "f2"] = np.nan
+    series = combine_fields(obs, fields, "_")
+    expected = obs[fields[0]].astype(str)
+    for field in fields[1:]:
+        expected = expected + "_" + obs[field].astype(str)
+    expected[obs.isna().any(axis=1)] = np.nan
+    pd.testing.assert_series_equal(
+        series.astype(object), expected.astype(object), check_names=False
+    )
+    assert list(series.cat.categories) == sorted(
+        series.cat.categories, key=lambda name: tuple(float(value) for value in name.split("_"))
+    )
@@ -1,10 +1,19 @@
 import numpy as np
 import pandas as pd
+import pytest
 import scipy.sparse
 from pandas import CategoricalDtype
 
 from cirrocumulus.data_processing import handle_data
-from cirrocumulus.embedding_aggregator import EmbeddingAggregator
+from cirrocumulus.embedding_aggregator import (
+    EmbeddingAggregator,
+    groupby_agg,
+    mean_agg,
+    mode_agg,
+    purity_agg,
+    sparse_max_agg,
+    sparse_sum_agg,
+)
 
 
 def create_df(test_data, measures, dimensions, basis):
@@ -94,6 +103,33 @@ def test_no_binning(
         )
 
 
+@pytest.mark.parametrize("agg_function", ["max", "mean", "sum"])
+def test_groupby_agg(test_data, measures, dimensions, continuous_obs, agg_function):
+    sparse = scipy.sparse.issparse(test_data.X)
+    basis = dict(full_name="X_umap_bins", coordinate_columns=["X_umap_1", "X_umap_2"])
+    df = create_df(test_data, measures, dimensions + continuous_obs, basis)
+    sparse_agg = dict(max=sparse_max_agg, mean=mean_agg, sum=sparse_sum_agg)[agg_function]
+    agg_dict = {}
+    for key in measures:
+        if sparse:
+            df[key] = pd.arrays.SparseArray(df[key].values, fill_value=0)
+        agg_dict[key] = sparse_agg if sparse else agg_function
+    for key in continuous_obs:
+        agg_dict[key] = agg_function
+    for key in dimensions:
+        agg_dict[key] = (mode_agg, purity_agg)
+    EmbeddingAggregator.convert_coords_to_bin(
+        df, nbins=20, coordinate_columns=basis["coordinate_columns"], bin_name=basis["full_name"]
+    )
+    for key in basis["coordinate_columns"]:
+        agg_dict[key] = "min"
+    pd.testing.assert_frame_equal(
+        groupby_agg(df, basis["full_name"], agg_dict),
+        df.groupby(basis["full_name"]).agg(agg_dict),
+        rtol=1e-5,
+    )
+
+
 #
 # @pytest.fixture(autouse=True, params=['sum', 'mean', 'max'])
 # def agg_function(request):
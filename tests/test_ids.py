@@ -1,6 +1,10 @@
 import numpy as np
+import pandas as pd
+import anndata
+import scipy.sparse
 
-from cirrocumulus.data_processing import handle_selection_ids
+from cirrocumulus.data_processing import get_filter_expr, get_mask, handle_selection_ids
+from cirrocumulus.mask_encoding import decode_mask, encode_mask
 
 
 def test_dimension_filter(dataset_api, input_dataset, test_data):
@@ -25,3 +29,80 @@ def test_measure_filter(dataset_api, input_dataset, test_data):
     ids_summary = process_results["ids"]
     matched_data = test_data[test_data[:, "DSCR3"].X > 2]
     assert len(np.intersect1d(ids_summary, matched_data.obs.index)) == matched_data.shape[0]
+
+
+def test_filter_expr(dataset_api, input_dataset, test_data):
+    data_filter = {
+        "filters": [
+            {"field": "X/DSCR3", "operation": ["<=", "!="], "value": [1, 0.5]},
+            {"field": "louvain", "operation": "in", "value": ["1", "5"], "invert": True},
+            {"field": "obs/n_genes", "operation": [">="], "value": [1000]},
+        ],
+        "combine": "or",
+    }
+    masks, _ = get_mask(dataset_api, input_dataset, None, [data_filter])
+    X = test_data[:, "DSCR3"].X
+    X = (X.toarray() if scipy.sparse.issparse(X) else X)[:, 0]
+    expected = (
+        ((X <= 1) & (X != 0.5))
+        | ~test_data.obs["louvain"].isin(["1", "5"]).values
+        | (test_data.obs["n_genes"] >= 1000).values
+    )
+    np.testing.assert_array_equal(masks[0], expected)
+    stats = dataset_api.mask_cache.stats()
+    masks, adata = get_mask(dataset_api, input_dataset, None, [data_filter])
+    assert adata is None  # not read again
+    assert dataset_api.mask_cache.stats()["hits"] == stats["hits"] + 1
+    np.testing.assert_array_equal(masks[0], expected)
+
+
+def test_mask_encoding(dataset_api, input_dataset, test_data):
+    n = test_data.shape[0]
+    rng = np.random.default_rng(0)
+    for mask in [rng.random(n) > 0.5, np.arange(n) < 10, np.zeros(n, dtype=bool)]:
+        encoded = encode_mask(mask)
+        np.testing.assert_array_equal(decode_mask(encoded, n), mask)
+        results = handle_selection_ids(
+            dataset_api=dataset_api,
+            dataset=input_dataset,
+            data_filter={"filters": [{"field": "__index", "operation": "in", "value": encoded}]},
+            encode=True,
+        )
+        np.testing.assert_array_equal(decode_mask(results["selection"], n), mask)
+    assert "rle" in encode_mask(np.arange(n) < 10)
+    assert "bitmap" in encode_mask(rng.random(n) > 0.5)
+
+
+def test_mask_cache_key_computed_once(dataset_api, input_dataset, monkeypatch):
+    data_filter = {"filters": [{"field": "obs/n_genes", "operation": [">="], "value": [1234]}]}
+    calls = []
+    get_mask_cache_key = dataset_api.get_mask_cache_key
+
+    def counting_get_mask_cache_key(*args):
+        calls.append(args)
+        return get_mask_cache_key(*args)
+
+    monkeypatch.setattr(dataset_api, "get_mask_cache_key", counting_get_mask_cache_key)
+    get_mask(dataset_api, input_dataset, None, [data_filter, None])
+    assert len(calls) == 1
+
+
+def test_filter_duplicate_var_names():
+    adata = anndata.AnnData(
+        X=np.array([[1, 0, 0], [0, 2, 3]], dtype=np.float32),
+        var=pd.DataFrame(index=["a", "a", "b"]),
+    )
+    keep = get_filter_expr(adata, {"filters": [{"field": "a", "operation": [">"], "value": [0]}]})
+    np.testing.assert_array_equal(keep, [True, False])
+
+
+def test_mask_cache_key_size(dataset_api, input_dataset, test_data):
+    points = list(range(0, test_data.shape[0], 2))
+    data_filter = {"filters": [{"field": "__index", "operation": "in", "value": points}]}
+    key = dataset_api.get_mask_cache_key(input_dataset, data_filter)
+    assert len(key) == 64  # digest instead of the filter
+    assert key == dataset_api.get_mask_cache_key(
+        input_dataset, {"filters": [{"value": points, "operation": "in", "field": "__index"}]}
+    )
+    masks, _ = get_mask(dataset_api, input_dataset, None, [data_filter])
+    np.testing.assert_array_equal(np.where(masks[0])[0], points)
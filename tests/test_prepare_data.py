@@ -1,14 +1,25 @@
 import os
 
+import zarr
 import numpy as np
 import fsspec
 import pandas as pd
 import pytest
+import anndata
 import scipy.sparse
+import pyarrow.parquet as pq
 
-from cirrocumulus.parquet_dataset import ParquetDataset
-from cirrocumulus.prepare_data import PrepareData
-from cirrocumulus.zarr_dataset import ZarrDataset
+from cirrocumulus import abstract_backed_dataset
+from cirrocumulus.anndata_util import ADATA_LAYERS_UNS_KEY, X_CSR_UNS_KEY, get_feature_values
+from cirrocumulus.incremental import HASHES_FILE, read_component_hashes
+from cirrocumulus.out_of_core import read_h5ad
+from cirrocumulus.parquet_dataset import ParquetDataset, get_obs_values
+from cirrocumulus.parquet_output import save_data_obs
+from cirrocumulus.prepare_data import PrepareData, main
+from cirrocumulus.quantization import dequantize, quantize
+from cirrocumulus.util import get_fs
+from cirrocumulus.zarr_dataset import ZarrDataset, open_zarr_group
+from cirrocumulus.zarr_output import get_matrix_chunks
 
 
 def read_and_diff(ds_reader, path, test_data, measures, dimensions, continuous_obs, basis):
@@ -95,3 +106,349 @@ def test_prepare_jsonl(test_data, measures, dimensions, continuous_obs, basis, t
         datasets=[test_data], output=os.path.join(output_dir, "test.jsonl"), output_format="jsonl"
     )
     prepare_data.execute()
+
+
+@pytest.mark.parametrize("obs_indices", [[0, 5, 10], slice(None, -1)])
+def test_prepare_csr(test_data, measures, dimensions, tmp_path, obs_indices):
+    output_dir = str(tmp_path / "test.zarr")
+    test_data = test_data[:, measures].copy()
+    test_data.X = scipy.sparse.csc_matrix(test_data.X)
+    obs_indices = np.arange(test_data.shape[0])[obs_indices]
+    PrepareData(datasets=[test_data], output=output_dir, output_format="zarr", csr=True).execute()
+    prepared_adata = ZarrDataset().read_dataset(
+        filesystem=fsspec.filesystem("file"),
+        path=output_dir,
+        dataset=dict(id=""),
+        keys=dict(X=measures, obs=dimensions),
+        obs_indices=obs_indices,
+    )
+    np.testing.assert_equal(prepared_adata.X.toarray(), test_data.X[obs_indices].toarray())
+    for key in dimensions:
+        pd.testing.assert_series_equal(
+            test_data.obs[key].iloc[obs_indices],
+            prepared_adata.obs[key],
+            check_index=False,
+            check_flags=False,
+        )
+
+
+def test_prepare_csr_slice(test_data, tmp_path, monkeypatch):
+    output_dir = str(tmp_path / "test.zarr")
+    test_data = test_data.copy()
+    test_data.X = scipy.sparse.csc_matrix(test_data.X)
+    PrepareData(datasets=[test_data], output=output_dir, output_format="zarr", csr=True).execute()
+    groups = []
+
+    class RecordingSparseDataset(abstract_backed_dataset.SparseDataset):
+        def __init__(self, group, indptr=None):
+            super().__init__(group, indptr)
+            groups.append(group.name)
+
+    monkeypatch.setattr(abstract_backed_dataset, "SparseDataset", RecordingSparseDataset)
+    # a slice of all features in two cells is read from the cell-major copy
+    n_features = test_data.shape[1]
+    prepared_adata = ZarrDataset().read_dataset(
+        filesystem=fsspec.filesystem("file"),
+        path=output_dir,
+        dataset=dict(id=""),
+        keys=dict(X=[slice(0, n_features)]),
+        obs_indices=np.array([0, 1]),
+    )
+    assert groups == ["/uns/{}".format(X_CSR_UNS_KEY)]
+    np.testing.assert_equal(prepared_adata.X.toarray(), test_data.X[[0, 1]].toarray())
+
+
+def test_prepare_bundle(test_data, measures, tmp_path):
+    output_dir = str(tmp_path / "test.cpq")
+    test_data = test_data.copy()
+    sparse = scipy.sparse.issparse(test_data.X)
+    test_data.layers["counts"] = test_data.X.copy()
+    PrepareData(
+        datasets=[test_data], output=output_dir, output_format="parquet", bundle=True
+    ).execute()
+    assert not os.path.exists(os.path.join(output_dir, "X"))
+    keys = [measures[2], measures[0]]
+    adata = ParquetDataset().read_dataset(
+        filesystem=fsspec.filesystem("file"),
+        path=output_dir,
+        dataset=dict(id=""),
+        keys=dict(X=keys, counts=[slice(0, 3)]),
+    )
+    counts = adata.uns[ADATA_LAYERS_UNS_KEY]["counts"]
+    assert list(counts.var.index) == list(test_data.var.index[0:3])
+    assert scipy.sparse.issparse(adata.X) == sparse
+    if sparse:
+        test_data.X = test_data.X.toarray()
+        adata.X = adata.X.toarray()
+        counts.X = counts.X.toarray()
+    np.testing.assert_equal(adata.X, test_data[:, keys].X)
+    np.testing.assert_equal(counts.X, test_data.X[:, 0:3])
+
+
+def test_prepare_no_bundle_probe(test_data, measures, tmp_path, monkeypatch):
+    output_dir = str(tmp_path / "test.cpq")
+    PrepareData(datasets=[test_data.copy()], output=output_dir, output_format="parquet").execute()
+
+    def get_bundle(*args):
+        raise AssertionError("per-feature layout should not look for a bundle")
+
+    reader = ParquetDataset()
+    monkeypatch.setattr(reader, "get_bundle", get_bundle)
+    adata = reader.read_dataset(
+        filesystem=fsspec.filesystem("file"),
+        path=output_dir,
+        dataset=dict(id=""),
+        keys=dict(X=[measures[0]]),
+    )
+    assert adata.shape == (test_data.shape[0], 1)
+
+
+def test_save_data_obs_types(tmp_path):
+    obs = pd.DataFrame(
+        dict(
+            cluster=pd.Categorical(["b", None, "a", "b"], categories=["b", "a", "c"], ordered=True),
+            count=np.array([1, 2, 300, 4], dtype=np.int64),
+            score=np.array([0.5, 1.0, np.nan, 2.0]),
+            exact=np.array([0.1, 0.2, 0.3, 0.4]),
+        )
+    )
+    adata = anndata.AnnData(obs=obs)
+    save_data_obs(adata, str(tmp_path), fsspec.filesystem("file"))
+    expected_types = dict(
+        cluster="dictionary<values=string, indices=int32, ordered=1>",
+        count="uint16",
+        score="float",
+        exact="double",
+    )
+    for name in obs.columns:
+        table = pq.read_table(os.path.join(str(tmp_path), name + ".parquet"))
+        assert str(table.schema.field("value").type) == expected_types[name]
+        values = get_obs_values(table)
+        pd.testing.assert_series_equal(pd.Series(values, name=name), obs[name], check_index=False)
+
+
+@pytest.mark.parametrize("x_dtype", ["float32", "float16", "uint16"])
+@pytest.mark.parametrize("file_format", ["zarr", "parquet", "bundle"])
+def test_prepare_x_dtype(test_data, measures, x_dtype, file_format, tmp_path):
+    output_dir = str(tmp_path / "test.{}".format("zarr" if file_format == "zarr" else "cpq"))
+    test_data = test_data[:, measures].copy()
+    test_data.layers["counts"] = test_data.X.copy()
+    PrepareData(
+        datasets=[test_data.copy()],
+        output=output_dir,
+        output_format="zarr" if file_format == "zarr" else "parquet",
+        bundle=file_format == "bundle",
+        x_dtype=x_dtype,
+        no_auto_groups=True,
+    ).execute()
+    reader = ZarrDataset() if file_format == "zarr" else ParquetDataset()
+    keys = [measures[2], measures[0]]
+    adata = reader.read_dataset(
+        filesystem=fsspec.filesystem("file"),
+        path=output_dir,
+        dataset=dict(id=""),
+        keys=dict(X=keys, counts=[slice(0, 2)]),
+    )
+    counts = adata.uns[ADATA_LAYERS_UNS_KEY]["counts"]
+    assert adata.X.dtype == np.float32
+    assert counts.X.dtype == np.float32
+    if x_dtype == "float16" and scipy.sparse.issparse(test_data.X):
+        x_dtype = "float32"
+    X = test_data[:, keys].X
+    X_counts = test_data.X[:, 0:2]
+    if scipy.sparse.issparse(X):
+        X = X.toarray()
+        X_counts = X_counts.toarray()
+        adata.X = adata.X.toarray()
+        counts.X = counts.X.toarray()
+    rtol = dict(float32=1e-7, float16=1e-3, uint16=1e-4)[x_dtype]
+    np.testing.assert_allclose(adata.X, X, rtol=rtol, atol=rtol * np.abs(X).max())
+    np.testing.assert_allclose(counts.X, X_counts, rtol=rtol, atol=rtol * np.abs(X_counts).max())
+    np.testing.assert_equal(adata.X != 0, X != 0)
+
+
+def test_quantize():
+    X = np.array([[0, 1.5, 0], [2.0, 1.5, 0], [-1.0, 0, 0]], dtype=np.float64)
+    for matrix in [X, scipy.sparse.csr_matrix(X)]:
+        Xq, scale, offset = quantize(matrix)
+        assert Xq.dtype == np.uint16
+        decoded = dequantize(Xq, scale, offset)
+        if scipy.sparse.issparse(decoded):
+            assert scipy.sparse.issparse(matrix)
+            decoded = decoded.toarray()
+        np.testing.assert_allclose(decoded, X, atol=1e-4)
+        np.testing.assert_equal(decoded != 0, X != 0)
+
+
+def test_quantize_mixed_sign():
+    # column spanning -1..1 with values that round to the code that decodes to zero
+    values = np.linspace(-1, 1, 200001, dtype=np.float32)
+    values = values[values != 0]
+    X = values.reshape(-1, 1)
+    for matrix in [X, scipy.sparse.csc_matrix(X)]:
+        Xq, scale, offset = quantize(matrix)
+        decoded = dequantize(Xq, scale, offset)
+        if scipy.sparse.issparse(decoded):
+            assert decoded.nnz == len(values)
+            decoded = decoded.toarray()
+        assert np.all(decoded != 0)
+        assert np.all(np.sign(decoded) == np.sign(X))
+        np.testing.assert_allclose(decoded, X, atol=1e-4)
+
+
+@pytest.mark.parametrize("sparse_format", ["csr", "csc", None])
+def test_read_h5ad_out_of_core(test_data, sparse_format, tmp_path):
+    test_data = test_data.copy()
+    X = test_data.X.toarray() if scipy.sparse.issparse(test_data.X) else test_data.X
+    test_data.X = X if sparse_format is None else scipy.sparse.csr_matrix(X).asformat(sparse_format)
+    test_data.layers["counts"] = test_data.X.copy()
+    h5ad_path = str(tmp_path / "test.h5ad")
+    test_data.write(h5ad_path)
+    directory = tmp_path / "out_of_core"
+    directory.mkdir()
+    # small blocks to read the matrix in many passes
+    adata = read_h5ad(h5ad_path, str(directory), block_size=10000)
+    for matrix in [adata.X, adata.layers["counts"]]:
+        if sparse_format is None:
+            assert isinstance(matrix, np.memmap)
+            assert matrix.flags.f_contiguous
+        else:
+            assert scipy.sparse.isspmatrix_csc(matrix)
+            assert matrix.has_sorted_indices
+            matrix = matrix.toarray()
+        np.testing.assert_equal(matrix, X)
+    pd.testing.assert_frame_equal(adata.obs, test_data.obs)
+    np.testing.assert_equal(adata.obsm["X_umap"], test_data.obsm["X_umap"])
+
+
+def test_prepare_out_of_core_inputs(test_data, tmp_path):
+    X = test_data.X.toarray() if scipy.sparse.issparse(test_data.X) else test_data.X
+    paths = []
+    for name, var_slice in [("a", slice(0, 25)), ("b", slice(25, 50))]:
+        adata = anndata.AnnData(
+            X=scipy.sparse.csr_matrix(X[:, var_slice]),
+            obs=test_data.obs[[]],
+            var=test_data.var[[]].iloc[var_slice],
+        )
+        paths.append(str(tmp_path / (name + ".h5ad")))
+        adata.write(paths[-1])
+    output_dir = str(tmp_path / "test.zarr")
+    main(paths + ["--out", output_dir, "--out-of-core", "--no-auto-groups"])
+    features = list(test_data.var.index[:50])
+    adata = ZarrDataset().read_dataset(fsspec.filesystem("file"), output_dir, keys=dict(X=features))
+    assert list(adata.var.index) == features
+    np.testing.assert_equal(adata.X.toarray(), X[:, :50])
+
+
+def test_prepare_workers(test_data, measures, dimensions, continuous_obs, basis, tmp_path):
+    output_dir = str(tmp_path / "test.cpq")
+    test_data = test_data[:, measures]
+    test_data.obs = test_data.obs[dimensions + continuous_obs]
+    PrepareData(
+        datasets=[test_data], output=output_dir, output_format="parquet", workers=4
+    ).execute()
+    read_and_diff(
+        ParquetDataset(), output_dir, test_data, measures, dimensions, continuous_obs, basis
+    )
+
+
+def test_get_feature_values():
+    # unsorted indices and an explicit zero in column 0
+    X = scipy.sparse.csc_matrix(
+        (np.array([3.0, 0.0, 1.0, 2.0]), np.array([2, 1, 0, 1]), np.array([0, 3, 4])),
+        shape=(3, 2),
+    )
+    indices, values = get_feature_values(X, 0)
+    np.testing.assert_equal(indices, [0, 2])
+    np.testing.assert_equal(values, [1.0, 3.0])
+    indices, values = get_feature_values(X.toarray(), 1)
+    assert indices is None
+    np.testing.assert_equal(values, [0.0, 2.0, 0.0])
+
+
+@pytest.mark.parametrize("zarr_compressor", ["blosc-zstd", "lz4"])
+def test_prepare_zarr_chunks(
+    test_data, measures, dimensions, continuous_obs, basis, tmp_path, zarr_compressor
+):
+    output_dir = str(tmp_path / "test.zarr")
+    test_data = test_data[:, measures]
+    test_data.obs = test_data.obs[dimensions + continuous_obs]
+    PrepareData(
+        datasets=[test_data],
+        output=output_dir,
+        output_format="zarr",
+        zarr_compressor=zarr_compressor,
+        compression_level=1,
+        features_per_chunk=2,
+    ).execute()
+    X = zarr.open_group(output_dir, mode="r")["X"]
+    if scipy.sparse.issparse(test_data.X):
+        X = X["data"]
+        assert X.chunks == get_matrix_chunks(scipy.sparse.csc_matrix(test_data.X), 2)
+    else:
+        assert X.chunks[1] == 2
+    assert X.compressor.codec_id == zarr_compressor.split("-")[0]
+    read_and_diff(ZarrDataset(), output_dir, test_data, measures, dimensions, continuous_obs, basis)
+
+
+def test_prepare_zarr_consolidated(
+    test_data, measures, dimensions, continuous_obs, basis, tmp_path
+):
+    output_dir = str(tmp_path / "test.zarr")
+    test_data = test_data[:, measures]
+    test_data.obs = test_data.obs[dimensions + continuous_obs]
+    PrepareData(datasets=[test_data], output=output_dir, output_format="zarr").execute()
+    group = open_zarr_group(get_fs(output_dir), output_dir)
+    assert isinstance(group.store, zarr.storage.ConsolidatedMetadataStore)
+    read_and_diff(ZarrDataset(), output_dir, test_data, measures, dimensions, continuous_obs, basis)
+    # datasets without consolidated metadata are still readable
+    (tmp_path / "test.zarr" / ".zmetadata").unlink()
+    group = open_zarr_group(get_fs(output_dir), output_dir)
+    assert not isinstance(group.store, zarr.storage.ConsolidatedMetadataStore)
+    assert ZarrDataset().get_schema(get_fs(output_dir), output_dir)["shape"] == list(
+        test_data.shape
+    )
+
+
+@pytest.mark.parametrize("file_format", ["zarr", "parquet"])
+def test_prepare_incremental(
+    test_data, measures, dimensions, continuous_obs, basis, tmp_path, file_format
+):
+    output_dir = str(tmp_path / ("test." + ("zarr" if file_format == "zarr" else "cpq")))
+    test_data = test_data[:, measures].copy()
+    test_data.obs = test_data.obs[dimensions + continuous_obs + ["n_counts"]]
+    PrepareData(
+        datasets=[test_data.copy()], output=output_dir, output_format=file_format, incremental=True
+    ).execute()
+    X_path = (
+        os.path.join(
+            output_dir, "X", ".zarray" if isinstance(test_data.X, np.ndarray) else ".zgroup"
+        )
+        if file_format == "zarr"
+        else os.path.join(output_dir, "X", measures[0] + ".parquet")
+    )
+    X_mtime = os.path.getmtime(X_path)
+    hashes = read_component_hashes(fsspec.filesystem("file"), output_dir)
+    assert "obs/n_counts" in hashes
+
+    # add and remove an obs column and change an embedding
+    test_data.obs["new"] = np.arange(test_data.shape[0])
+    del test_data.obs["n_counts"]
+    test_data.obsm[basis] = test_data.obsm[basis] + 1
+    PrepareData(
+        datasets=[test_data.copy()], output=output_dir, output_format=file_format, incremental=True
+    ).execute()
+    assert os.path.getmtime(X_path) == X_mtime
+    assert os.path.exists(os.path.join(output_dir, HASHES_FILE))
+    reader = ZarrDataset() if file_format == "zarr" else ParquetDataset()
+    schema = reader.get_schema(fsspec.filesystem("file"), output_dir)
+    obs_names = [c["name"] if isinstance(c, dict) else c for c in schema["obs"]]
+    assert "n_counts" not in obs_names
+    prepared = reader.read_dataset(
+        filesystem=fsspec.filesystem("file"),
+        path=output_dir,
+        dataset=dict(id=""),
+        keys=dict(obs=["new"], basis=[basis]),
+    )
+    np.testing.assert_equal(prepared.obs["new"].values, test_data.obs["new"].values)
+    read_and_diff(reader, output_dir, test_data, measures, dimensions, continuous_obs, basis)
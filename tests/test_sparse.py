@@ -12,7 +12,8 @@ from anndata.tests.helpers import (
 )
 from scipy import sparse
 
-from cirrocumulus.sparse_dataset import SparseDataset
+from cirrocumulus.anndata_zarr import write_attribute
+from cirrocumulus.sparse_dataset import SparseDataset, coalesce_ranges, get_compressed_vectors
 
 
 subset_func2 = subset_func
@@ -84,6 +85,17 @@ def test_backed_indexing_zarr_var(ondisk_equivalent_adata_zarr, subset_func_zarr
     assert_equal(X[:, idx], csc_disk[:, idx])
 
 
+@pytest.mark.parametrize("max_gap", [0, 10, 100000])
+def test_compressed_vectors_zarr(ondisk_equivalent_adata_zarr, max_gap):
+    csr_mem, csr_disk, csc_disk = ondisk_equivalent_adata_zarr
+    X = csr_mem.X.tocsc()
+    # unsorted, with duplicates and adjacent columns
+    idx = np.array([7, 3, 4, 5, 49, 3, 0, 20, 21])
+    data, indices, indptr = get_compressed_vectors(csc_disk.to_backed(), idx, max_gap=max_gap)
+    result = sparse.csc_matrix((data, indices, indptr), shape=(X.shape[0], len(idx)))
+    assert_equal(X[:, idx], result)
+
+
 # subset_func_zarr2 = subset_func_zarr
 #
 #
@@ -203,3 +215,45 @@ def test_wrong_formats(tmp_path):
 
     # Check nothing changed
     assert not np.any((pre_checks != post_checks).toarray())
+
+
+def test_coalesce_ranges_chunks():
+    starts = np.array([0, 30, 100, 250])
+    stops = np.array([10, 40, 110, 260])
+    # gaps are larger than max_gap but ranges 0-1 and 2 share chunks of 100 with their neighbors
+    merged_starts, merged_stops, range_ids = coalesce_ranges(starts, stops, 5, chunk_size=100)
+    np.testing.assert_equal(merged_starts, [0, 100, 250])
+    np.testing.assert_equal(merged_stops, [40, 110, 260])
+    np.testing.assert_equal(range_ids, [0, 0, 1, 2])
+    merged_starts, merged_stops, range_ids = coalesce_ranges(starts, stops, 5)
+    np.testing.assert_equal(range_ids, [0, 1, 2, 3])
+
+
+class RecordingArray:
+    """Array wrapper that records the slices that are read."""
+
+    def __init__(self, array):
+        self.array = array
+        self.chunks = array.chunks
+        self.reads = []
+
+    def __getitem__(self, s):
+        self.reads.append(s)
+        return self.array[s]
+
+
+def test_compressed_vectors_zarr_chunks(tmp_path):
+    X = sparse.random(200, 100, format="csc", density=0.2, random_state=0, dtype=np.float32)
+    group = zarr.open_group(str(tmp_path / "X.zarr"), mode="w")
+    write_attribute(group, "X", X, dict(chunks=(256,)))
+    backed = SparseDataset(group["X"]).to_backed()
+    backed.data = RecordingArray(backed.data)
+    backed.indices = RecordingArray(backed.indices)
+    idx = np.arange(0, 100, 3)
+    data, indices, indptr = get_compressed_vectors(backed, idx, max_gap=0)
+    result = sparse.csc_matrix((data, indices, indptr), shape=(X.shape[0], len(idx)))
+    assert_equal(X[:, idx], result)
+    for array in [backed.data, backed.indices]:
+        # no chunk is read more than once
+        chunks = [set(range(s.start // 256, (s.stop - 1) // 256 + 1)) for s in array.reads]
+        assert sum(map(len, chunks)) == len(set().union(*chunks))